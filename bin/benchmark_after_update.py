@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Benchmark the per-edit overhead of getting the dict of an updated dataset
+
+Compares building the datapackage committed after an update from a full
+``package_show`` with building it from the dict passed to ``after_update``
+(see ``get_updated_package_dict``). A temporary dataset is created in the
+database configured by the given CKAN config file, and purged at the end.
+
+Usage:
+
+    python bin/benchmark_after_update.py test.ini [--resources 20] [--runs 200]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+try:
+    from ckan.cli import load_config
+except ImportError:
+    from ckan.lib.cli import load_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('config', help='CKAN configuration file')
+    parser.add_argument('--resources', type=int, default=20, help='number of resources of the dataset')
+    parser.add_argument('--runs', type=int, default=200, help='number of times each variant is run')
+    args = parser.parse_args()
+
+    load_config(args.config)
+
+    from ckan import model
+    from ckan.plugins import toolkit
+
+    from ckanext.versioning.common import get_excluded_fields
+    from ckanext.versioning.datapackage import dataset_to_frictionless
+    from ckanext.versioning.logic.action import get_updated_package_dict
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {'model': model, 'session': model.Session, 'user': site_user['name'], 'ignore_auth': True}
+    dataset = toolkit.get_action('package_create')(dict(context), {
+        'name': 'versioning-benchmark-after-update',
+        'tags': [{'name': 'tag-{}'.format(i)} for i in range(10)],
+        'extras': [{'key': 'extra-{}'.format(i), 'value': str(i)} for i in range(10)],
+        'resources': [{'url': 'https://example.com/data-{}.csv'.format(i), 'name': 'Resource {}'.format(i)}
+                      for i in range(args.resources)],
+    })
+
+    exclude_fields = get_excluded_fields()
+    # The validated data dict CKAN passes to after_update looks much like the input
+    data_dict = {k: v for k, v in dataset.items() if k not in ('organization', 'tracking_summary')}
+
+    def from_package_show():
+        dataset_to_frictionless(toolkit.get_action('package_show')({}, {'id': dataset['id']}), exclude_fields)
+
+    def from_updated_dict():
+        dataset_to_frictionless(get_updated_package_dict(dict(context), data_dict), exclude_fields)
+
+    try:
+        for name, func in (('package_show', from_package_show), ('after_update dict', from_updated_dict)):
+            seconds = min(timeit.repeat(func, number=args.runs, repeat=3))
+            print('{:<20} {:8.2f} ms per edit'.format(name, seconds / args.runs * 1000))
+    finally:
+        toolkit.get_action('dataset_purge')(dict(context), {'id': dataset['id']})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Benchmark converting very large datasets to datapackages
+
+Times ``dataset_to_frictionless`` on a synthetic dataset with many resources,
+a share of which have the same file name, with and without a warm
+``ResourceConversionCache``, and, if ``--processes`` is given, converted in
+a ``ParallelConverter``. Checks that all resource paths of the resulting
+datapackage are unique. No CKAN environment is needed.
+
+Usage:
+
+    python bin/benchmark_datapackage.py [--resources 100000] [--duplicates 0.5] [--runs 3] [--processes 4]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from ckanext.versioning.datapackage import ParallelConverter, ResourceConversionCache, dataset_to_frictionless
+
+
+def _dataset(resources, duplicates):
+    unique = max(1, int(resources * (1 - duplicates)))
+    return {
+        'id': 'benchmark-dataset',
+        'name': 'benchmark-dataset',
+        'title': 'Benchmark dataset',
+        'resources': [{'id': 'resource-{}'.format(i),
+                       'name': 'Resource {}'.format(i),
+                       'url': 'https://example.com/data/file-{}.csv'.format(i % unique),
+                       'format': 'CSV'}
+                      for i in range(resources)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--resources', type=int, default=100000, help='number of resources of the dataset')
+    parser.add_argument('--duplicates', type=float, default=0.5,
+                        help='share of resources whose file name is used by another resource')
+    parser.add_argument('--runs', type=int, default=3, help='number of times each variant is run')
+    parser.add_argument('--processes', type=int, default=0, help='number of worker processes to also convert with')
+    args = parser.parse_args()
+
+    dataset = _dataset(args.resources, args.duplicates)
+    cache = ResourceConversionCache()
+    cache.convert(dataset['id'], dataset['resources'])
+
+    variants = [('uncached', lambda: dataset_to_frictionless(dataset)),
+                ('cached', lambda: dataset_to_frictionless(dataset, resource_cache=cache))]
+    converter = None
+    if args.processes > 0:
+        converter = ParallelConverter(args.processes, threshold=0)
+        variants.append(('parallel', lambda: dataset_to_frictionless(dataset, converter=converter)))
+
+    try:
+        for name, func in variants:
+            paths = [resource['path'] for resource in func()['resources']]
+            assert len(set(paths)) == len(paths), 'resource paths are not unique'
+            seconds = min(timeit.repeat(func, number=1, repeat=args.runs))
+            print('{:<10} {:8.1f} ms per conversion'.format(name, seconds * 1000))
+    finally:
+        if converter is not None:
+            converter.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Batch sessions for scripts making bulk changes to datasets
+"""
+import contextlib
+import logging
+
+from ckanext.versioning.common import begin_batch_session, end_batch_session
+from ckanext.versioning.logic.action import commit_batch_session
+
+log = logging.getLogger(__name__)
+
+
+@contextlib.contextmanager
+def batch_session(threads=None):
+    """Defer metastore commits while making bulk changes to datasets
+
+    Dataset changes made in the block, by the current thread, are committed
+    when it exits, one revision per changed dataset, even if the block
+    raises an exception. Changes made by other threads, e.g. concurrent web
+    requests served by the same process, are committed as usual. The summary
+    returned by :func:`~ckanext.versioning.logic.action.commit_batch_session`
+    is stored in the ``summary`` key of the yielded dict.
+
+    Usage::
+
+        with batch_session() as batch:
+            for dataset_id in dataset_ids:
+                toolkit.get_action('package_patch')(context, {'id': dataset_id, ...})
+        print(batch['summary'])
+    """
+    session = begin_batch_session()
+    if session is None:
+        raise RuntimeError('A batch session is already in progress in this thread')
+
+    log.info('Batch session started; metastore commits are deferred')
+    batch = {}
+    try:
+        yield batch
+    finally:
+        end_batch_session()
+        batch['summary'] = commit_batch_session(session, threads)
@@ -1,22 +1,37 @@
+import hashlib
+import json
+
 from ckan import model
 from ckan.lib import helpers as h
 from ckan.plugins import toolkit
-from flask import Blueprint
+from flask import Blueprint, make_response, request
 
 from ckanext.versioning.logic import helpers
 
+# Max age for pages pinned to an immutable revision ID
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
 versioning = Blueprint('versioning', __name__)
 
 
 def show(package_id, revision_ref=None):
+    etag, cache_control = _get_revision_cache_headers(package_id, revision_ref)
+    if etag and etag in request.if_none_match:
+        return _not_modified(etag, cache_control)
+
     pkg_dict = _get_package(package_id, revision_ref)
     toolkit.c.pkg_dict = pkg_dict
-    return toolkit.render('package/read.html')
+    return _with_cache_headers(toolkit.render('package/read.html'), etag, cache_control)
 
 
 def resource_show(package_id, resource_id, revision_ref=None):
     """Show a resource of a package, optionally in a given revision / release
     """
+    view_id = toolkit.request.args.get('view_id')
+    etag, cache_control = _get_revision_cache_headers(package_id, revision_ref, resource_id, view_id)
+    if etag and etag in request.if_none_match:
+        return _not_modified(etag, cache_control)
+
     pkg_dict = _get_package(package_id, revision_ref)
     resource = helpers.find_resource_in_package(pkg_dict, resource_id)
 
@@ -36,7 +51,6 @@ def resource_show(package_id, resource_id, revision_ref=None):
     resource['has_views'] = len(resource_views) > 0
 
     current_resource_view = None
-    view_id = toolkit.request.args.get('view_id')
     if resource['has_views']:
         if view_id:
             current_resource_view = [rv for rv in resource_views
@@ -52,8 +66,8 @@ def resource_show(package_id, resource_id, revision_ref=None):
                      'current_resource_view': current_resource_view,
                      'dataset_type': pkg_dict['type'] or 'dataset'}
 
-    return toolkit.render('package/resource_read.html',
-                          extra_vars=template_vars)
+    return _with_cache_headers(toolkit.render('package/resource_read.html', extra_vars=template_vars),
+                               etag, cache_control)
 
 
 def changes(id):
@@ -124,6 +138,96 @@ def _get_package(package_id, revision_ref=None):
     return toolkit.get_action('package_show')(context, data_dict)
 
 
+def _get_revision_cache_headers(package_id, revision_ref, resource_id=None, view_id=None):
+    """Get ETag and Cache-Control header values for a view pinned to a
+    revision or release
+
+    The ETag is derived from the fingerprint of the dataset revision the
+    view resolves to (see ``dataset_revision_fingerprint``), the user and
+    their permissions on the dataset, and the live data the page shows
+    besides the revision (the dataset's visibility and state, its owner
+    organization, resource views and page view counts). Resource pages also depend on the ``resource_id`` and
+    ``view_id`` they show.
+
+    Pages of public, active datasets pinned to a revision ID can be cached
+    for a long time, unless they show page view counts; Other pages need to
+    be revalidated, as a release may be moved, and the dataset may be made
+    private or deleted.
+
+    Returns (None, None) if the view is not pinned to a revision, or if the
+    revision cannot be resolved; The view is then expected to handle errors.
+    """
+    if not revision_ref:
+        return None, None
+
+    context = _get_context()
+    try:
+        fingerprint = toolkit.get_action('dataset_revision_fingerprint')(
+            context, {'dataset': package_id, 'revision_ref': revision_ref})
+    except (toolkit.ObjectNotFound, toolkit.NotAuthorized, toolkit.ValidationError):
+        return None, None
+
+    pkg = model.Package.get(package_id)
+    tracking = toolkit.asbool(toolkit.config.get('ckan.tracking_enabled', False))
+    etag_source = [fingerprint['fingerprint'], pkg.state, pkg.private, _get_organization_source(pkg.owner_org),
+                   resource_id, view_id, toolkit.c.user or '',
+                   h.check_access('package_update', {'id': package_id}), h.lang()]
+    if resource_id:
+        etag_source.append(_get_resource_views_source(resource_id))
+    if tracking:
+        etag_source.append(_get_tracking_source(pkg.id, resource_id))
+    etag = hashlib.sha1(json.dumps(etag_source).encode('utf-8')).hexdigest()
+
+    public_dataset = not pkg.private and pkg.state == 'active'
+    scope = 'public' if public_dataset and not toolkit.c.user else 'private'
+    if fingerprint['immutable'] and public_dataset and not tracking:
+        cache_control = '{}, max-age={}, immutable'.format(scope, IMMUTABLE_MAX_AGE)
+    else:
+        cache_control = '{}, no-cache'.format(scope)
+    return etag, cache_control
+
+
+def _get_organization_source(org_id):
+    """Get the owner organization fields shown on dataset pages, for ETags
+    """
+    org = model.Group.get(org_id) if org_id else None
+    if org is None:
+        return None
+    return [org.id, org.name, org.title, org.image_url, org.state]
+
+
+def _get_resource_views_source(resource_id):
+    """Get the views of a resource, for ETags
+    """
+    views = model.Session.query(model.ResourceView).filter_by(resource_id=resource_id) \
+        .order_by(model.ResourceView.order)
+    return [[v.id, v.view_type, v.title, v.description, v.config] for v in views]
+
+
+def _get_tracking_source(package_id, resource_id):
+    """Get the page view counts shown on dataset and resource pages, for ETags
+    """
+    source = [model.TrackingSummary.get_for_package(package_id)]
+    resource = model.Resource.get(resource_id) if resource_id else None
+    if resource is not None:
+        source.append(model.TrackingSummary.get_for_resource(resource.url))
+    return source
+
+
+def _not_modified(etag, cache_control):
+    return _with_cache_headers(make_response('', 304), etag, cache_control)
+
+
+def _with_cache_headers(response, etag, cache_control):
+    """Add caching headers to a view's response, if any
+    """
+    response = make_response(response)
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+    return response
+
+
 def _get_context():
     """Get context for actions
     """
@@ -1,27 +1,367 @@
 import contextlib
-from ast import literal_eval
+import functools
+import logging
+import os
+import threading
+from multiprocessing.pool import ThreadPool
 
 from ckan.plugins import toolkit
-from metastore.backend import StorageBackend, create_metastore
+from metastore.backend import StorageBackend
 from metastore.types import Author
 
+from ckanext.versioning.datapackage import DEFAULT_PARALLEL_THRESHOLD, ParallelConverter, ResourceConversionCache
+from ckanext.versioning.lib.backend import BackendPool, RequestCachedBackend
+from ckanext.versioning.lib.batch import BatchSession
+from ckanext.versioning.lib.cache import LRUCache, TieredCache
+from ckanext.versioning.lib.commits import HeadHashes
+from ckanext.versioning.lib.disk_cache import SQLiteCache
+from ckanext.versioning.lib.releases import ReleaseCache
+from ckanext.versioning.lib.write_queue import MemoryWriteQueue, SQLiteWriteQueue, WriteBehindQueue
+
+DEFAULT_EXCLUDE_FIELDS = 'metadata_modified tracking_summary num_resources num_tags'
+DEFAULT_REVISION_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_REVISION_CACHE_DIR_SIZE = 1024 * 1024 * 1024
+DEFAULT_RELEASE_CACHE_TTL = 300
+DEFAULT_RELEASE_CACHE_NEGATIVE_TTL = 10
+DEFAULT_RELEASE_LIST_CACHE_TTL = 60
+DEFAULT_RELEASE_LIST_STALE_TTL = 3600
+DEFAULT_FRAGMENT_CACHE_SIZE = 16 * 1024 * 1024
+DEFAULT_FRAGMENT_CACHE_TTL = 3600
+DEFAULT_HEAD_HASH_CACHE_SIZE = 4 * 1024 * 1024
+DEFAULT_FETCH_THREADS = 4
+DEFAULT_CONVERSION_CACHE_DATASETS = 50
+DEFAULT_WRITE_QUEUE_MAX_ATTEMPTS = 10
+DEFAULT_BATCH_COMMIT_THREADS = 4
+DEFAULT_MAX_REVISIONS_PER_CALL = 50
+DEFAULT_MAX_DATASETS_PER_CALL = 500
+
+log = logging.getLogger(__name__)
+
+_backend_pool = BackendPool()
+_caches = {}
+_caches_lock = threading.Lock()
+_fetch_pool = None
+_fetch_pool_lock = threading.Lock()
+_batch_local = threading.local()
+
 
 def get_metastore_backend():
     # type: () -> StorageBackend
     '''Returns a metastore object.
 
     The type and the configuration of the metastore object is defined in the
-    configuration file of CKAN.
+    configuration file of CKAN. Backend instances are pooled per thread and
+    re-created only when the configuration changes.
+
+    When called while handling a request, read operations on the returned
+    backend are memoized for the rest of the request, so the same dataset /
+    revision is not read from the backend more than once per request.
+    '''
+    backend_type = toolkit.config.get('ckanext.versioning.backend_type')
+    config = toolkit.config.get('ckanext.versioning.backend_config')
+    backend = _backend_pool.get(backend_type, config)
+
+    memo = _get_request_memo()
+    if memo is None:
+        return backend
+    return RequestCachedBackend(backend, memo)
+
+
+def get_thread_backend_getter():
+    '''Get a callable returning a metastore backend instance for the calling
+    thread
+
+    The backend configuration is read when this is called, so the returned
+    callable can be used from worker threads, which have no access to the
+    current request or to CKAN's configuration.
     '''
     backend_type = toolkit.config.get('ckanext.versioning.backend_type')
+    config = toolkit.config.get('ckanext.versioning.backend_config')
+    return functools.partial(_backend_pool.get, backend_type, config)
+
+
+def get_fetch_pool():
+    # type: () -> ThreadPool
+    '''Get the process-wide thread pool used to read from the metastore
+    backend concurrently
+
+    The number of threads is set by ``ckanext.versioning.fetch_threads``.
+    '''
+    global _fetch_pool
+    with _fetch_pool_lock:
+        # Threads do not survive forking worker processes
+        if _fetch_pool is None or _fetch_pool[0] != os.getpid():
+            size = toolkit.asint(toolkit.config.get('ckanext.versioning.fetch_threads', DEFAULT_FETCH_THREADS))
+            _fetch_pool = (os.getpid(), ThreadPool(max(size, 1)))
+        return _fetch_pool[1]
+
+
+def _get_request_memo():
+    '''Get the backend read memo dict bound to the current request
+
+    Returns None if not called in the context of a request
+    '''
     try:
-        config = literal_eval(
-            toolkit.config.get('ckanext.versioning.backend_config')
-        )
-    except ValueError:
-        config = {}
+        environ = toolkit.request.environ
+    except (AttributeError, RuntimeError, TypeError):
+        return None
+    return environ.setdefault('ckanext.versioning.backend_memo', {})
+
+
+def invalidate_request_reads(package_id):
+    '''Drop backend reads of a package memoized for the current request
+
+    This must be called after writing to the backend other than through
+    :func:`get_metastore_backend`, e.g. by flushing the write-behind queue,
+    so that the rest of the request does not see stale data.
+    '''
+    memo = _get_request_memo()
+    if memo is not None:
+        memo.pop(package_id, None)
+
 
-    return create_metastore(backend_type, config)
+def reset_metastore_backend():
+    '''Drop all pooled metastore backend instances
+
+    This should be called if the backend needs to be re-created even though
+    its configuration did not change, e.g. after rotating credentials.
+    '''
+    _backend_pool.invalidate()
+
+
+def get_metastore_backend_stats():
+    '''Get hit / miss counters of the metastore backend pool
+    '''
+    return _backend_pool.stats.as_dict()
+
+
+def get_excluded_fields():
+    # type: () -> frozenset
+    '''Get the names of CKAN dataset and resource fields which are not
+    stored in versioned datapackages
+
+    These are set by ``ckanext.versioning.exclude_fields``, a space and / or
+    comma separated list. They default to fields which are derived from other
+    fields or change without the dataset being modified.
+    '''
+    value = toolkit.config.get('ckanext.versioning.exclude_fields', DEFAULT_EXCLUDE_FIELDS)
+    return frozenset(toolkit.aslist(value.replace(',', ' ')))
+
+
+def get_revision_cache():
+    # type: () -> LRUCache
+    '''Get the process-wide cache of CKAN dataset dicts converted from
+    datapackages at a given (immutable) revision
+
+    Converted dataset dicts are stored by content hash of the datapackage,
+    and revisions map to that hash (see ``_load_dataset_in_revision``).
+
+    The cache is bounded by ``ckanext.versioning.revision_cache_size``, in
+    bytes. Setting it to 0 disables the cache.
+
+    If ``ckanext.versioning.revision_cache_dir`` is set, an additional on-disk
+    cache tier shared by all worker processes is kept in that directory,
+    bounded by ``ckanext.versioning.revision_cache_dir_size`` bytes.
+    '''
+    return _get_cache('revision', _create_revision_cache)
+
+
+def _create_revision_cache():
+    memory_cache = LRUCache(toolkit.asint(
+        toolkit.config.get('ckanext.versioning.revision_cache_size', DEFAULT_REVISION_CACHE_SIZE)))
+
+    cache_dir = toolkit.config.get('ckanext.versioning.revision_cache_dir')
+    if not cache_dir:
+        return memory_cache
+
+    disk_cache = SQLiteCache(
+        os.path.join(cache_dir, 'revisions.sqlite'),
+        toolkit.asint(toolkit.config.get('ckanext.versioning.revision_cache_dir_size',
+                                         DEFAULT_REVISION_CACHE_DIR_SIZE)))
+    return TieredCache(memory_cache, disk_cache)
+
+
+def get_release_cache():
+    # type: () -> ReleaseCache
+    '''Get the process-wide cache of releases by dataset and release name
+
+    Release actions are responsible for keeping this cache up to date.
+    Entries expire after ``ckanext.versioning.release_cache_ttl`` seconds;
+    Names of releases which do not exist are remembered for
+    ``ckanext.versioning.release_cache_negative_ttl`` seconds.
+
+    Lists of releases are fresh for ``ckanext.versioning.release_list_cache_ttl``
+    seconds, and are served stale while being reloaded for up to
+    ``ckanext.versioning.release_list_stale_ttl`` more seconds.
+    '''
+    return _get_cache('release', lambda: ReleaseCache(
+        ttl=toolkit.asint(toolkit.config.get('ckanext.versioning.release_cache_ttl',
+                                             DEFAULT_RELEASE_CACHE_TTL)),
+        negative_ttl=toolkit.asint(toolkit.config.get('ckanext.versioning.release_cache_negative_ttl',
+                                                      DEFAULT_RELEASE_CACHE_NEGATIVE_TTL)),
+        list_ttl=toolkit.asint(toolkit.config.get('ckanext.versioning.release_list_cache_ttl',
+                                                  DEFAULT_RELEASE_LIST_CACHE_TTL)),
+        list_stale_ttl=toolkit.asint(toolkit.config.get('ckanext.versioning.release_list_stale_ttl',
+                                                        DEFAULT_RELEASE_LIST_STALE_TTL))))
+
+
+def get_fragment_cache():
+    # type: () -> LRUCache
+    '''Get the process-wide cache of rendered template fragments
+
+    The cache is bounded by ``ckanext.versioning.fragment_cache_size``, in
+    bytes. Setting it to 0 disables the cache.
+    '''
+    return _get_cache('fragment', lambda: LRUCache(toolkit.asint(
+        toolkit.config.get('ckanext.versioning.fragment_cache_size', DEFAULT_FRAGMENT_CACHE_SIZE))))
+
+
+def get_resource_conversion_cache():
+    # type: () -> Optional[ResourceConversionCache]
+    '''Get the process-wide cache of converted resources, used to convert
+    only changed resources when a dataset is saved
+
+    Resources of up to ``ckanext.versioning.conversion_cache_datasets``
+    recently saved datasets are kept. Returns None if this is set to 0.
+    '''
+    max_datasets = toolkit.asint(toolkit.config.get('ckanext.versioning.conversion_cache_datasets',
+                                                    DEFAULT_CONVERSION_CACHE_DATASETS))
+    if max_datasets <= 0:
+        return None
+    return _get_cache('resource_conversion', lambda: ResourceConversionCache(max_datasets))
+
+
+def get_parallel_converter():
+    # type: () -> Optional[ParallelConverter]
+    '''Get the process-wide pool of processes converting the resources of
+    very large datasets
+
+    Datasets with at least ``ckanext.versioning.conversion_parallel_threshold``
+    resources are converted in ``ckanext.versioning.conversion_processes``
+    worker processes. Returns None if this is not set, which is the default.
+    '''
+    processes = toolkit.asint(toolkit.config.get('ckanext.versioning.conversion_processes', 0))
+    if processes <= 0:
+        return None
+    threshold = toolkit.asint(toolkit.config.get('ckanext.versioning.conversion_parallel_threshold',
+                                                 DEFAULT_PARALLEL_THRESHOLD))
+    return _get_cache('parallel_converter', lambda: ParallelConverter(processes, threshold))
+
+
+def get_head_hashes():
+    # type: () -> Optional[HeadHashes]
+    '''Get the process-wide store of content hashes of the latest revision
+    of each dataset, used to skip commits which would not change anything
+
+    Returns None if ``ckanext.versioning.skip_unchanged_revisions`` is
+    disabled, in which case every save of a dataset creates a new revision.
+    '''
+    if not toolkit.asbool(toolkit.config.get('ckanext.versioning.skip_unchanged_revisions', True)):
+        return None
+    return _get_cache('head_hashes', lambda: HeadHashes(LRUCache(DEFAULT_HEAD_HASH_CACHE_SIZE)))
+
+
+def get_write_queue():
+    # type: () -> Optional[WriteBehindQueue]
+    '''Get the process-wide metastore write-behind queue
+
+    Returns None unless ``ckanext.versioning.write_mode`` is set to
+    ``async`` or ``ckanext.versioning.write_coalesce_window`` is set, in
+    which case datapackages are committed to the metastore backend in a
+    background thread. Jobs are stored in an SQLite database at
+    ``ckanext.versioning.write_queue_path``; If not set, a non-durable
+    in-memory queue is used.
+
+    The worker thread is started right away if jobs left by a process which
+    exited are pending.
+    '''
+    if (toolkit.config.get('ckanext.versioning.write_mode', 'sync') != 'async'
+            and not _get_coalesce_window()):
+        return None
+    write_queue = _get_cache('write_queue', _create_write_queue)
+    write_queue.resume()
+    return write_queue
+
+
+def _create_write_queue():
+    path = toolkit.config.get('ckanext.versioning.write_queue_path')
+    if path:
+        queue = SQLiteWriteQueue(path)
+    else:
+        log.warning('ckanext.versioning.write_queue_path is not set; '
+                    'pending metastore writes will be lost if the process exits')
+        queue = MemoryWriteQueue()
+
+    return WriteBehindQueue(
+        queue,
+        get_thread_backend_getter(),
+        max_attempts=toolkit.asint(toolkit.config.get('ckanext.versioning.write_queue_max_attempts',
+                                                      DEFAULT_WRITE_QUEUE_MAX_ATTEMPTS)),
+        head_hashes=get_head_hashes(),
+        coalesce_window=_get_coalesce_window())
+
+
+def _get_coalesce_window():
+    return toolkit.asint(toolkit.config.get('ckanext.versioning.write_coalesce_window', 0))
+
+
+def get_batch_session():
+    # type: () -> Optional[BatchSession]
+    '''Get the batch session in progress in the current thread, if any
+
+    While a batch session is in progress, changes to datasets made in the
+    same thread are only recorded in it, and are committed to the metastore
+    backend when the session ends. Changes made by other threads, e.g.
+    concurrent web requests, are not affected.
+    '''
+    return getattr(_batch_local, 'session', None)
+
+
+def begin_batch_session():
+    # type: () -> Optional[BatchSession]
+    '''Start a batch session in the current thread
+
+    Returns None if a batch session is already in progress.
+    '''
+    if getattr(_batch_local, 'session', None) is not None:
+        return None
+    _batch_local.session = BatchSession()
+    return _batch_local.session
+
+
+def end_batch_session():
+    # type: () -> Optional[BatchSession]
+    '''End the batch session in progress in the current thread, and return it
+
+    Returns None if no batch session is in progress.
+    '''
+    session = getattr(_batch_local, 'session', None)
+    _batch_local.session = None
+    return session
+
+
+def clear_caches():
+    '''Drop all process-wide caches
+
+    Caches are re-created, with current configuration, on next use.
+    '''
+    with _caches_lock:
+        for cache in _caches.values():
+            if hasattr(cache, 'close'):
+                cache.close()
+        _caches.clear()
+
+
+def _get_cache(name, factory):
+    '''Get a process-wide cache object, creating it on first use
+    '''
+    try:
+        return _caches[name]
+    except KeyError:
+        with _caches_lock:
+            if name not in _caches:
+                _caches[name] = factory()
+            return _caches[name]
 
 
 def create_author_from_context(context):
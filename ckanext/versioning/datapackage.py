@@ -2,72 +2,317 @@
 
 See http://specs.frictionlessdata.io/data-package/ for datapackage specs
 """
+import hashlib
+import json
+import multiprocessing
 import re
+import threading
+from collections import OrderedDict
+from itertools import chain
 from typing import Any, Dict
 
 import frictionless_ckan_mapper.ckan_to_frictionless as ctf
 import frictionless_ckan_mapper.frictionless_to_ckan as ftc
 from six import iteritems
 
+from ckanext.versioning.lib.cache import CacheStats
+
 FALLBACK_RESOURCE_PATH = 'resource'
 
+DEFAULT_PARALLEL_THRESHOLD = 10000
+
+_PARENT_DIR_RE = re.compile(r'/?(?:(?:\.)+/)+')
+
+# Fields which change on every save, without the dataset itself changing
+HASH_IGNORED_FIELDS = ('metadata_modified', 'revision_id', 'tracking_summary')
 
-def dataset_to_frictionless(ckan_dataset):
+
+def dataset_to_frictionless(ckan_dataset, exclude_fields=(), resource_cache=None, converter=None):
     """Convert a CKAN dataset dict to a Frictionless datapackage
+
+    CKAN fields listed in ``exclude_fields`` are left out of the
+    datapackage, both from the dataset and from each resource.
+
+    If a :class:`ResourceConversionCache` is specified, only resources
+    which changed since the dataset was last converted with it are
+    converted again. If a :class:`ParallelConverter` is specified, the
+    resources of large datasets are converted in its worker processes. The
+    result is the same either way.
     """
-    package = _convert_excluding_path(ckan_dataset)
-    _normalize_resource_paths(package)
+    if exclude_fields:
+        ckan_dataset = _exclude_fields(ckan_dataset, exclude_fields)
+
+    resources = ckan_dataset.get('resources')
+    if resources is None:
+        return ctf.dataset(ckan_dataset)
+
+    # Convert the dataset with a placeholder, to keep the order of keys
+    package = ctf.dataset(dict(ckan_dataset, resources=[]))
+    convert = _map if converter is None else converter.map
+    if resource_cache is None:
+        converted = convert(_convert_resource, resources)
+    else:
+        converted = resource_cache.convert(ckan_dataset.get('id') or ckan_dataset.get('name'), resources, convert)
+    package['resources'] = _assign_resource_paths(converted)
     return package
 
 
-def frictionless_to_dataset(datapackage):
+def frictionless_to_dataset(datapackage, converter=None):
     """Convert a Frictionless data datapackage dict to a CKAN dataset dict
+
+    If a :class:`ParallelConverter` is specified, the resources of large
+    datapackages are converted in its worker processes.
+    """
+    resources = datapackage.get('resources')
+    if converter is None or not resources or len(resources) < converter.threshold:
+        return ftc.package(datapackage)
+
+    # Resources do not affect how the rest of the package is converted
+    dataset = ftc.package(dict(datapackage, resources=[]))
+    dataset['resources'] = converter.map(ftc.resource, resources)
+    return dataset
+
+
+def prepare_dataset(datapackage, converter=None):
+    """Convert a datapackage to a CKAN dataset dict to be applied to live
+    package dicts with :func:`update_ckan_dict`
+
+    Extras duplicating fields of the dataset are removed right away, as
+    ``update_ckan_dict`` would remove them anyway. The result only depends on
+    the content of the datapackage, so it can be shared by all revisions and
+    datasets with the same content.
+    """
+    dataset = frictionless_to_dataset(datapackage, converter)
+    if dataset.get('extras'):
+        dataset['extras'] = _normalize_extras(dataset)
+    return dataset
+
+
+def frictionless_to_resource(resource):
+    """Convert a single Frictionless data resource dict to a CKAN resource dict
     """
-    return ftc.package(datapackage)
+    return ftc.resource(resource)
 
 
-def _convert_excluding_path(ckan_dataset):
-    """Convert a CKAN dataset to a frictionless package but exclude custom `path` values
+def datapackage_hash(datapackage, ignored_fields=HASH_IGNORED_FIELDS):
+    # type: (Dict[str, Any], Any) -> str
+    """Get a hash of the content of a datapackage
 
-    This is done because frictionless_ckan_mapper will override `path` if URL is set for
-    a resource, but we want to preserve `path` if it was previously set.
+    The hash does not depend on key order, and ignores the fields listed in
+    ``ignored_fields``. By default these are ``HASH_IGNORED_FIELDS``, so
+    datapackages converted from a dataset that was saved again without
+    changes have the same hash.
     """
-    existing_paths = {i: r['path']
-                      for i, r in enumerate(ckan_dataset.get('resources', []))
-                      if 'path' in r}
+    content = {k: v for k, v in iteritems(datapackage) if k not in ignored_fields}
+    if 'resources' in content:
+        content['resources'] = [{k: v for k, v in iteritems(r) if k not in ignored_fields}
+                                for r in content['resources']]
+    serialized = json.dumps(content, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
 
-    package = ctf.dataset(ckan_dataset)
 
-    for i, path in iteritems(existing_paths):
-        package['resources'][i]['path'] = path
+def _exclude_fields(ckan_dataset, exclude_fields):
+    """Get a shallow copy of a CKAN dataset dict without some fields
+    """
+    dataset = {k: v for k, v in iteritems(ckan_dataset) if k not in exclude_fields}
+    if 'resources' in dataset:
+        dataset['resources'] = [{k: v for k, v in iteritems(r) if k not in exclude_fields}
+                                for r in dataset['resources']]
+    return dataset
 
-    return package
 
+def _convert_resource(ckan_resource):
+    """Convert a CKAN resource, without making its path unique in the package
 
-def _normalize_resource_paths(package):
-    """Normalize the paths of all resources
+    Returns a tuple of the converted resource and its normalized path, or
+    None if it has no path.
+
+    Custom `path` values are preserved, as frictionless_ckan_mapper will
+    override `path` if URL is set for a resource.
     """
-    parent_dir_re = re.compile(r'/?(?:(?:\.)+/)+')
-    existing_paths = set()
+    resource = ctf.resource(ckan_resource)
+    if 'path' in ckan_resource:
+        resource['path'] = ckan_resource['path']
+
+    path = _get_resource_path(resource)
+    if path is not None:
+        path = _PARENT_DIR_RE.sub('/', path).lstrip('/') or FALLBACK_RESOURCE_PATH
+        resource['path'] = path
+    return resource, path
+
+
+def _assign_resource_paths(converted):
+    """Get the list of resources of a package from converted resources,
+    making their paths unique
 
-    for counter, resource in enumerate(package.get('resources', [])):
-        path = _get_resource_path(resource)
+    The first resource with a given path keeps it. Other resources with the
+    same path get a suffix based on their position in the package, which is
+    extended further if the suffixed path is taken as well. Paths which were
+    unique to begin with are never changed, so adding or removing a
+    duplicate does not change the paths of other resources.
+
+    Converted resources are copied only if their path has to be changed.
+    """
+    taken = set()
+    duplicates = []
+    for counter, (_, path) in enumerate(converted):
         if path is None:
             continue
+        if path in taken:
+            duplicates.append(counter)
+        else:
+            taken.add(path)
 
-        path = parent_dir_re.sub('/', path)
-        try:
-            while path[0] == '/':
-                path = path[1:]
-        except IndexError:
-            path = FALLBACK_RESOURCE_PATH
+    resources = [resource for resource, _ in converted]
+    for counter in duplicates:
+        resource, path = converted[counter]
+        suffix = '-{}'.format(counter)
+        unique_path = _add_filename_suffix(path, suffix)
+        attempt = 1
+        while unique_path in taken:
+            attempt += 1
+            unique_path = _add_filename_suffix(path, '{}-{}'.format(suffix, attempt))
+        taken.add(unique_path)
+        resources[counter] = dict(resource, path=unique_path)
+    return resources
 
-        if path in existing_paths:
-            path = _add_filename_suffix(path, '-{}'.format(counter))
-        else:
-            existing_paths.add(path)
 
-        resource['path'] = path
+def _map(func, items):
+    return [func(item) for item in items]
+
+
+def _map_chunk(args):
+    func, chunk = args
+    return [func(item) for item in chunk]
+
+
+class ParallelConverter(object):
+    """Pool of worker processes converting the resources of large packages
+
+    Lists of at least ``threshold`` items are split into chunks, which are
+    converted in up to ``processes`` worker processes; results are merged
+    back in order. Shorter lists are converted in the calling process, as
+    sending resources to other processes costs more than converting them.
+
+    Worker processes are started when first needed. As the calling process
+    may be running other threads (e.g. a threaded web server), which may
+    hold locks when forking, they are started from a fork server where
+    available, or spawned; On Python 2, they can only be forked. Conversion
+    functions must be picklable, i.e. defined at the top level of a module.
+    """
+
+    # Number of chunks per process, so that uneven chunks balance out
+    CHUNKS_PER_PROCESS = 4
+
+    def __init__(self, processes, threshold=DEFAULT_PARALLEL_THRESHOLD):
+        self.processes = processes
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def map(self, func, items):
+        """Get a list of the result of calling ``func`` with each item
+        """
+        if len(items) < self.threshold:
+            return _map(func, items)
+
+        chunk_size = -(-len(items) // (self.processes * self.CHUNKS_PER_PROCESS))
+        chunks = [(func, items[start:start + chunk_size]) for start in range(0, len(items), chunk_size)]
+        return list(chain.from_iterable(self._get_pool().map(_map_chunk, chunks, chunksize=1)))
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = _get_pool_context().Pool(self.processes)
+            return self._pool
+
+
+def _get_pool_context():
+    """Get the multiprocessing context used to start conversion worker
+    processes, which does not fork the calling process if possible
+    """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:
+        return multiprocessing
+    try:
+        return get_context('forkserver')
+    except ValueError:
+        return get_context('spawn')
+
+
+class ResourceConversionCache(object):
+    """Cache of converted resources of recently converted datasets
+
+    Converted resources are kept per dataset, keyed by the content of the
+    CKAN resource dict, for up to ``max_datasets`` datasets. Only resources of
+    the last conversion of each dataset are kept. Converted resources are
+    shared with the datapackages they are part of, which must not be
+    modified in place.
+    """
+
+    def __init__(self, max_datasets=50):
+        self.max_datasets = max_datasets
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._datasets = OrderedDict()
+
+    def convert(self, dataset_id, ckan_resources, convert=_map):
+        """Convert the resources of a dataset, reusing cached conversions
+
+        Resources which are not cached are converted with ``convert``, called
+        with :func:`_convert_resource` and the list of those resources.
+
+        Returns a list of (resource, path) tuples, as returned by
+        :func:`_convert_resource`.
+        """
+        with self._lock:
+            cached = self._datasets.pop(dataset_id, {})
+
+        converted = {}
+        missing = OrderedDict()
+        keys = []
+        for ckan_resource in ckan_resources:
+            key = _resource_key(ckan_resource)
+            keys.append(key)
+            if key in converted or key in missing:
+                self.stats.hit()
+            elif key in cached:
+                self.stats.hit()
+                converted[key] = cached[key]
+            else:
+                self.stats.miss()
+                missing[key] = ckan_resource
+
+        converted.update(zip(missing.keys(), convert(_convert_resource, list(missing.values()))))
+        result = [converted[key] for key in keys]
+
+        with self._lock:
+            self._datasets[dataset_id] = converted
+            while len(self._datasets) > self.max_datasets:
+                self._datasets.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._datasets.clear()
+
+
+def _resource_key(ckan_resource):
+    """Get a hashable key equal only for resource dicts with the same content
+    """
+    try:
+        # Types are included as e.g. True == 1, but they are converted differently
+        return frozenset((k, v.__class__, v) for k, v in iteritems(ckan_resource))
+    except TypeError:
+        # Resources with list or dict values
+        return json.dumps(ckan_resource, sort_keys=True)
 
 
 def _get_resource_path(resource):
@@ -102,13 +347,12 @@ def _get_resource_path(resource):
 
 def _add_filename_suffix(original, suffix):
     # type: (str, str) -> str
-    """Add a suffix to a filename
+    """Add a suffix to a filename, before its extension if any
     """
-    parts = original.rsplit('.', 1)
-    filename = '{}{}'.format(parts[0], suffix)
-    if len(parts) > 1:
-        filename += '.{}'.format(parts[1])
-    return filename
+    extension_pos = original.rfind('.')
+    if extension_pos <= original.rfind('/'):
+        return original + suffix
+    return original[:extension_pos] + suffix + original[extension_pos:]
 
 
 def update_ckan_dict(ckan_dict, dataset):
@@ -117,7 +361,7 @@ def update_ckan_dict(ckan_dict, dataset):
     ckan_dict.update(dataset)
     if len(ckan_dict.get('extras', [])) > 0:
         ckan_dict['extras'] = _normalize_extras(ckan_dict)
-    for resource in ckan_dict.get('resources'):
+    for resource in ckan_dict.get('resources', []):
         resource['package_id'] = ckan_dict.get('id')
     return ckan_dict
 
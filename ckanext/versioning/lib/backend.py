@@ -0,0 +1,130 @@
+# encoding: utf-8
+
+'''
+Metastore backend instance management
+'''
+
+import copy
+import logging
+import threading
+from ast import literal_eval
+
+from metastore.backend import create_metastore
+
+from ckanext.versioning.lib.cache import CacheStats
+
+log = logging.getLogger(__name__)
+
+
+def parse_backend_config(raw_config):
+    '''Parse the ``ckanext.versioning.backend_config`` string into a dict
+    '''
+    try:
+        return literal_eval(raw_config)
+    except ValueError:
+        return {}
+
+
+class BackendPool(object):
+    '''Pool of metastore backend instances
+
+    Instances are keyed by (backend_type, raw backend config string) and are
+    kept per thread, as metastore backends wrap HTTP sessions and file system
+    handles which are not guaranteed to be thread safe. When the configuration
+    key changes, backends created for the previous configuration are dropped.
+    '''
+
+    def __init__(self, factory=create_metastore):
+        self._factory = factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.stats = CacheStats()
+
+    def get(self, backend_type, raw_config):
+        '''Get a backend instance for the given type and configuration
+        '''
+        key = (backend_type, raw_config)
+        generation = self._generation
+        local = self._local
+        if getattr(local, 'generation', None) != generation or getattr(local, 'key', None) != key:
+            self.stats.miss()
+            log.debug('Creating metastore backend of type %s', backend_type)
+            local.backend = self._factory(backend_type, parse_backend_config(raw_config))
+            local.key = key
+            local.generation = generation
+        else:
+            self.stats.hit()
+
+        return local.backend
+
+    def invalidate(self):
+        '''Drop all pooled backend instances, in all threads
+
+        Instances are re-created lazily on the next call to :meth:`get`
+        '''
+        with self._lock:
+            self._generation += 1
+
+
+class RequestCachedBackend(object):
+    '''A metastore backend wrapper memoizing read operations
+
+    Results of ``fetch``, ``tag_list``, ``tag_fetch`` and ``revision_list``
+    are stored in ``memo``, a dict which is expected to live only as long as
+    the current request. Any write operation on a package drops memoized
+    results for that package. All other attributes are proxied to the wrapped
+    backend.
+    '''
+
+    def __init__(self, backend, memo):
+        self._backend = backend
+        self._memo = memo
+
+    def __getattr__(self, item):
+        return getattr(self._backend, item)
+
+    def fetch(self, package_id, revision_ref=None):
+        # Package metadata is a mutable dict; never hand out the memoized copy
+        return copy.deepcopy(self._cached('fetch', package_id, revision_ref))
+
+    def tag_list(self, package_id):
+        return list(self._cached('tag_list', package_id))
+
+    def tag_fetch(self, package_id, tag):
+        return self._cached('tag_fetch', package_id, tag)
+
+    def revision_list(self, package_id):
+        return list(self._cached('revision_list', package_id))
+
+    def create(self, package_id, *args, **kwargs):
+        return self._write('create', package_id, *args, **kwargs)
+
+    def update(self, package_id, *args, **kwargs):
+        return self._write('update', package_id, *args, **kwargs)
+
+    def delete(self, package_id):
+        return self._write('delete', package_id)
+
+    def tag_create(self, package_id, *args, **kwargs):
+        return self._write('tag_create', package_id, *args, **kwargs)
+
+    def tag_update(self, package_id, *args, **kwargs):
+        return self._write('tag_update', package_id, *args, **kwargs)
+
+    def tag_delete(self, package_id, *args, **kwargs):
+        return self._write('tag_delete', package_id, *args, **kwargs)
+
+    def _cached(self, method, package_id, *args):
+        package_memo = self._memo.setdefault(package_id, {})
+        key = (method, ) + args
+        try:
+            return package_memo[key]
+        except KeyError:
+            value = getattr(self._backend, method)(package_id, *args)
+            package_memo[key] = value
+            return value
+
+    def _write(self, method, package_id, *args, **kwargs):
+        self._memo.pop(package_id, None)
+        return getattr(self._backend, method)(package_id, *args, **kwargs)
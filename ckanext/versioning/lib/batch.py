@@ -0,0 +1,105 @@
+# encoding: utf-8
+
+'''
+Batch sessions deferring metastore commits during bulk changes
+'''
+
+import logging
+import threading
+from collections import OrderedDict
+
+from ckanext.versioning.lib.commits import CREATE
+
+log = logging.getLogger(__name__)
+
+
+class BatchSession(object):
+    '''Datasets changed while per-change metastore commits are suspended
+
+    Only the first author and operation recorded for each dataset are kept,
+    so a dataset created during the session is committed as created.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changes = OrderedDict()
+
+    def record(self, package_id, operation, author):
+        with self._lock:
+            if package_id not in self._changes:
+                self._changes[package_id] = (operation, author)
+            elif operation == CREATE:
+                self._changes[package_id] = (operation, self._changes[package_id][1])
+
+    def discard(self, package_id):
+        with self._lock:
+            self._changes.pop(package_id, None)
+
+    def changes(self):
+        '''Get a list of (package_id, operation, author) tuples
+        '''
+        with self._lock:
+            return [(package_id, ) + change for package_id, change in self._changes.items()]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._changes)
+
+    def commit(self, convert, commit, pool, chunk_size=100, progress=None):
+        '''Commit one revision per changed dataset
+
+        ``convert`` is called in the calling thread with each recorded
+        (package_id, operation, author), and should return the arguments to
+        call ``commit`` with, or None to skip the dataset. ``commit`` is
+        called in threads of ``pool``, and should return a true value if a
+        revision was created. Datasets are processed in chunks of
+        ``chunk_size``, after each of which ``progress`` is called, if
+        specified, with the number of datasets processed so far and the
+        total number of datasets.
+
+        Returns a summary dict with the number of ``datasets``, how many
+        were ``committed``, ``unchanged`` and ``skipped``, and the IDs of
+        those which ``failed``.
+        '''
+        changes = self.changes()
+        summary = {'datasets': len(changes), 'committed': 0, 'unchanged': 0, 'skipped': 0, 'failed': []}
+
+        for start in range(0, len(changes), chunk_size):
+            chunk = changes[start:start + chunk_size]
+            jobs = []
+            for change in chunk:
+                try:
+                    args = convert(*change)
+                except Exception:
+                    log.exception('Failed preparing dataset %s for commit', change[0])
+                    summary['failed'].append(change[0])
+                    continue
+                if args is None:
+                    summary['skipped'] += 1
+                else:
+                    jobs.append((change[0], args))
+
+            for package_id, outcome in pool.map(lambda job: _try_commit(commit, job), jobs, chunksize=1):
+                if outcome is _FAILED:
+                    summary['failed'].append(package_id)
+                elif outcome:
+                    summary['committed'] += 1
+                else:
+                    summary['unchanged'] += 1
+
+            if progress is not None:
+                progress(start + len(chunk), len(changes))
+
+        return summary
+
+
+_FAILED = object()
+
+
+def _try_commit(commit, job):
+    package_id, args = job
+    try:
+        return package_id, commit(*args)
+    except Exception:
+        log.exception('Failed committing dataset %s', package_id)
+        return package_id, _FAILED
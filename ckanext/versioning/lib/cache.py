@@ -0,0 +1,166 @@
+# encoding: utf-8
+
+'''
+Generic in-process caching primitives used by the versioning extension
+'''
+
+import json
+import threading
+from collections import OrderedDict
+
+
+class CacheStats(object):
+    '''Thread safe hit / miss counters for a cache
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def evict(self, count=1):
+        with self._lock:
+            self.evictions += count
+
+    def reset(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def as_dict(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class LRUCache(object):
+    '''Thread safe LRU cache of JSON serializable values
+
+    The cache is bounded by the total size in bytes of the serialized values
+    it holds, rather than by number of items. Values are stored serialized,
+    so each call to :meth:`get` returns a new copy that callers are free to
+    modify.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._size = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                serialized = self._items.pop(key)
+            except KeyError:
+                serialized = None
+            else:
+                self._items[key] = serialized
+
+        if serialized is None:
+            self.stats.miss()
+            return default
+
+        self.stats.hit()
+        return json.loads(serialized)
+
+    def set(self, key, value):
+        serialized = json.dumps(value)
+        if len(serialized) > self.max_size:
+            return
+
+        evicted = 0
+        with self._lock:
+            self._discard(key)
+            self._items[key] = serialized
+            self._size += len(serialized)
+            while self._size > self.max_size:
+                _, old = self._items.popitem(last=False)
+                self._size -= len(old)
+                evicted += 1
+
+        if evicted:
+            self.stats.evict(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def delete_if(self, predicate):
+        '''Delete all entries with a key matching ``predicate``
+        '''
+        with self._lock:
+            for key in [k for k in self._items if predicate(k)]:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    @property
+    def size(self):
+        '''Total size in bytes of all cached values
+        '''
+        return self._size
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _discard(self, key):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+
+
+class TieredCache(object):
+    '''A two-tier cache, typically a small in-process cache in front of a
+    larger, slower shared cache
+
+    Values found only in the second tier are promoted into the first tier.
+    '''
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def get(self, key, default=None):
+        value = self.first.get(key)
+        if value is None:
+            value = self.second.get(key)
+            if value is None:
+                return default
+            self.first.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.first.set(key, value)
+        self.second.set(key, value)
+
+    def delete(self, key):
+        self.first.delete(key)
+        self.second.delete(key)
+
+    def clear(self):
+        self.first.clear()
+        self.second.clear()
+
+    def __contains__(self, key):
+        return key in self.first or key in self.second
+
+    @property
+    def stats(self):
+        return self.first.stats
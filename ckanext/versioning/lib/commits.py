@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+'''
+Committing datapackages to the metastore backend
+'''
+
+import logging
+
+from ckanext.versioning.datapackage import datapackage_hash
+
+log = logging.getLogger(__name__)
+
+CREATE = 'create'
+UPDATE = 'update'
+
+
+class HeadHashes(object):
+    '''Content hashes of the last revision committed for each dataset
+
+    Hashes are stored along with the revision they were committed as in
+    ``cache``, an :class:`~ckanext.versioning.lib.cache.LRUCache`-like
+    object. Since other processes may have committed to the same dataset
+    since, a stored hash is only trusted if that revision is still the
+    latest one. This is checked with the list of revisions of the dataset,
+    which is much cheaper to get than the datapackage itself, and is
+    memoized by request cached backends.
+
+    Hashes are only kept in memory, so the first update of each dataset
+    after a restart is always committed.
+    '''
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def is_unchanged(self, backend, dataset, content_hash):
+        '''Tell whether the latest revision of a dataset has the given hash
+        '''
+        head = self._cache.get(dataset)
+        if head is None or head['hash'] != content_hash:
+            return False
+        revisions = backend.revision_list(dataset)
+        return bool(revisions) and revisions[0].revision == head['revision']
+
+    def set(self, dataset, revision, content_hash):
+        self._cache.set(dataset, {'revision': revision, 'hash': content_hash})
+
+    def delete(self, dataset):
+        self._cache.delete(dataset)
+
+
+def commit_datapackage(backend, dataset, operation, datapackage, author, head_hashes=None, message=None):
+    '''Commit a datapackage to the metastore backend
+
+    ``operation`` is either :data:`CREATE` or :data:`UPDATE`. ``message``
+    overrides the backend's default commit message. If
+    ``head_hashes`` is specified, updates which would not change the content
+    of the latest revision of the dataset are skipped, and None is returned.
+    Otherwise, the ``PackageInfo`` of the new revision is returned.
+    '''
+    content_hash = datapackage_hash(datapackage)
+    if operation == CREATE:
+        pkg_info = backend.create(dataset, datapackage, author=author, message=message)
+    elif head_hashes is not None and head_hashes.is_unchanged(backend, dataset, content_hash):
+        log.debug('Package %s is unchanged, not creating a new revision', dataset)
+        return None
+    else:
+        pkg_info = backend.update(dataset, datapackage, author=author, message=message)
+
+    if head_hashes is not None:
+        head_hashes.set(dataset, pkg_info.revision, content_hash)
+    return pkg_info
@@ -0,0 +1,168 @@
+# encoding: utf-8
+
+'''
+On-disk cache shared by all processes of a CKAN deployment on the same node
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ckanext.versioning.lib.cache import CacheStats
+
+log = logging.getLogger(__name__)
+
+# Only update the last access time of an entry if it is older than this many
+# seconds, so that reads do not turn into writes (and lock the database) on
+# every cache hit
+ACCESS_TIME_RESOLUTION = 300
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+'''
+
+
+class SQLiteCache(object):
+    '''A size capped cache of JSON serializable values stored in SQLite
+
+    The database is opened in WAL mode, so any number of processes can read
+    from the cache concurrently with a single writer. When the total size of
+    stored values exceeds ``max_size`` bytes, least recently accessed entries
+    are evicted.
+
+    Errors accessing the database are logged and handled as cache misses; a
+    broken cache should never break the read path it sits behind.
+    '''
+
+    def __init__(self, path, max_size, timeout=5.0):
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.stats = CacheStats()
+        self._local = threading.local()
+
+    def get(self, key, default=None):
+        db_key = _serialize_key(key)
+        try:
+            conn = self._connection()
+            row = conn.execute('SELECT value, accessed FROM entries WHERE key = ?', (db_key, )).fetchone()
+            if row is not None and row[1] < time.time() - ACCESS_TIME_RESOLUTION:
+                self._touch(conn, db_key)
+        except (sqlite3.Error, OSError) as e:
+            log.warning('Failed reading from revision cache %s: %s', self.path, e)
+            row = None
+
+        if row is None:
+            self.stats.miss()
+            return default
+
+        self.stats.hit()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        serialized = json.dumps(value)
+        if len(serialized) > self.max_size:
+            return
+
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                             (_serialize_key(key), serialized, len(serialized), time.time()))
+                self._evict(conn)
+        except (sqlite3.Error, OSError) as e:
+            log.warning('Failed writing to revision cache %s: %s', self.path, e)
+
+    def delete(self, key):
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM entries WHERE key = ?', (_serialize_key(key), ))
+        except (sqlite3.Error, OSError) as e:
+            log.warning('Failed deleting from revision cache %s: %s', self.path, e)
+
+    def clear(self):
+        try:
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM entries')
+        except (sqlite3.Error, OSError) as e:
+            log.warning('Failed clearing revision cache %s: %s', self.path, e)
+
+    @property
+    def size(self):
+        '''Total size in bytes of all cached values
+        '''
+        return self._connection().execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def __contains__(self, key):
+        row = self._connection().execute('SELECT 1 FROM entries WHERE key = ?', (_serialize_key(key), )).fetchone()
+        return row is not None
+
+    def _connection(self):
+        '''Get a database connection for the current thread and process
+        '''
+        # Connections must not be shared with forked worker processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            ensure_dir(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _touch(self, conn, db_key):
+        try:
+            with conn:
+                conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), db_key))
+        except sqlite3.OperationalError as e:
+            # Most likely the database is locked by a writer; it's ok to skip
+            log.debug('Failed to update access time in revision cache: %s', e)
+
+    def _evict(self, conn):
+        excess = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+
+        evict = []
+        for db_key, size in conn.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            evict.append((db_key, ))
+            excess -= size
+            if excess <= 0:
+                break
+
+        conn.executemany('DELETE FROM entries WHERE key = ?', evict)
+        self.stats.evict(len(evict))
+
+
+def ensure_dir(directory):
+    '''Create a directory, if it does not exist
+    '''
+    if not directory:
+        return
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # Another process may have created it concurrently
+        if not os.path.isdir(directory):
+            raise
+
+
+def _serialize_key(key):
+    if isinstance(key, tuple):
+        key = list(key)
+    return json.dumps(key)
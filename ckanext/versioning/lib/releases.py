@@ -0,0 +1,311 @@
+# encoding: utf-8
+
+'''
+In-process caching of dataset release information
+'''
+
+import logging
+import threading
+import time
+
+from ckanext.versioning.lib.cache import CacheStats
+
+log = logging.getLogger(__name__)
+
+# Returned by ReleaseCache.get() for names known not to exist
+NOT_FOUND = object()
+
+
+class ReleaseRecord(object):
+    '''Compact in-memory representation of a release dict
+    '''
+    __slots__ = ('package_id', 'name', 'created', 'revision_ref', 'author', 'author_email', 'description')
+
+    def __init__(self, package_id, name, created, revision_ref, author=None, author_email=None,
+                 description=None):
+        self.package_id = package_id
+        self.name = name
+        self.created = created
+        self.revision_ref = revision_ref
+        self.author = author
+        self.author_email = author_email
+        self.description = description
+
+    @classmethod
+    def from_dict(cls, release):
+        return cls(**{k: release.get(k) for k in cls.__slots__})
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class _ReleaseList(object):
+    '''A cached list of releases of a dataset, indexed by revision
+    '''
+    __slots__ = ('records', 'by_revision', 'loaded_at')
+
+    def __init__(self, records, loaded_at):
+        self.records = records
+        self.loaded_at = loaded_at
+        self.by_revision = {}
+        for record in records:
+            # If more than one release points to the same revision, the oldest one wins
+            self.by_revision.setdefault(record.revision_ref, record)
+
+    def add(self, record):
+        '''Add a record, keeping records ordered by creation time
+        '''
+        position = len(self.records)
+        while position > 0 and self.records[position - 1].created > record.created:
+            position -= 1
+        self.records.insert(position, record)
+
+        indexed = self.by_revision.get(record.revision_ref)
+        if indexed is None or indexed.created > record.created:
+            self.by_revision[record.revision_ref] = record
+
+    def remove(self, name):
+        removed = [r for r in self.records if r.name == name]
+        if not removed:
+            return
+        self.records = [r for r in self.records if r.name != name]
+
+        for record in removed:
+            if self.by_revision.get(record.revision_ref) is not record:
+                continue
+            # Fall back to the next oldest release pointing to the same revision, if any
+            replacement = next((r for r in self.records if r.revision_ref == record.revision_ref), None)
+            if replacement is None:
+                del self.by_revision[record.revision_ref]
+            else:
+                self.by_revision[record.revision_ref] = replacement
+
+
+class ReleaseCache(object):
+    '''Cache of release dicts by dataset name and release name
+
+    Releases are mutable (they can be renamed, moved or deleted), so entries
+    are expected to be explicitly updated or invalidated by the code
+    modifying releases. Entries also expire after ``ttl`` seconds, to bound
+    staleness when releases are modified by another process.
+
+    Names of releases that do not exist are cached separately, for
+    ``negative_ttl`` seconds.
+
+    The full list of releases of each dataset is cached as well, along with
+    an index of releases by revision. A list is fresh for ``list_ttl``
+    seconds; After that, it can still be served for up to ``list_stale_ttl``
+    seconds while it is being reloaded in the background (see
+    :meth:`refresh_list`).
+
+    Releases are stored internally as :class:`ReleaseRecord` objects, and
+    handed out as new dicts.
+    '''
+
+    def __init__(self, ttl=300, negative_ttl=10, list_ttl=60, list_stale_ttl=3600, clock=time.time):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.list_ttl = list_ttl
+        self.list_stale_ttl = list_stale_ttl
+        self.stats = CacheStats()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._datasets = {}
+        self._lists = {}
+        self._generations = {}
+        self._refreshing = set()
+
+    def get(self, dataset, name):
+        '''Get a release by name
+
+        Returns a copy of the cached release dict, :data:`NOT_FOUND` if the
+        release is known not to exist, or None if nothing is cached.
+        '''
+        with self._lock:
+            entry = self._datasets.get(dataset, {}).get(name)
+
+        if entry is None or entry[1] < self._clock():
+            self.stats.miss()
+            return None
+
+        self.stats.hit()
+        if entry[0] is NOT_FOUND:
+            return NOT_FOUND
+        return entry[0].to_dict()
+
+    def set(self, dataset, release):
+        '''Cache a release dict
+        '''
+        record = ReleaseRecord.from_dict(release)
+        with self._lock:
+            releases = self._datasets.setdefault(dataset, {})
+            releases[record.name] = (record, self._clock() + self.ttl)
+
+    def set_not_found(self, dataset, name):
+        '''Remember that a release does not exist
+        '''
+        with self._lock:
+            releases = self._datasets.setdefault(dataset, {})
+            releases[name] = (NOT_FOUND, self._clock() + self.negative_ttl)
+
+    def delete(self, dataset, name):
+        '''Forget a release
+        '''
+        with self._lock:
+            self._datasets.get(dataset, {}).pop(name, None)
+
+    def get_list(self, dataset):
+        '''Get the list of releases of a dataset
+
+        Returns a tuple of (releases, fresh). ``releases`` is None if the list
+        is not cached or is too old to be served at all.
+        '''
+        with self._lock:
+            entry, fresh = self._get_list_entry(dataset)
+            records = None if entry is None else list(entry.records)
+
+        if records is None:
+            return None, False
+        return [r.to_dict() for r in records], fresh
+
+    def get_by_revision(self, dataset, revision_ref):
+        '''Get the release pointing to a revision
+
+        This uses the cached list of releases of the dataset, and follows
+        the same freshness rules as :meth:`get_list`. Returns a tuple of
+        (release, fresh), where ``release`` is a release dict,
+        :data:`NOT_FOUND` if no release points to the revision, or None if
+        the list of releases is not cached or is too old to be served.
+        '''
+        with self._lock:
+            entry, fresh = self._get_list_entry(dataset)
+            if entry is None:
+                return None, False
+            record = entry.by_revision.get(revision_ref)
+
+        if record is None:
+            return NOT_FOUND, fresh
+        return record.to_dict(), fresh
+
+    def set_list(self, dataset, releases, generation=None):
+        '''Cache the list of releases of a dataset
+
+        If ``generation`` is specified and the dataset's releases were
+        invalidated since it was obtained from :meth:`generation`, the list
+        is considered outdated and is not cached.
+        '''
+        records = [ReleaseRecord.from_dict(r) for r in releases]
+        now = self._clock()
+        with self._lock:
+            if generation is not None and generation != self._generations.get(dataset, 0):
+                return
+            self._lists[dataset] = _ReleaseList(records, now)
+            names = self._datasets.setdefault(dataset, {})
+            for record in records:
+                names[record.name] = (record, now + self.ttl)
+
+    def generation(self, dataset):
+        '''Get a number that changes every time the releases of a dataset
+        are invalidated
+        '''
+        with self._lock:
+            return self._generations.get(dataset, 0)
+
+    def refresh_list(self, dataset, loader):
+        '''Reload the list of releases of a dataset in a background thread
+
+        ``loader`` is called with the dataset name and should return the
+        list of releases. Only one refresh per dataset runs at any time;
+        if a refresh is already in progress, this is a no-op.
+        '''
+        with self._lock:
+            if dataset in self._refreshing:
+                return
+            self._refreshing.add(dataset)
+            generation = self._generations.get(dataset, 0)
+
+        thread = threading.Thread(target=self._refresh_list, args=(dataset, loader, generation),
+                                  name='release-list-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def release_created(self, dataset, release):
+        '''Update the cache after a release was created
+        '''
+        self.release_updated(dataset, None, release)
+
+    def release_updated(self, dataset, old_name, release):
+        '''Update the cache after a release was modified (and possibly renamed)
+        '''
+        record = ReleaseRecord.from_dict(release)
+        with self._lock:
+            names = self._datasets.setdefault(dataset, {})
+            if old_name is not None:
+                names.pop(old_name, None)
+            names[record.name] = (record, self._clock() + self.ttl)
+
+            release_list = self._lists.get(dataset)
+            if release_list is not None:
+                if old_name is not None:
+                    release_list.remove(old_name)
+                release_list.add(record)
+            self._bump_generation(dataset)
+
+    def release_deleted(self, dataset, name):
+        '''Update the cache after a release was deleted
+        '''
+        with self._lock:
+            self._datasets.get(dataset, {}).pop(name, None)
+            release_list = self._lists.get(dataset)
+            if release_list is not None:
+                release_list.remove(name)
+            self._bump_generation(dataset)
+
+    def invalidate_list(self, dataset):
+        '''Forget the cached list of releases of a dataset
+        '''
+        with self._lock:
+            self._lists.pop(dataset, None)
+            self._bump_generation(dataset)
+
+    def invalidate(self, dataset):
+        '''Forget all releases of a dataset
+        '''
+        with self._lock:
+            self._datasets.pop(dataset, None)
+            self._lists.pop(dataset, None)
+            self._bump_generation(dataset)
+
+    def clear(self):
+        with self._lock:
+            self._datasets.clear()
+            self._lists.clear()
+            self._generations.clear()
+
+    def _get_list_entry(self, dataset):
+        # Must be called with the lock held
+        entry = self._lists.get(dataset)
+        if entry is None:
+            self.stats.miss()
+            return None, False
+
+        age = self._clock() - entry.loaded_at
+        if age > self.list_ttl + self.list_stale_ttl:
+            self.stats.miss()
+            return None, False
+
+        self.stats.hit()
+        return entry, age <= self.list_ttl
+
+    def _bump_generation(self, dataset):
+        self._generations[dataset] = self._generations.get(dataset, 0) + 1
+
+    def _refresh_list(self, dataset, loader, generation):
+        try:
+            self.set_list(dataset, loader(dataset), generation=generation)
+        except Exception:
+            log.exception('Failed refreshing list of releases for dataset %s', dataset)
+            self.invalidate_list(dataset)
+        finally:
+            with self._lock:
+                self._refreshing.discard(dataset)
@@ -0,0 +1,497 @@
+# encoding: utf-8
+
+'''
+Write-behind queue for committing datapackages to the metastore backend
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from metastore.types import Author
+
+from ckanext.versioning.lib.commits import UPDATE, commit_datapackage
+from ckanext.versioning.lib.disk_cache import ensure_dir
+
+log = logging.getLogger(__name__)
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dataset TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    datapackage TEXT NOT NULL,
+    author_name TEXT,
+    author_email TEXT,
+    co_authors TEXT NOT NULL DEFAULT '[]',
+    queued_at REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    claimed_until REAL,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_dataset ON jobs (dataset, failed, id);
+'''
+
+
+class WriteJob(object):
+    '''A queued datapackage commit
+    '''
+    __slots__ = ('id', 'dataset', 'operation', 'datapackage', 'author_name', 'author_email', 'co_authors',
+                 'attempts')
+
+    def __init__(self, id, dataset, operation, datapackage, author_name=None, author_email=None, co_authors=(),
+                 attempts=0):
+        self.id = id
+        self.dataset = dataset
+        self.operation = operation
+        self.datapackage = datapackage
+        self.author_name = author_name
+        self.author_email = author_email
+        # (name, email) pairs of other authors of changes merged into this job
+        self.co_authors = [tuple(a) for a in co_authors]
+        self.attempts = attempts
+
+
+class MemoryWriteQueue(object):
+    '''In-process, non-durable stand-in for :class:`SQLiteWriteQueue`
+
+    Jobs are lost when the process exits; This is meant for tests and
+    development setups.
+    '''
+
+    def __init__(self, claim_timeout=300, clock=time.time):
+        self.claim_timeout = claim_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._next_id = 1
+
+    def put(self, dataset, operation, datapackage, author_name=None, author_email=None, delay=0,
+            max_delay=None):
+        '''Queue a job, or merge it into a pending one
+
+        See :meth:`SQLiteWriteQueue.put`.
+        '''
+        now = self._clock()
+        with self._lock:
+            if delay and operation == UPDATE:
+                pending = [j for j in self._jobs if j['dataset'] == dataset and not j['failed']]
+                if pending and pending[-1]['claimed_until'] is None:
+                    job = pending[-1]
+                    job['datapackage'] = json.dumps(datapackage)
+                    job['co_authors'] = json.dumps(_add_co_author(job, author_name, author_email))
+                    job['not_before'] = _coalesced_not_before(job, now, delay, max_delay)
+                    return job['id']
+
+            job_id = self._next_id
+            self._next_id += 1
+            self._jobs.append({'id': job_id,
+                               'dataset': dataset,
+                               'operation': operation,
+                               'datapackage': json.dumps(datapackage),
+                               'author_name': author_name,
+                               'author_email': author_email,
+                               'co_authors': '[]',
+                               'queued_at': now,
+                               'attempts': 0,
+                               'not_before': now + delay if delay else 0,
+                               'claimed_until': None,
+                               'failed': False})
+        return job_id
+
+    def claim(self, dataset=None, ignore_delay=False):
+        '''Claim the next job which can be processed, if any
+
+        Only the oldest pending job of each dataset can be claimed, so that
+        jobs of a dataset are processed in order. Jobs scheduled to be
+        retried later are skipped, unless ``ignore_delay`` is set.
+        '''
+        now = self._clock()
+        seen = set()
+        with self._lock:
+            for job in self._jobs:
+                if job['failed'] or job['dataset'] in seen:
+                    continue
+                seen.add(job['dataset'])
+                if dataset is not None and job['dataset'] != dataset:
+                    continue
+                if (job['not_before'] > now and not ignore_delay) or (job['claimed_until'] or 0) >= now:
+                    continue
+                job['claimed_until'] = now + self.claim_timeout
+                return _job_from_row(job)
+        return None
+
+    def complete(self, job_id):
+        with self._lock:
+            self._jobs = [j for j in self._jobs if j['id'] != job_id]
+
+    def retry(self, job_id, delay):
+        with self._lock:
+            for job in self._jobs:
+                if job['id'] == job_id:
+                    job['attempts'] += 1
+                    job['not_before'] = self._clock() + delay
+                    job['claimed_until'] = None
+
+    def fail(self, job_id):
+        with self._lock:
+            for job in self._jobs:
+                if job['id'] == job_id:
+                    job['attempts'] += 1
+                    job['claimed_until'] = None
+                    job['failed'] = True
+
+    def discard(self, dataset):
+        with self._lock:
+            self._jobs = [j for j in self._jobs if j['dataset'] != dataset]
+
+    def pending(self, dataset=None):
+        '''Get the number of jobs not yet processed, optionally of a dataset
+        '''
+        with self._lock:
+            return len([j for j in self._jobs
+                        if not j['failed'] and (dataset is None or j['dataset'] == dataset)])
+
+
+class SQLiteWriteQueue(object):
+    '''A durable queue of datapackage commits, stored in SQLite
+
+    The queue can be shared by all CKAN processes on the same server. A
+    claimed job is not handed out again for ``claim_timeout`` seconds, after
+    which it is assumed the process handling it died.
+    '''
+
+    def __init__(self, path, claim_timeout=300, timeout=30.0, clock=time.time):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self.timeout = timeout
+        self._clock = clock
+        self._local = threading.local()
+
+    def put(self, dataset, operation, datapackage, author_name=None, author_email=None, delay=0,
+            max_delay=None):
+        '''Queue a job, or merge it into a pending one
+
+        A job queued with a ``delay`` is not processed before that many
+        seconds passed. If it is an update, and the last pending job of the
+        dataset is not being processed yet, the update is merged into that
+        job instead: its datapackage is replaced, the author is recorded as a
+        co-author, and it is delayed again, but not to more than
+        ``max_delay`` seconds after it was first queued.
+
+        Returns the ID of the new or merged job.
+        '''
+        now = self._clock()
+        with self._transaction() as conn:
+            if delay and operation == UPDATE:
+                row = conn.execute(
+                    'SELECT id, author_name, author_email, co_authors, queued_at, not_before, claimed_until '
+                    'FROM jobs WHERE dataset = ? AND failed = 0 ORDER BY id DESC LIMIT 1', (dataset, )).fetchone()
+                if row is not None and row[6] is None:
+                    job = dict(zip(('id', 'author_name', 'author_email', 'co_authors', 'queued_at', 'not_before'),
+                                   row))
+                    conn.execute('UPDATE jobs SET datapackage = ?, co_authors = ?, not_before = ? WHERE id = ?',
+                                 (json.dumps(datapackage),
+                                  json.dumps(_add_co_author(job, author_name, author_email)),
+                                  _coalesced_not_before(job, now, delay, max_delay),
+                                  job['id']))
+                    return job['id']
+
+            cursor = conn.execute(
+                'INSERT INTO jobs (dataset, operation, datapackage, author_name, author_email, queued_at, not_before) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (dataset, operation, json.dumps(datapackage), author_name, author_email, now,
+                 now + delay if delay else 0))
+            return cursor.lastrowid
+
+    def claim(self, dataset=None, ignore_delay=False):
+        '''Claim the next job which can be processed, if any
+
+        Only the oldest pending job of each dataset can be claimed, so that
+        jobs of a dataset are processed in order. Jobs scheduled to be
+        retried later are skipped, unless ``ignore_delay`` is set.
+        '''
+        now = self._clock()
+        query = ('SELECT id, dataset, operation, datapackage, author_name, author_email, co_authors, attempts '
+                 'FROM jobs j '
+                 'WHERE failed = 0 AND not_before <= ? AND (claimed_until IS NULL OR claimed_until < ?) '
+                 'AND id = (SELECT MIN(id) FROM jobs WHERE dataset = j.dataset AND failed = 0) ')
+        params = [float('inf') if ignore_delay else now, now]
+        if dataset is not None:
+            query += 'AND dataset = ? '
+            params.append(dataset)
+        query += 'ORDER BY id LIMIT 1'
+
+        with self._transaction() as conn:
+            row = conn.execute(query, params).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE jobs SET claimed_until = ? WHERE id = ?', (now + self.claim_timeout, row[0]))
+
+        return _job_from_row(dict(zip(('id', 'dataset', 'operation', 'datapackage', 'author_name',
+                                       'author_email', 'co_authors', 'attempts'), row)))
+
+    def complete(self, job_id):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id, ))
+
+    def retry(self, job_id, delay):
+        with self._transaction() as conn:
+            conn.execute('UPDATE jobs SET attempts = attempts + 1, not_before = ?, claimed_until = NULL '
+                         'WHERE id = ?', (self._clock() + delay, job_id))
+
+    def fail(self, job_id):
+        with self._transaction() as conn:
+            conn.execute('UPDATE jobs SET attempts = attempts + 1, claimed_until = NULL, failed = 1 '
+                         'WHERE id = ?', (job_id, ))
+
+    def discard(self, dataset):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM jobs WHERE dataset = ?', (dataset, ))
+
+    def pending(self, dataset=None):
+        '''Get the number of jobs not yet processed, optionally of a dataset
+        '''
+        if dataset is None:
+            row = self._connection().execute('SELECT COUNT(*) FROM jobs WHERE failed = 0').fetchone()
+        else:
+            row = self._connection().execute('SELECT COUNT(*) FROM jobs WHERE failed = 0 AND dataset = ?',
+                                             (dataset, )).fetchone()
+        return row[0]
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    def _connection(self):
+        '''Get a database connection for the current thread and process
+        '''
+        # Connections must not be shared with forked worker processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            ensure_dir(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+
+class _Transaction(object):
+    '''An immediate (write locking) SQLite transaction context manager
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
+
+
+class WriteBehindQueue(object):
+    '''Commits datapackages to the metastore backend in a background thread
+
+    Jobs of each dataset are committed in the order they were queued. Failed
+    commits are retried with exponential backoff, starting at
+    ``retry_delay`` seconds and up to ``max_retry_delay`` seconds, until
+    ``max_attempts`` attempts were made; The job is then marked as failed
+    and left in the queue for inspection.
+
+    ``get_backend`` is called from the worker thread to get a metastore
+    backend instance. If ``head_hashes`` is specified, jobs which would not
+    change the dataset are completed without committing (see
+    :func:`~ckanext.versioning.lib.commits.commit_datapackage`).
+
+    If ``coalesce_window`` is set, jobs are committed only after that many
+    seconds without further updates to the dataset, and updates queued in the
+    meantime are merged into a single commit of the final state, up to
+    ``max_coalesce_delay`` seconds (by default, 10 times the window) after
+    the first one. Authors of merged updates are credited in the commit
+    message.
+    '''
+
+    def __init__(self, queue, get_backend, max_attempts=10, retry_delay=5, max_retry_delay=600,
+                 poll_interval=5, head_hashes=None, coalesce_window=0, max_coalesce_delay=None):
+        self.queue = queue
+        self.head_hashes = head_hashes
+        self.coalesce_window = coalesce_window
+        self.max_coalesce_delay = coalesce_window * 10 if max_coalesce_delay is None else max_coalesce_delay
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self._get_backend = get_backend
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._worker = None
+        self._worker_pid = None
+        self._resumed_pid = None
+
+    def enqueue(self, dataset, operation, datapackage, author):
+        '''Queue a datapackage to be committed to the backend
+
+        ``operation`` is either :data:`~ckanext.versioning.lib.commits.CREATE` or
+        :data:`~ckanext.versioning.lib.commits.UPDATE`.
+        '''
+        job_id = self.queue.put(dataset, operation, datapackage, author.name, author.email,
+                                delay=self.coalesce_window, max_delay=self.max_coalesce_delay)
+        log.debug('Queued %s of package %s as job %d', operation, dataset, job_id)
+        self.ensure_started()
+        self._wakeup.set()
+        return job_id
+
+    def flush(self, dataset, timeout=30):
+        '''Commit all pending jobs of a dataset in the current thread
+
+        Jobs waiting to be retried are retried immediately. If jobs of the
+        dataset are being processed by another thread or process, wait for
+        them for up to ``timeout`` seconds. Returns True if all jobs were
+        committed, or False if a job failed or the timeout expired.
+        '''
+        deadline = time.time() + timeout
+        while self.queue.pending(dataset):
+            job = self.queue.claim(dataset, ignore_delay=True)
+            if job is None:
+                if time.time() > deadline:
+                    return False
+                time.sleep(0.1)
+                continue
+            if not self._process(job):
+                return False
+        return True
+
+    def discard(self, dataset):
+        '''Drop all pending jobs of a dataset
+        '''
+        self.queue.discard(dataset)
+
+    def process_next(self):
+        '''Process the next job which can be processed, if any
+
+        Returns False if there was no job to process.
+        '''
+        job = self.queue.claim()
+        if job is None:
+            return False
+        self._process(job)
+        return True
+
+    def ensure_started(self):
+        '''Start the worker thread of the current process, if not running
+        '''
+        with self._lock:
+            # Threads do not survive forking worker processes
+            if self._worker_pid == os.getpid() and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, name='metastore-write-behind')
+            self._worker.daemon = True
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def resume(self):
+        '''Start the worker thread of the current process if jobs are pending,
+        e.g. left by a process which exited before committing them
+
+        The queue is only checked once per process.
+        '''
+        with self._lock:
+            if self._resumed_pid == os.getpid():
+                return
+            self._resumed_pid = os.getpid()
+
+        try:
+            pending = self.queue.pending()
+        except Exception:
+            log.exception('Failed reading from the metastore write queue')
+            return
+        if pending:
+            log.info('Resuming %d pending metastore writes', pending)
+            self.ensure_started()
+
+    def close(self):
+        '''Stop the worker thread
+        '''
+        self._closed.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                if self.process_next():
+                    continue
+            except Exception:
+                log.exception('Failed reading from the metastore write queue')
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _process(self, job):
+        '''Commit a claimed job; Returns True if it was committed
+        '''
+        try:
+            pkg_info = self._commit(job)
+        except Exception:
+            attempts = job.attempts + 1
+            if attempts >= self.max_attempts:
+                log.exception('Failed to %s package %s in metastore after %d attempts; giving up on job %d',
+                              job.operation, job.dataset, attempts, job.id)
+                self.queue.fail(job.id)
+            else:
+                delay = min(self.retry_delay * 2 ** job.attempts, self.max_retry_delay)
+                log.warning('Failed to %s package %s in metastore (attempt %d), retrying in %d seconds',
+                            job.operation, job.dataset, attempts, delay, exc_info=True)
+                self.queue.retry(job.id, delay)
+            return False
+
+        self.queue.complete(job.id)
+        if pkg_info is not None:
+            log.info('Package %s written to metastore. Revision %s created.', pkg_info.package_id, pkg_info.revision)
+        return True
+
+    def _commit(self, job):
+        return commit_datapackage(self._get_backend(), job.dataset, job.operation, job.datapackage,
+                                  Author(job.author_name, job.author_email), self.head_hashes,
+                                  message=_commit_message(job))
+
+
+def _job_from_row(row):
+    return WriteJob(row['id'], row['dataset'], row['operation'], json.loads(row['datapackage']),
+                    row['author_name'], row['author_email'], json.loads(row['co_authors']), row['attempts'])
+
+
+def _commit_message(job):
+    '''Get the commit message for a job crediting co-authors, if any
+    '''
+    if not job.co_authors:
+        return None
+    trailers = ['Co-authored-by: {} <{}>'.format(name, email or '') for name, email in job.co_authors]
+    return '{} {}\n\n{}'.format(job.operation.capitalize(), job.dataset, '\n'.join(trailers))
+
+
+def _add_co_author(job, author_name, author_email):
+    '''Get the co-authors of a job, with another author added if new
+    '''
+    co_authors = json.loads(job['co_authors'])
+    author = [author_name, author_email]
+    if author != [job['author_name'], job['author_email']] and author not in co_authors:
+        co_authors.append(author)
+    return co_authors
+
+
+def _coalesced_not_before(job, now, delay, max_delay):
+    '''Get the time a job can be processed at after merging another job into it
+    '''
+    not_before = now + delay
+    if max_delay is not None:
+        not_before = min(not_before, job['queued_at'] + max_delay)
+    # Do not cut short a delay before retrying
+    return max(not_before, job['not_before'])
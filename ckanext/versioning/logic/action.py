@@ -1,19 +1,39 @@
 # encoding: utf-8
+import copy
 import difflib
+import functools
+import hashlib
 import json
 import logging
 import re
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from ckan import model as core_model
+from ckan import plugins
 from ckan.common import request
+from ckan.lib.dictization import model_dictize, table_dictize
 from ckan.logic.action.get import package_show as core_package_show
 from ckan.logic.action.get import resource_show as core_resource_show
 from ckan.plugins import toolkit
+from dateutil import parser as date_parser
+from dateutil import tz
 from metastore.backend import exc
+from six import string_types
 from six.moves.urllib import parse
-
-from ckanext.versioning.common import create_author_from_context, exception_mapper, get_metastore_backend, tag_to_dict
-from ckanext.versioning.datapackage import frictionless_to_dataset, update_ckan_dict
+from sqlalchemy import or_
+
+from ckanext.versioning.common import (DEFAULT_BATCH_COMMIT_THREADS, DEFAULT_MAX_DATASETS_PER_CALL,
+                                       DEFAULT_MAX_REVISIONS_PER_CALL, create_author_from_context, exception_mapper,
+                                       get_batch_session, get_excluded_fields, get_fetch_pool, get_fragment_cache,
+                                       get_head_hashes, get_metastore_backend, get_parallel_converter,
+                                       get_release_cache, get_resource_conversion_cache, get_revision_cache,
+                                       get_thread_backend_getter, get_write_queue, invalidate_request_reads,
+                                       tag_to_dict)
+from ckanext.versioning.datapackage import (dataset_to_frictionless, datapackage_hash, frictionless_to_dataset,
+                                            frictionless_to_resource, prepare_dataset, update_ckan_dict)
+from ckanext.versioning.lib import commits
+from ckanext.versioning.lib.releases import NOT_FOUND
 from ckanext.versioning.logic import helpers as h
 
 log = logging.getLogger(__name__)
@@ -42,9 +62,11 @@ def dataset_release_update(context, data_dict):
 
     backend = get_metastore_backend()
     author = create_author_from_context(context)
+    dataset_name = _get_dataset_name(dataset_name_or_id)
+    release_cache = get_release_cache()
     try:
         release_info = backend.tag_update(
-                _get_dataset_name(dataset_name_or_id),
+                dataset_name,
                 release,
                 new_name=name,
                 new_description=data_dict.get('description', None),
@@ -55,7 +77,9 @@ def dataset_release_update(context, data_dict):
 
     log.info('Release "%s" with id %s modified successfully', name, release)
 
-    return tag_to_dict(release_info)
+    release_dict = tag_to_dict(release_info)
+    release_cache.release_updated(dataset_name, release, release_dict)
+    return release_dict
 
 
 def dataset_release_create(context, data_dict):
@@ -83,6 +107,9 @@ def dataset_release_create(context, data_dict):
     toolkit.check_access('dataset_release_create', context, data_dict)
     assert context.get('auth_user_obj')  # Should be here after `check_access`
 
+    # The release must point to the latest revision, including queued changes
+    _flush_pending_writes(dataset.name)
+
     # TODO: Names like 'Version 1.2' are not allowed as Github tags
     backend = get_metastore_backend()
     author = create_author_from_context(context)
@@ -102,7 +129,9 @@ def dataset_release_create(context, data_dict):
 
     log.info('Release "%s" created for package %s', name, dataset.id)
 
-    return tag_to_dict(release_info)
+    release_dict = tag_to_dict(release_info)
+    get_release_cache().release_created(dataset.name, release_dict)
+    return release_dict
 
 
 def dataset_revert(context, data_dict):
@@ -136,23 +165,89 @@ def dataset_revert(context, data_dict):
 def dataset_release_list(context, data_dict):
     """List releases of a given dataset
 
+    Releases are listed from oldest to newest.
+
     :param dataset: the id or name of the dataset
     :type dataset: string
+    :param limit: maximal number of releases to return (optional)
+    :type limit: int
+    :param offset: number of releases to skip (optional)
+    :type offset: int
+    :param since: only list releases created at or after this ISO 8601
+                  date / time (optional)
+    :type since: string
     :returns: list of matched releases
     :rtype: list
     """
     model = context.get('model', core_model)
     dataset_id_or_name = toolkit.get_or_bust(data_dict, ['dataset'])
+    limit = _get_int_param(data_dict, 'limit')
+    offset = _get_int_param(data_dict, 'offset') or 0
+    since = _get_datetime_param(data_dict, 'since')
+
     dataset = model.Package.get(dataset_id_or_name)
     if not dataset:
         raise toolkit.ObjectNotFound('Dataset not found')
 
-    backend = get_metastore_backend()
+    release_list = _get_release_list(dataset.name)
 
-    with exception_mapper(exc.NotFound, toolkit.ObjectNotFound):
-        release_list = backend.tag_list(dataset.name)
+    if since is not None:
+        release_list = [r for r in release_list if _parse_datetime(r['created']) >= since]
+    if limit is not None:
+        return release_list[offset:offset + limit]
+    return release_list[offset:]
 
-    return [tag_to_dict(t) for t in release_list]
+
+@toolkit.side_effect_free
+def dataset_release_list_batch(context, data_dict):
+    """List releases of many datasets in one call
+
+    Releases of datasets which are not in the release cache are loaded from
+    the backend concurrently. Datasets not found in the backend have no
+    releases.
+
+    :param datasets: the ids or names of the datasets; a string is split on
+                     commas
+    :type datasets: list of strings
+    :param summary: if true, return only the number of releases and the name
+                    and creation time of the latest release of each dataset
+                    (optional, default: false)
+    :type summary: bool
+    :returns: a dict mapping each requested dataset id or name to its list of
+              releases (oldest to newest), or to its release summary
+    :rtype: dict
+    """
+    model = context.get('model', core_model)
+    datasets = _get_list_param(data_dict, 'datasets')
+    if not datasets:
+        raise toolkit.ValidationError({'datasets': ['Missing value']})
+
+    max_datasets = toolkit.asint(toolkit.config.get('ckanext.versioning.max_datasets_per_call',
+                                                    DEFAULT_MAX_DATASETS_PER_CALL))
+    if len(datasets) > max_datasets:
+        raise toolkit.ValidationError(
+            {'datasets': ['At most {} datasets can be requested at once'.format(max_datasets)]})
+    summary = toolkit.asbool(data_dict.get('summary', False))
+
+    packages = {}
+    for pkg in model.Session.query(model.Package).filter(
+            or_(model.Package.id.in_(datasets), model.Package.name.in_(datasets))):
+        packages[pkg.id] = pkg
+        packages[pkg.name] = pkg
+
+    for id_or_name in datasets:
+        pkg = packages.get(id_or_name)
+        if pkg is None:
+            raise toolkit.ObjectNotFound('Dataset {} not found'.format(id_or_name))
+        toolkit.check_access('dataset_release_list', dict(context, package=pkg), {'dataset': pkg.id})
+
+    release_lists = _get_release_lists(set(packages[d].name for d in datasets))
+
+    result = {}
+    for id_or_name in datasets:
+        release_list = release_lists[packages[id_or_name].name]
+        result[id_or_name] = _summarize_release_list(release_list) if summary else release_list
+    return result
 
 
 @toolkit.side_effect_free
@@ -166,12 +261,25 @@ def dataset_release_show(context, data_dict):
     :returns: The matched release
     :rtype: dict
     """
-    dataset_name, release = toolkit.get_or_bust(data_dict, ['dataset', 'release'])
-    backend = get_metastore_backend()
-    with exception_mapper(exc.NotFound, toolkit.ObjectNotFound):
-        release_info = backend.tag_fetch(dataset_name, release)
+    dataset_name_or_id, release = toolkit.get_or_bust(data_dict, ['dataset', 'release'])
+    dataset_name = _get_dataset_name(dataset_name_or_id)
+
+    release_cache = get_release_cache()
+    release_dict = release_cache.get(dataset_name, release)
+    if release_dict is NOT_FOUND:
+        raise toolkit.ObjectNotFound('Dataset release not found')
+    elif release_dict is None:
+        backend = get_metastore_backend()
+        try:
+            release_info = backend.tag_fetch(dataset_name, release)
+        except exc.NotFound as e:
+            release_cache.set_not_found(dataset_name, release)
+            raise toolkit.ObjectNotFound(e)
+
+        release_dict = tag_to_dict(release_info)
+        release_cache.set(dataset_name, release_dict)
 
-    return tag_to_dict(release_info)
+    return release_dict
 
 
 def dataset_release_delete(context, data_dict):
@@ -191,6 +299,8 @@ def dataset_release_delete(context, data_dict):
         backend.tag_delete(dataset_name, release)
     except Exception:
         raise toolkit.ObjectNotFound('Dataset release not found')
+    finally:
+        get_release_cache().release_deleted(dataset_name, release)
 
     log.info('Release %s of dataset %s was deleted', release, dataset_name)
 
@@ -206,6 +316,10 @@ def package_show_revision(context, data_dict):
     :type id: string
     :param revision_ref: the ID of the revision
     :type revision_ref: string
+    :param fields: only return these fields of the package at the revision;
+                   Resource fields can be selected with ``resources.<field>``.
+                   A string is split on commas (optional)
+    :type fields: list of strings
     :returns: A package dict
     :rtype: dict
     """
@@ -218,6 +332,61 @@ def package_show_revision(context, data_dict):
     return result
 
 
+@toolkit.side_effect_free
+def package_show_revisions(context, data_dict):
+    """Show a package at several revisions or releases in one call
+
+    Live package metadata is read and access is checked only once, and
+    historical metadata for all revisions is read from the backend
+    concurrently.
+
+    :param id: the id or name of the package
+    :type id: string
+    :param revision_refs: revision IDs and / or release names; a string is
+                          split on commas
+    :type revision_refs: list of strings
+    :returns: A list of package dicts, in the same order as revision_refs
+    :rtype: list
+    """
+    revision_refs = _get_list_param(data_dict, 'revision_refs')
+    if not revision_refs:
+        raise toolkit.ValidationError({'revision_refs': ['Missing value']})
+
+    max_refs = toolkit.asint(toolkit.config.get('ckanext.versioning.max_revisions_per_call',
+                                                DEFAULT_MAX_REVISIONS_PER_CALL))
+    if len(revision_refs) > max_refs:
+        raise toolkit.ValidationError(
+            {'revision_refs': ['At most {} revisions can be requested at once'.format(max_refs)]})
+
+    fast_path = _use_revision_fast_path(data_dict)
+    package_dict = _get_live_package(context, data_dict, minimal=fast_path)
+    dataset_name = package_dict['name']
+    revision_ids = _resolve_revision_ids(dataset_name, revision_refs)
+
+    unique_ids = list(OrderedDict.fromkeys(revision_ids))
+    cache = get_revision_cache()
+    get_backend = get_thread_backend_getter()
+    converter = get_parallel_converter()
+    with exception_mapper(exc.NotFound, toolkit.ObjectNotFound):
+        datasets = get_fetch_pool().map(
+            lambda revision_id: _load_dataset_in_revision(dataset_name, revision_id, cache, get_backend, converter),
+            unique_ids,
+            chunksize=1)
+
+    datasets = dict(zip(unique_ids, datasets))
+    results = []
+    seen = set()
+    for revision_ref, revision_id in zip(revision_refs, revision_ids):
+        dataset = datasets[revision_id]
+        if revision_id in seen:
+            dataset = copy.deepcopy(dataset)
+        seen.add(revision_id)
+        results.append(_build_package_in_revision(context, copy.deepcopy(package_dict), dataset, revision_ref,
+                                                  after_show=fast_path))
+
+    return results
+
+
 @toolkit.side_effect_free
 def package_show_release(context, data_dict):
     """Wrapper for package_show with some additional release related info
@@ -236,8 +405,9 @@ def package_show_release(context, data_dict):
         release_dict = dataset_release_show(
             context, {'release': release, 'dataset': dataset_name}
             )
+        # Generated URLs keep referring to the release by name
         package_dict = _get_package_in_revision(
-            context, data_dict, release_dict['name'])
+            context, data_dict, release_dict['revision_ref'], release_dict['name'])
         package_dict['release_metadata'] = release_dict
     else:
         package_dict = core_package_show(context, data_dict)
@@ -268,71 +438,529 @@ def resource_show_revision(context, data_dict):
     model = context['model']
     id = toolkit.get_or_bust(data_dict, 'id')
     resource = model.Resource.get(id)
+    if not resource:
+        raise toolkit.ObjectNotFound('Resource not found')
+
+    context['resource'] = resource
+    toolkit.check_access('resource_show', context, {'id': id})
 
-    package = _get_package_in_revision(context, {'id': resource.package_id}, revision_ref)
-    resource_dict = h.find_resource_in_package(package, id)
+    dataset_name = _get_dataset_name(resource.package_id)
+    resource_dict = _get_resource_in_revision(dataset_name, revision_ref, id)
     if resource_dict is None:
         raise toolkit.ObjectNotFound("Resource not found for dataset revision")
 
-    return resource_dict
+    resource_dict['package_id'] = resource.package_id
+    resource_dict['datastore_active'] = False
+    return _fix_resource_data(resource_dict, revision_ref)
 
 
 @toolkit.side_effect_free
 def resource_show_release(context, data_dict):
     """Wrapper for resource_show allowing to get a resource from a specific
     dataset release
+
+    :param id: the id of the resource
+    :type id: string
+    :param release: the name of the release (optional); ``release_id`` is
+                    accepted as an alias
+    :type release: string
+    :param revision_ref: a revision ID, if ``release`` is not specified
+                         (optional)
+    :type revision_ref: string
+    :returns: A resource dict, with a ``release_metadata`` key if the
+              release or revision is known
+    :rtype: dict
     """
-    release_id = data_dict.get('release_id', None)
-    if release_id:
-        release_dict = dataset_release_show(context, {'id': release_id})
-        resource_dict = _get_resource_in_revision(
-            context, data_dict, release_dict['package_revision_id'])
-        resource_dict['release_metadata'] = release_dict
-        return resource_dict
+    release = data_dict.get('release', data_dict.get('release_id'))
+    revision_ref = data_dict.get('revision_ref')
+    if not (release or revision_ref):
+        return toolkit.get_action('resource_show')(context, data_dict)
 
+    model = context.get('model', core_model)
+    resource_id = toolkit.get_or_bust(data_dict, 'id')
+    resource = model.Resource.get(resource_id)
+    if not resource:
+        raise toolkit.ObjectNotFound('Resource not found')
+    dataset_name = _get_dataset_name(resource.package_id)
+
+    if release:
+        release_dict = dataset_release_show(context, {'dataset': dataset_name, 'release': release})
+        revision_ref = release_dict['revision_ref']
     else:
-        return toolkit.get_action('resource_show')(context, data_dict)
+        release_dict = get_release_by_revision(dataset_name, revision_ref)
+
+    resource_dict = resource_show_revision(context, {'id': resource_id, 'revision_ref': revision_ref})
+    if release_dict:
+        resource_dict['release_metadata'] = release_dict
+    return resource_dict
 
 
-def _get_package_in_revision(context, data_dict, revision_id):
+def get_release_by_revision(dataset_name, revision_ref):
+    """Get the release pointing to a revision of a dataset
+
+    This uses the cached index of releases by revision, which is reloaded
+    like the cached list of releases (see ``_get_release_list``). If more
+    than one release points to the revision, the oldest one is returned.
+    Returns None if no release points to the revision.
+    """
+    release_cache = get_release_cache()
+    release, fresh = release_cache.get_by_revision(dataset_name, revision_ref)
+    if release is None:
+        _get_release_list(dataset_name)
+        release, _ = release_cache.get_by_revision(dataset_name, revision_ref)
+    elif not fresh:
+        _refresh_release_list(release_cache, dataset_name)
+
+    if release is NOT_FOUND:
+        return None
+    return release
+
+
+def get_updated_package_dict(context, pkg_dict):
+    """Get the complete dict of a package just saved by ``package_update``
+
+    ``pkg_dict`` is the validated data dict passed to ``after_update``. It is
+    completed with what CKAN sets or normalizes when saving (e.g. resource
+    IDs and URLs, tags and extras), read from the saved package objects
+    rather than by a full ``package_show``, so that it converts to the same
+    datapackage as the output of ``package_show``. Packages in groups or
+    with relationships are rare, and are dictized by ``package_show``.
+    """
+    model = context.get('model', core_model)
+    pkg = model.Package.get(pkg_dict['id'])
+    if pkg is None or pkg.get_groups('group') or pkg.get_relationships():
+        return toolkit.get_action('package_show')({}, {'id': pkg_dict['id']})
+
+    dictize_context = {'model': model, 'session': model.Session}
+    # Custom fields of the dataset schema are only in the data dict
+    result = {k: v for k, v in pkg_dict.items() if k not in _NORMALIZED_PACKAGE_FIELDS}
+    result.update(table_dictize(pkg, dictize_context))
+
+    result['resources'] = model_dictize.resource_list_dictize(pkg.resources, dictize_context)
+    for resource in result['resources']:
+        for plugin in plugins.PluginImplementations(plugins.IResourceController):
+            plugin.before_show(resource)
+
+    result['tags'] = [{'name': tag.name} for tag in pkg.get_tags()]
+    extras = model.Session.query(model.PackageExtra).filter_by(package_id=pkg.id, state='active')
+    result['extras'] = sorted(({'key': e.key, 'value': e.value} for e in extras), key=lambda e: e['key'])
+    result['groups'] = []
+    result['relationships_as_object'] = []
+    result['relationships_as_subject'] = []
+    result['num_resources'] = len(result['resources'])
+    result['num_tags'] = len(result['tags'])
+    return _add_license_info(result)
+
+
+# Package dict fields CKAN normalizes when saving, which are read back from the saved package
+_NORMALIZED_PACKAGE_FIELDS = {'resources', 'tags', 'tag_string', 'extras', 'groups', 'relationships_as_object',
+                              'relationships_as_subject'}
+
+
+def _get_package_in_revision(context, data_dict, revision_id, revision_ref=None):
     """Internal implementation of package_show_revision
+
+    The dataset is read at ``revision_id``. URLs of uploaded resources refer
+    to ``revision_ref``, e.g. a release name, if specified.
     """
-    result = core_package_show(context, data_dict)
-    if revision_id:
-        backend = get_metastore_backend()
-        dataset_name = _get_dataset_name(data_dict.get('id'))
-        pkg_info = backend.fetch(dataset_name, revision_id)
-        dataset = frictionless_to_dataset(pkg_info.package)
-        result = update_ckan_dict(result, dataset)
-        for resource in result.get('resources', []):
+    if not revision_id:
+        return _add_license_info(core_package_show(context, data_dict))
+
+    revision_ref = revision_ref or revision_id
+    fields = _get_list_param(data_dict, 'fields')
+    if fields:
+        return _get_package_fields_in_revision(context, data_dict, revision_id, fields, revision_ref)
+
+    fast_path = _use_revision_fast_path(data_dict)
+    package_dict = _get_live_package(context, data_dict, minimal=fast_path)
+    dataset = _get_dataset_in_revision(package_dict['name'], revision_id)
+    return _build_package_in_revision(context, package_dict, dataset, revision_ref, after_show=fast_path)
+
+
+def _get_package_fields_in_revision(context, data_dict, revision_id, fields, revision_ref):
+    """Get only some fields of a package in a revision
+
+    ``fields`` are names of package fields, or of resource fields prefixed
+    with ``resources.``. Resources are not converted at all unless requested,
+    and resource URLs are only adjusted if requested. Plugins' ``after_show``
+    hooks are not called on the partial package dict.
+    """
+    package_fields = set()
+    resource_fields = set()
+    for field in fields:
+        if field.startswith('resources.'):
+            resource_fields.add(field[len('resources.'):])
+        else:
+            package_fields.add(field)
+    all_resource_fields = 'resources' in package_fields
+    with_resources = all_resource_fields or bool(resource_fields)
+
+    package_dict = _get_live_package(context, data_dict, minimal=True)
+    dataset = _get_dataset_in_revision(package_dict['name'], revision_id, with_resources=with_resources)
+    result = update_ckan_dict(package_dict, dataset)
+
+    if with_resources:
+        resources = result.get('resources', [])
+        for resource in resources:
             resource['datastore_active'] = False
-            _fix_resource_data(resource, revision_id)
-
-    # Fetching the license_url, title from the license registry and validate
-    if 'license_id' in result and result['license_id']:
-        license_data = h.get_license(result['license_id'])
-        # Validate license has url and title both
-        result['license_url'] = license_data.url if license_data.url else ''
-        result['license_title'] = license_data.title if license_data.title \
-            else ''
-    return result
+            if all_resource_fields or 'url' in resource_fields:
+                _fix_resource_data(resource, revision_ref)
+        if not all_resource_fields:
+            result['resources'] = [{k: r[k] for k in resource_fields if k in r} for r in resources]
+        package_fields.add('resources')
+
+    if 'num_resources' in package_fields and 'num_resources' not in result:
+        result['num_resources'] = len(result.get('resources', []))
+    if 'num_tags' in package_fields:
+        result['num_tags'] = len(result.get('tags', []))
+    if package_fields & {'license_url', 'license_title'}:
+        _add_license_info(result)
+
+    return {k: result[k] for k in package_fields if k in result}
+
+
+def _get_live_package(context, data_dict, minimal=False):
+    """Get the current package dict that historical metadata is applied to
+
+    This is the result of the core ``package_show``, unless ``minimal`` is
+    set (e.g. on the revision fast path), in which case only the few fields
+    which are not versioned (the package ID, state and owning organization)
+    are read from the DB. Either way, access is checked just like in
+    ``package_show``.
+    """
+    if not minimal:
+        return core_package_show(context, data_dict)
+
+    model = context.get('model', core_model)
+    id_or_name = toolkit.get_or_bust(data_dict, 'id')
+    pkg = model.Package.get(id_or_name)
+    if pkg is None:
+        raise toolkit.ObjectNotFound('Package {} not found'.format(id_or_name))
 
+    context['package'] = pkg
+    toolkit.check_access('package_show', context, data_dict)
 
-def _get_resource_in_revision(context, data_dict, revision_id):
-    """Get resource from a given revision
+    return {
+        'id': pkg.id,
+        'name': pkg.name,
+        'type': pkg.type,
+        'state': pkg.state,
+        'owner_org': pkg.owner_org,
+        'private': pkg.private,
+        'organization': _get_organization_dict(context, pkg.owner_org),
+    }
+
+
+def _build_package_in_revision(context, package_dict, dataset, revision_ref, after_show=False):
+    """Apply a dataset dict converted from a historical datapackage to a live
+    package dict
+
+    Fields which are not versioned are computed from the historical data, or
+    taken from the live package dict. Plugins' ``after_show`` hooks are
+    called on the result if ``after_show`` is set, i.e. if the live package
+    dict was not obtained from ``package_show``.
+    """
+    tracking_summary = package_dict.get('tracking_summary')
+    live_tracking = {r['id']: r['tracking_summary']
+                     for r in package_dict.get('resources', []) if 'tracking_summary' in r}
+    result = update_ckan_dict(package_dict, dataset)
+    if tracking_summary is not None:
+        result['tracking_summary'] = tracking_summary
+    for resource in result.get('resources', []):
+        resource['datastore_active'] = False
+        if resource.get('id') in live_tracking:
+            resource['tracking_summary'] = live_tracking[resource['id']]
+        _fix_resource_data(resource, revision_ref)
+
+    result['num_resources'] = len(result.get('resources', []))
+    result['num_tags'] = len(result.get('tags', []))
+
+    if after_show:
+        for item in plugins.PluginImplementations(plugins.IPackageController):
+            item.after_show(context, result)
+
+    return _add_license_info(result)
+
+
+def _add_license_info(package_dict):
+    """Set the license_url and title from the license registry
+
+    This mirrors what ``package_dictize`` does: Licenses which are not in the
+    registry are titled by their ID, and ``license_url`` is only set for
+    licenses with a URL.
+    """
+    license_id = package_dict.get('license_id')
+    license_data = h.get_license(license_id) if license_id else None
+    package_dict.pop('license_url', None)
+    if license_data and license_data.url:
+        package_dict['license_url'] = license_data.url
+        package_dict['license_title'] = license_data.title.split('::')[-1]
+    elif license_data:
+        package_dict['license_title'] = license_data.title
+    else:
+        package_dict['license_title'] = license_id
+    return package_dict
+
+
+def _use_revision_fast_path(data_dict):
+    """Check whether to build a package in a revision without a full ``package_show``
+
+    The fast path is not used when live fields that only ``package_show``
+    computes, such as tracking data, are requested.
     """
-    current_revision_id = context.get('revision_id', None)
-    context['revision_id'] = revision_id
-    result = core_resource_show(context, data_dict)
-    result['datastore_active'] = False
-    _fix_resource_data(result, revision_id)
+    if not toolkit.asbool(toolkit.config.get('ckanext.versioning.revision_fast_path', False)):
+        return False
+    try:
+        return not toolkit.asbool(data_dict.get('include_tracking', False))
+    except ValueError:
+        # Let package_show deal with the invalid value
+        return False
+
+
+def _get_organization_dict(context, org_id):
+    """Get the dictized owning organization of a package, like package_show does
+    """
+    if not org_id:
+        return None
+    org = context.get('model', core_model).Group.get(org_id)
+    if org is None or org.state != 'active':
+        return None
+    return table_dictize(org, context)
+
+
+def _get_release_list(dataset_name):
+    """Get the list of releases of a dataset, from cache if possible
 
-    if current_revision_id:
-        context['revision_id'] = current_revision_id
+    A stale cached list is still returned while it is reloaded in the
+    background, so that a slow backend does not block rendering pages.
+    """
+    release_cache = get_release_cache()
+    release_list, fresh = release_cache.get_list(dataset_name)
+    if release_list is None:
+        generation = release_cache.generation(dataset_name)
+        release_list = _load_release_list(dataset_name)
+        release_cache.set_list(dataset_name, release_list, generation=generation)
+    elif not fresh:
+        _refresh_release_list(release_cache, dataset_name)
+
+    return release_list
+
+
+def _get_release_lists(dataset_names):
+    """Get the lists of releases of many datasets, from cache if possible
+
+    Lists which are not cached are loaded from the backend concurrently.
+    Returns a dict of release lists by dataset name.
+    """
+    release_cache = get_release_cache()
+    release_lists = {}
+    missing = []
+    for dataset_name in dataset_names:
+        release_list, fresh = release_cache.get_list(dataset_name)
+        if release_list is None:
+            missing.append(dataset_name)
+            continue
+        release_lists[dataset_name] = release_list
+        if not fresh:
+            _refresh_release_list(release_cache, dataset_name)
+
+    if not missing:
+        return release_lists
+
+    generations = {n: release_cache.generation(n) for n in missing}
+    get_backend = get_thread_backend_getter()
+    loaded = get_fetch_pool().map(lambda n: _try_load_release_list(n, get_backend), missing, chunksize=1)
+    for dataset_name, release_list in zip(missing, loaded):
+        if release_list is None:
+            release_list = []
+        else:
+            release_cache.set_list(dataset_name, release_list, generation=generations[dataset_name])
+        release_lists[dataset_name] = release_list
+
+    return release_lists
+
+
+def _refresh_release_list(release_cache, dataset_name):
+    """Reload a stale cached list of releases in the background
+
+    The list is loaded in a background thread, which has no access to the
+    current request or to CKAN's configuration, so it gets its backend from
+    a getter created here.
+    """
+    loader = functools.partial(_load_release_list, get_backend=get_thread_backend_getter())
+    release_cache.refresh_list(dataset_name, loader)
+
+
+def _summarize_release_list(release_list):
+    """Get the number of releases and the latest release from a list of releases
+    """
+    latest = None
+    if release_list:
+        latest = {'name': release_list[-1]['name'], 'created': release_list[-1]['created']}
+    return {'count': len(release_list), 'latest': latest}
+
+
+def _load_release_list(dataset_name, get_backend=get_metastore_backend):
+    """Load the list of releases of a dataset from the backend
+    """
+    backend = get_backend()
+    with exception_mapper(exc.NotFound, toolkit.ObjectNotFound):
+        release_list = backend.tag_list(dataset_name)
+
+    return [tag_to_dict(t) for t in release_list]
+
+
+def _try_load_release_list(dataset_name, get_backend):
+    """Load the list of releases of a dataset, or return None if the dataset
+    is not in the backend
+    """
+    try:
+        return _load_release_list(dataset_name, get_backend)
+    except toolkit.ObjectNotFound:
+        return None
+
+
+def _get_dataset_in_revision(dataset_name, revision_ref, with_resources=True):
+    """Get the CKAN dataset dict converted from a dataset's datapackage in a
+    given revision or release
+
+    As revisions are immutable, converted datasets are cached by dataset name
+    and revision ID. The returned dict is a copy owned by the caller.
+
+    If ``with_resources`` is false and the dataset is not cached, resources
+    are not converted, and the returned dict may have no ``resources`` key;
+    The number of resources is set in ``num_resources`` instead.
+    """
+    revision_id = _resolve_revision_id(dataset_name, revision_ref)
+    cache = get_revision_cache()
+    if with_resources:
+        return _load_dataset_in_revision(dataset_name, revision_id, cache, get_metastore_backend,
+                                         get_parallel_converter())
+
+    dataset = _get_cached_dataset(cache, dataset_name, revision_id)
+    if dataset is not None:
+        return dataset
+
+    datapackage = dict(get_metastore_backend().fetch(dataset_name, revision_id).package)
+    resources = datapackage.pop('resources', [])
+    dataset = frictionless_to_dataset(datapackage)
+    dataset['num_resources'] = len(resources)
+    return dataset
+
+
+def _load_dataset_in_revision(dataset_name, revision_id, cache, get_backend, converter=None):
+    """Get a converted dataset at a revision ID from cache, or from the backend
+
+    Converted datasets are cached by the content hash of their datapackage,
+    so datapackages with the same content in different revisions (e.g.
+    after a revert) or datasets are only converted once. Each revision is
+    mapped to the content hash of its datapackage.
+
+    This does not access the request or CKAN's configuration, so it is safe
+    to call from worker threads.
+    """
+    dataset = _get_cached_dataset(cache, dataset_name, revision_id)
+    if dataset is not None:
+        return dataset
+
+    pkg_info = get_backend().fetch(dataset_name, revision_id)
+    content_hash = datapackage_hash(pkg_info.package, ignored_fields=())
+    dataset = cache.get(_content_cache_key(content_hash))
+    if dataset is None:
+        dataset = prepare_dataset(pkg_info.package, converter)
+        cache.set(_content_cache_key(content_hash), dataset)
+    cache.set((dataset_name, pkg_info.revision, 'content'), content_hash)
+    return dataset
+
+
+def _get_cached_dataset(cache, dataset_name, revision_id):
+    """Get the converted dataset at a revision ID from cache, or None
+    """
+    content_hash = cache.get((dataset_name, revision_id, 'content'))
+    if content_hash is None:
+        return None
+    return cache.get(_content_cache_key(content_hash))
+
+
+def _content_cache_key(content_hash):
+    # Dataset names cannot contain ':', so this never clashes with revision keys
+    return ('datapackage:sha1', content_hash)
+
+
+def _get_resource_in_revision(dataset_name, revision_ref, resource_id):
+    """Get a single CKAN resource dict from a dataset's datapackage in a given
+    revision or release, without converting the rest of the datapackage
+
+    Converted resources are cached by revision ID. If the whole dataset in
+    the revision is already cached, the resource is taken from it without
+    reading the datapackage from the backend. Otherwise, the unconverted
+    resources of the datapackage are cached as well, so reading other
+    resources in the same revision does not fetch it again. Returns None if
+    the resource does not exist in the revision.
+    """
+    revision_id = _resolve_revision_id(dataset_name, revision_ref)
+    cache = get_revision_cache()
+    resource_key = (dataset_name, revision_id, 'resources', resource_id)
+    resource = cache.get(resource_key)
+    if resource is not None:
+        return resource
+
+    dataset = _get_cached_dataset(cache, dataset_name, revision_id)
+    if dataset is not None:
+        resource = _find_resource(dataset.get('resources', []), resource_id)
     else:
-        del context['revision_id']
+        resources_key = (dataset_name, revision_id, 'datapackage_resources')
+        resources = cache.get(resources_key)
+        if resources is None:
+            datapackage = get_metastore_backend().fetch(dataset_name, revision_id).package
+            resources = datapackage.get('resources', [])
+            cache.set(resources_key, resources)
+        resource = _find_resource(resources, resource_id)
+        if resource is not None:
+            resource = frictionless_to_resource(resource)
 
-    return result
+    if resource is not None:
+        cache.set(resource_key, resource)
+    return resource
+
+
+def _find_resource(resources, resource_id):
+    return next((r for r in resources if r.get('id') == resource_id), None)
+
+
+def _resolve_revision_id(dataset_name, revision_ref):
+    """Get the revision ID a revision ref (revision ID or release name) points to
+    """
+    if get_metastore_backend().is_valid_revision_id(revision_ref):
+        return revision_ref
+
+    release = dataset_release_show({'ignore_auth': True}, {'dataset': dataset_name, 'release': revision_ref})
+    return release['revision_ref']
+
+
+def _resolve_revision_ids(dataset_name, revision_refs):
+    """Get the revision IDs a list of revision refs point to
+
+    Release names are looked up in the (cached) list of releases of the
+    dataset, so resolving many of them does not take a backend call each.
+    """
+    backend = get_metastore_backend()
+    releases = None
+    revision_ids = []
+    for revision_ref in revision_refs:
+        if backend.is_valid_revision_id(revision_ref):
+            revision_ids.append(revision_ref)
+            continue
+
+        if releases is None:
+            releases = {r['name']: r['revision_ref'] for r in _get_release_list(dataset_name)}
+        try:
+            revision_ids.append(releases[revision_ref])
+        except KeyError:
+            # The cached list may be outdated
+            revision_ids.append(_resolve_revision_id(dataset_name, revision_ref))
+
+    return revision_ids
 
 
 def _fix_resource_data(resource_dict, revision_id):
@@ -352,6 +980,50 @@ def _fix_resource_data(resource_dict, revision_id):
     return resource_dict
 
 
+@toolkit.side_effect_free
+def dataset_revision_fingerprint(context, data_dict):
+    """Get a fingerprint of a dataset in a revision or release
+
+    The fingerprint is cheap to compute, as it does not require reading the
+    dataset from the backend. It changes whenever showing the dataset in the
+    same revision or release may give a different result: when a release is
+    moved or modified, or when the current dataset is modified (as some
+    metadata, e.g. the owner organization, is not versioned).
+
+    :param dataset: the id or name of the dataset
+    :type dataset: string
+    :param revision_ref: the ID of the revision or release name
+    :type revision_ref: string
+    :returns: a dict with the ``fingerprint``, the ``revision_id`` the
+              revision ref points to, and whether it is ``immutable`` (i.e.
+              a revision ID rather than a release name)
+    :rtype: dict
+    """
+    model = context.get('model', core_model)
+    dataset_id_or_name, revision_ref = toolkit.get_or_bust(data_dict, ['dataset', 'revision_ref'])
+    toolkit.check_access('dataset_revision_fingerprint', context, data_dict)
+
+    dataset = model.Package.get(dataset_id_or_name)
+    if not dataset:
+        raise toolkit.ObjectNotFound('Dataset not found')
+
+    source = [dataset.id, dataset.metadata_modified.isoformat() if dataset.metadata_modified else None]
+    immutable = get_metastore_backend().is_valid_revision_id(revision_ref)
+    if immutable:
+        revision_id = revision_ref
+    else:
+        release = dataset_release_show(context, {'dataset': dataset.name, 'release': revision_ref})
+        revision_id = release['revision_ref']
+        source.extend([release['name'], release['description'], release['created']])
+    source.append(revision_id)
+
+    return {
+        'fingerprint': hashlib.sha1(json.dumps(source).encode('utf-8')).hexdigest(),
+        'revision_id': revision_id,
+        'immutable': immutable,
+    }
+
+
 @toolkit.side_effect_free
 def dataset_release_diff(context, data_dict):
     '''Returns a diff between two dataset releases
@@ -443,6 +1115,20 @@ def _generate_diff(obj1, obj2, diff_type):
     return diff
 
 
+def _flush_pending_writes(dataset_name):
+    """Commit queued changes of a dataset to the backend, if writes are async
+    """
+    write_queue = get_write_queue()
+    if write_queue is None:
+        return
+    flushed = write_queue.flush(dataset_name)
+    # Queued changes are committed by other backend instances than this request's
+    invalidate_request_reads(dataset_name)
+    if not flushed:
+        raise toolkit.ValidationError(
+            {'dataset': ['Recent changes to the dataset could not be saved yet, please try again later']})
+
+
 def _get_dataset_name(id_or_name):
     ''' Returns the dataset name given the id or name '''
     if not core_model.is_id(id_or_name):
@@ -455,6 +1141,57 @@ def _get_dataset_name(id_or_name):
     return dataset.name
 
 
+def _get_int_param(data_dict, key):
+    """Get an optional non-negative integer parameter from data_dict
+    """
+    value = data_dict.get(key)
+    if value is None or value == '':
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({key: ['Must be an integer']})
+    if value < 0:
+        raise toolkit.ValidationError({key: ['Must be a non-negative integer']})
+    return value
+
+
+def _get_list_param(data_dict, key):
+    """Get an optional list of strings parameter from data_dict
+
+    A string value is split on commas.
+    """
+    value = data_dict.get(key)
+    if not value:
+        return []
+    if isinstance(value, string_types):
+        value = value.split(',')
+    elif not isinstance(value, list):
+        raise toolkit.ValidationError({key: ['Must be a list of strings']})
+    return [v.strip() for v in value if v and v.strip()]
+
+
+def _get_datetime_param(data_dict, key):
+    """Get an optional ISO 8601 date / time parameter from data_dict
+    """
+    value = data_dict.get(key)
+    if not value:
+        return None
+    try:
+        return _parse_datetime(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({key: ['Must be an ISO 8601 date / time']})
+
+
+def _parse_datetime(value):
+    """Parse an ISO 8601 date / time string; Naive values are assumed to be UTC
+    """
+    parsed = date_parser.parse(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=tz.tzutc())
+    return parsed
+
+
 def _get_revision_ref(data_dict):
     """Get the revision_ref parameter from data_dict or query string
     """
@@ -468,6 +1205,55 @@ def _get_revision_ref(data_dict):
     return revision_ref
 
 
+def commit_batch_session(session, threads=None):
+    """Commit one revision per dataset changed in an ended batch session
+
+    Datasets are converted in the current thread, and committed to the
+    metastore backend by a pool of ``threads`` threads, by default
+    ``ckanext.versioning.batch_commit_threads``. Progress is logged as
+    datasets are committed.
+
+    Returns a summary with the number of changed ``datasets``, how many were
+    ``committed``, ``unchanged`` or ``skipped`` (e.g. as they were deleted
+    since), and the IDs of datasets which ``failed``.
+    """
+    threads = threads or toolkit.asint(
+        toolkit.config.get('ckanext.versioning.batch_commit_threads', DEFAULT_BATCH_COMMIT_THREADS))
+
+    exclude_fields = get_excluded_fields()
+    resource_cache = get_resource_conversion_cache()
+    converter = get_parallel_converter()
+    head_hashes = get_head_hashes()
+    get_backend = get_thread_backend_getter()
+
+    def convert(package_id, operation, author):
+        try:
+            pkg_dict = toolkit.get_action('package_show')({'ignore_auth': True}, {'id': package_id})
+        except toolkit.ObjectNotFound:
+            return None
+        if pkg_dict['type'] != 'dataset':
+            return None
+        # Changes queued before the session must be committed first
+        _flush_pending_writes(pkg_dict['name'])
+        datapackage = dataset_to_frictionless(pkg_dict, exclude_fields, resource_cache, converter)
+        return pkg_dict['name'], operation, datapackage, author
+
+    def commit(name, operation, datapackage, author):
+        return commits.commit_datapackage(get_backend(), name, operation, datapackage, author, head_hashes)
+
+    def progress(done, total):
+        log.info('Batch session: processed %d of %d datasets', done, total)
+
+    pool = ThreadPool(max(threads, 1))
+    try:
+        summary = session.commit(convert, commit, pool, chunk_size=max(threads, 1) * 10, progress=progress)
+    finally:
+        pool.close()
+
+    log.info('Batch session committed: %s', summary)
+    return summary
+
+
 @toolkit.chained_action
 def dataset_purge(next_action, context, data_dict):
     """Purge a dataset.
@@ -485,7 +1271,19 @@ def dataset_purge(next_action, context, data_dict):
     next_action(context, data_dict)
     assert 'package' in context
 
+    write_queue = get_write_queue()
+    if write_queue is not None:
+        write_queue.discard(context['package'].name)
+    head_hashes = get_head_hashes()
+    if head_hashes is not None:
+        head_hashes.delete(context['package'].name)
+    batch = get_batch_session()
+    if batch is not None:
+        batch.discard(context['package'].id)
+
     backend = get_metastore_backend()
+    get_release_cache().invalidate(context['package'].name)
+    get_fragment_cache().delete_if(lambda key: key[0] == context['package'].name)
     try:
         backend.delete(context['package'].name)
     except exc.NotFound as e:
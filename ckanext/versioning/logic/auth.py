@@ -48,6 +48,15 @@ def dataset_release_show(context, data_dict):
     return is_authorized('package_show', context, {"id": data_dict['dataset']})
 
 
+@toolkit.auth_allow_anonymous_access
+def dataset_revision_fingerprint(context, data_dict):
+    """Check if a user is allowed to get a dataset revision fingerprint
+
+    This is permitted only to users who can view the dataset
+    """
+    return is_authorized('package_show', context, {"id": data_dict['dataset']})
+
+
 @toolkit.auth_allow_anonymous_access
 def dataset_release_diff(context, data_dict):
     return dataset_release_show(context, data_dict)
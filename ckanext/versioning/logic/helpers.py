@@ -1,9 +1,14 @@
 import json
+import time
 
 from ckan import model
+from ckan.lib import helpers as h
 from ckan.plugins import toolkit
+from markupsafe import Markup
+from six import text_type
 
-from ckanext.versioning.common import get_metastore_backend
+from ckanext.versioning.common import (DEFAULT_FRAGMENT_CACHE_TTL, get_fragment_cache, get_metastore_backend,
+                                       get_write_queue)
 from ckanext.versioning.lib.changes import check_metadata_changes, check_resource_changes
 
 
@@ -107,6 +112,10 @@ def get_dataset_current_revision(dataset_name):
 
     # TODO: This shouldn't be necessary. It is only used in tests.
     '''
+    write_queue = get_write_queue()
+    if write_queue is not None:
+        write_queue.flush(dataset_name)
+
     backend = get_metastore_backend()
 
     return backend.fetch(dataset_name).revision
@@ -129,3 +138,91 @@ def get_query_param(key):
     templates
     '''
     return toolkit.request.params.get(key)
+
+
+def get_release_summaries(datasets):
+    '''Get the number of releases and the latest release of each of a list
+    of datasets, keyed by dataset id or name
+
+    Datasets the current user is not allowed to see, or which do not exist,
+    are left out. This is meant for pages listing many datasets.
+    '''
+    if not datasets:
+        return {}
+    try:
+        return toolkit.get_action('dataset_release_list_batch')(
+            {}, {'datasets': list(datasets), 'summary': True})
+    except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
+        pass
+
+    # Fall back to getting datasets one by one, to leave out the offending ones
+    summaries = {}
+    for dataset in datasets:
+        try:
+            summaries.update(toolkit.get_action('dataset_release_list_batch')(
+                {}, {'datasets': [dataset], 'summary': True}))
+        except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
+            continue
+    return summaries
+
+
+def cached_fragment(name, *key, **kwargs):
+    '''Render the body of a ``{% call %}`` block, caching the output on
+    pages showing a dataset in a release or revision
+
+    Usage::
+
+        {% call h.versioning_cached_fragment('resource_item', res.id) %}
+          ...
+        {% endcall %}
+
+    The output is cached by ``name`` and ``key``, the dataset and revision
+    shown, the current release metadata, the time the dataset was last
+    modified, the language and the user's permissions on the dataset.
+    Cached fragments expire after ``ckanext.versioning.fragment_cache_ttl``
+    seconds. The body must not depend on anything else (e.g. page view
+    counts), and must not include any ``{% resource %}`` tags, as these
+    would be skipped when the cached output is used.
+    '''
+    caller = kwargs.pop('caller')
+    release = getattr(toolkit.c, 'current_release', None)
+    if not release:
+        return caller()
+
+    dataset = release['package_id']
+    # Keyed by dataset first, so fragments of a dataset can be dropped when it is purged
+    cache_key = (dataset, json.dumps([name, list(key), release['revision_ref'], release.get('name'),
+                                      release.get('description'), release.get('created'),
+                                      _get_fragment_context(dataset), h.lang()]))
+    cache = get_fragment_cache()
+    cached = cache.get(cache_key)
+    if cached is not None and cached[0] > time.time():
+        return Markup(cached[1])
+
+    output = caller()
+    ttl = toolkit.asint(toolkit.config.get('ckanext.versioning.fragment_cache_ttl', DEFAULT_FRAGMENT_CACHE_TTL))
+    cache.set(cache_key, [time.time() + ttl, text_type(output)])
+    return output
+
+
+# Permissions which may affect how versioning template fragments are rendered
+_FRAGMENT_AUTH_ACTIONS = ('package_update', 'dataset_release_create', 'dataset_release_delete',
+                          'dataset_revert', 'dataset_release_diff')
+
+
+def _get_fragment_context(dataset):
+    '''Get the time a dataset was last modified, and the current user's
+    permissions on it as a list of booleans
+
+    The modification time is read from the DB, so that it is the same in all
+    processes. This is computed once per request.
+    '''
+    fragment_context = getattr(toolkit.c, 'versioning_fragment_context', None)
+    if fragment_context is None or fragment_context[0] != dataset:
+        pkg = model.Package.get(dataset)
+        modified = pkg.metadata_modified.isoformat() if pkg is not None and pkg.metadata_modified else None
+        permissions = [h.check_access(action, {'id': dataset, 'dataset': dataset})
+                       for action in _FRAGMENT_AUTH_ACTIONS]
+        fragment_context = (dataset, [modified, permissions])
+        toolkit.c.versioning_fragment_context = fragment_context
+    return fragment_context[1]
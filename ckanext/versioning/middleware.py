@@ -0,0 +1,119 @@
+"""Conditional GET support for API actions showing datasets in a revision
+
+GET requests to the API actions listed in ``_REVISION_REFS`` which reference
+a revision or release are given an ETag, derived from the fingerprint of each
+referenced dataset revision (see ``dataset_revision_fingerprint``), the
+request parameters and the user. Requests with a matching ``If-None-Match``
+header are answered with 304 before the action is called, so the dataset is
+neither read from the backend nor serialized.
+
+Requests with ``include_tracking`` are left alone, as the live tracking data
+they include changes without the fingerprint changing.
+"""
+import hashlib
+import json
+import re
+
+from ckan import model
+from ckan.plugins import toolkit
+from flask import g, make_response, request
+
+_API_ACTION_RE = re.compile(r'^/api/(?:\d+/)?action/([\w-]+)/?$')
+
+
+def register_conditional_get(app):
+    """Register conditional GET request hooks on a Flask app
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def _package_show_refs(args):
+    return [(args.get('id'), args.get('revision_ref'))]
+
+
+def _resource_show_refs(args):
+    resource = model.Resource.get(args.get('id')) if args.get('id') else None
+    if resource is None:
+        return []
+    return [(resource.package_id, args.get('revision_ref'))]
+
+
+def _package_show_release_refs(args):
+    return [(args.get('dataset'), args.get('release'))]
+
+
+def _dataset_release_diff_refs(args):
+    return [(args.get('id'), args.get('revision_ref_1')),
+            (args.get('id'), args.get('revision_ref_2'))]
+
+
+# Functions getting (dataset, revision_ref) pairs from API action parameters
+_REVISION_REFS = {
+    'package_show': _package_show_refs,
+    'resource_show': _resource_show_refs,
+    'package_show_release': _package_show_release_refs,
+    'dataset_release_diff': _dataset_release_diff_refs,
+}
+
+
+def _before_request():
+    if request.method != 'GET':
+        return None
+
+    match = _API_ACTION_RE.match(request.path)
+    if not match or match.group(1) not in _REVISION_REFS or _includes_tracking(request.args):
+        return None
+
+    etag = _get_etag(match.group(1), _REVISION_REFS[match.group(1)](request.args))
+    if etag is None:
+        return None
+
+    g.versioning_etag = etag
+    if etag in request.if_none_match:
+        return _add_cache_headers(make_response('', 304), etag)
+    return None
+
+
+def _after_request(response):
+    etag = getattr(g, 'versioning_etag', None)
+    if etag and response.status_code == 200:
+        _add_cache_headers(response, etag)
+    return response
+
+
+def _includes_tracking(args):
+    try:
+        return toolkit.asbool(args.get('include_tracking', False))
+    except ValueError:
+        # Let the action itself deal with the invalid value
+        return True
+
+
+def _get_etag(action_name, refs):
+    """Get the ETag for an API action call, or None if the call does not
+    reference revisions or the revisions cannot be resolved
+    """
+    if not refs or not all(dataset and revision_ref for dataset, revision_ref in refs):
+        return None
+
+    context = {'model': model,
+               'session': model.Session,
+               'user': toolkit.c.user,
+               'auth_user_obj': toolkit.c.userobj}
+    fingerprint = toolkit.get_action('dataset_revision_fingerprint')
+    try:
+        fingerprints = [fingerprint(context.copy(), {'dataset': dataset, 'revision_ref': revision_ref})['fingerprint']
+                        for dataset, revision_ref in refs]
+    except (toolkit.ObjectNotFound, toolkit.NotAuthorized, toolkit.ValidationError):
+        # Let the action itself respond with an error
+        return None
+
+    source = [action_name, sorted(request.args.items(multi=True)), fingerprints, toolkit.c.user or '']
+    return hashlib.sha1(json.dumps(source).encode('utf-8')).hexdigest()
+
+
+def _add_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = '{}, no-cache'.format('private' if toolkit.c.user else 'public')
+    return response
@@ -4,9 +4,12 @@ import logging
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.versioning import blueprints
-from ckanext.versioning.common import create_author_from_context, get_metastore_backend
+from ckanext.versioning import blueprints, middleware
+from ckanext.versioning.common import (create_author_from_context, get_batch_session, get_excluded_fields,
+                                       get_head_hashes, get_metastore_backend, get_parallel_converter,
+                                       get_resource_conversion_cache, get_write_queue)
 from ckanext.versioning.datapackage import dataset_to_frictionless
+from ckanext.versioning.lib import commits
 from ckanext.versioning.logic import action, auth, helpers
 
 log = logging.getLogger(__name__)
@@ -21,6 +24,7 @@ class PackageVersioningPlugin(plugins.SingletonPlugin,
     plugins.implements(plugins.IDatasetForm, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     # IConfigurer
 
@@ -36,12 +40,15 @@ class PackageVersioningPlugin(plugins.SingletonPlugin,
             'dataset_release_create': action.dataset_release_create,
             'dataset_release_delete': action.dataset_release_delete,
             'dataset_release_list': action.dataset_release_list,
+            'dataset_release_list_batch': action.dataset_release_list_batch,
             'dataset_release_update': action.dataset_release_update,
             'dataset_release_show': action.dataset_release_show,
             'dataset_revert': action.dataset_revert,
             'package_show_release': action.package_show_release,
+            'package_show_revisions': action.package_show_revisions,
             'resource_show_release': action.resource_show_release,
             'dataset_release_diff': action.dataset_release_diff,
+            'dataset_revision_fingerprint': action.dataset_revision_fingerprint,
 
             # Chained to core actions
             'dataset_purge': action.dataset_purge,
@@ -61,6 +68,7 @@ class PackageVersioningPlugin(plugins.SingletonPlugin,
             'dataset_release_show': auth.dataset_release_show,
             'dataset_revert': auth.dataset_revert,
             'dataset_release_diff': auth.dataset_release_diff,
+            'dataset_revision_fingerprint': auth.dataset_revision_fingerprint,
         }
 
     # ITemplateHelpers
@@ -72,6 +80,8 @@ class PackageVersioningPlugin(plugins.SingletonPlugin,
             'dataset_release_compare_pkg_dicts': helpers.compare_pkg_dicts,
             'tojson': helpers.tojson,
             'versioning_get_query_param': helpers.get_query_param,
+            'versioning_release_summaries': helpers.get_release_summaries,
+            'versioning_cached_fragment': helpers.cached_fragment,
         }
 
     # IPackageController
@@ -85,17 +95,22 @@ class PackageVersioningPlugin(plugins.SingletonPlugin,
             return pkg_dict
 
         if get_metastore_backend().is_valid_revision_id(revision_ref):
-            releases = action.dataset_release_list({"ignore_auth": True},
-                                                   {'dataset': pkg_dict['name']})
-            revision = filter(lambda d: d['revision_ref'] == revision_ref,
-                              releases)[0]
+            revision = action.get_release_by_revision(pkg_dict['name'], revision_ref)
         else:
             revision = action.dataset_release_show({"ignore_auth": True},
                                                    {'dataset': pkg_dict['name'],
                                                     'release': revision_ref})
 
-        # current_release needs to be a release (eg, name and description).
-        # This assumes that there is a release for the given revision
+        if revision is None:
+            # Not a released revision; it is shown under its revision ID, and
+            # templates must not offer to edit, delete or revert to it as a release
+            revision = {'name': revision_ref,
+                        'revision_ref': revision_ref,
+                        'package_id': pkg_dict['name'],
+                        'is_release': False}
+        else:
+            revision['is_release'] = True
+
         toolkit.c.current_release = revision
 
         # Hide package creation / update date if viewing a specific release
@@ -108,22 +123,18 @@ class PackageVersioningPlugin(plugins.SingletonPlugin,
 
         After creating the package, it calls metastore-lib to create a new
         GitHub repository a store the package dict in a datapackage.json file.
+        In async write mode, this is queued and done in the background. In a
+        batch session, this is deferred until the session is committed.
         """
 
         if pkg_dict['type'] == 'dataset':
-            datapackage = dataset_to_frictionless(pkg_dict)
-            backend = get_metastore_backend()
-            author = create_author_from_context(context)
-            pkg_info = backend.create(
-                pkg_dict['name'],
-                datapackage,
-                author=author
-                )
+            if self._defer_to_batch(context, pkg_dict, commits.CREATE):
+                return pkg_dict
 
-            log.info(
-                'Package {} created correctly. Revision {} created.'.format(
-                 pkg_info.package_id, pkg_info.revision
-                ))
+            datapackage = dataset_to_frictionless(pkg_dict, get_excluded_fields(), get_resource_conversion_cache(),
+                                                  get_parallel_converter())
+            author = create_author_from_context(context)
+            self._commit(pkg_dict['name'], commits.CREATE, datapackage, author)
 
         return pkg_dict
 
@@ -131,34 +142,63 @@ class PackageVersioningPlugin(plugins.SingletonPlugin,
         """Updates the datapackage.json using metastore-lib backend.
 
         After updating the package it calls metastore-lib to update the
-        datapackage.json file in the GitHub repository.
+        datapackage.json file in the GitHub repository, unless nothing but
+        fields such as ``metadata_modified`` changed. In async write mode,
+        this is queued and done in the background. In a batch session, this
+        is deferred until the session is committed.
         """
         if pkg_dict['type'] == 'dataset':
-            # We need to get a complete dict to also update resources data.
-            # We need to save tracking_summary, required for templates.
-            pkg_dict = toolkit.get_action('package_show')({}, {
-                'id': pkg_dict['id'],
-                'include_tracking': True
-                })
-
-            datapackage = dataset_to_frictionless(pkg_dict)
-            backend = get_metastore_backend()
-            author = create_author_from_context(context)
-            pkg_info = backend.update(
-                pkg_dict['name'], datapackage, author=author)
+            if self._defer_to_batch(context, pkg_dict, commits.UPDATE):
+                return pkg_dict
 
-            log.info(
-                'Package {} updated correctly. Revision {} created.'.format(
-                 pkg_info.package_id, pkg_info.revision
-                ))
+            # We need a complete dict to also update resources data.
+            pkg_dict = action.get_updated_package_dict(context, pkg_dict)
+
+            datapackage = dataset_to_frictionless(pkg_dict, get_excluded_fields(), get_resource_conversion_cache(),
+                                                  get_parallel_converter())
+            author = create_author_from_context(context)
+            self._commit(pkg_dict['name'], commits.UPDATE, datapackage, author)
 
         return pkg_dict
 
+    def _defer_to_batch(self, context, pkg_dict, operation):
+        batch = get_batch_session()
+        if batch is None:
+            return False
+        batch.record(pkg_dict['id'], operation, create_author_from_context(context))
+        return True
+
+    def _commit(self, name, operation, datapackage, author):
+        write_queue = get_write_queue()
+        if write_queue is not None:
+            write_queue.enqueue(name, operation, datapackage, author)
+            return
+
+        pkg_info = commits.commit_datapackage(
+            get_metastore_backend(), name, operation, datapackage, author, get_head_hashes())
+        if pkg_info is None:
+            log.info('Package {} is unchanged. No revision created.'.format(name))
+        else:
+            log.info('Package {} {}d correctly. Revision {} created.'.format(
+                pkg_info.package_id, operation, pkg_info.revision))
+
     # IBlueprint
 
     def get_blueprint(self):
         return [blueprints.versioning]
 
+    # IMiddleware
+
+    def make_middleware(self, app, config):
+        # Only the Flask app, which serves the API, can be hooked into
+        if hasattr(app, 'before_request'):
+            middleware.register_conditional_get(app)
+            # Commit writes left pending by a previous process. This is done
+            # when handling the first request, rather than here, so that the
+            # queue is set up in each worker process rather than before forking
+            app.before_first_request(get_write_queue)
+        return app
+
     # IDatasetForm
 
     def is_fallback(self):
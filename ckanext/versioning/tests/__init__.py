@@ -6,6 +6,8 @@ from ckan import model as core_model
 from ckan.common import config
 from ckan.tests import helpers
 
+from ckanext.versioning import common
+
 
 class MetastoreBackendTestBase(helpers.FunctionalTestBase):
 
@@ -22,6 +24,7 @@ class MetastoreBackendTestBase(helpers.FunctionalTestBase):
         super(MetastoreBackendTestBase, self).setup()
         self._backend_dir = tempfile.mkdtemp()
         config['ckanext.versioning.backend_config'] = json.dumps({"uri": self._backend_dir})
+        common.clear_caches()
 
     def teardown(self):
         shutil.rmtree(self._backend_dir)
@@ -1,9 +1,15 @@
+import threading
+import time
+
 from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckan.tests import helpers as test_helpers
 from metastore.backend.exc import NotFound
-from nose.tools import assert_equals, assert_in, assert_raises, raises
+from nose.tools import assert_equals, assert_in, assert_not_in, assert_raises, raises
 
+from ckanext.versioning import common
+from ckanext.versioning.batch import batch_session
+from ckanext.versioning.common import end_batch_session, get_metastore_backend, get_revision_cache
 from ckanext.versioning.logic import helpers
 from ckanext.versioning.tests import MetastoreBackendTestBase
 
@@ -97,6 +103,69 @@ class TestVersioningActions(MetastoreBackendTestBase):
                                             dataset=self.dataset['id'])
         assert_equals(len(releases), 1)
 
+    def test_list_updated_after_create(self):
+        context = self._get_context(self.org_admin)
+        releases = test_helpers.call_action('dataset_release_list',
+                                            context,
+                                            dataset=self.dataset['id'])
+        assert_equals(len(releases), 0)
+
+        test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name="0.1.2")
+
+        releases = test_helpers.call_action('dataset_release_list',
+                                            context,
+                                            dataset=self.dataset['id'])
+        assert_equals(len(releases), 1)
+
+    def test_list_limit_offset(self):
+        context = self._get_context(self.org_admin)
+        for name in ['1', '2', '3']:
+            test_helpers.call_action(
+                'dataset_release_create',
+                context,
+                dataset=self.dataset['id'],
+                name=name)
+
+        releases = test_helpers.call_action('dataset_release_list',
+                                            context,
+                                            dataset=self.dataset['id'],
+                                            limit=2)
+        assert_equals([r['name'] for r in releases], ['1', '2'])
+
+        releases = test_helpers.call_action('dataset_release_list',
+                                            context,
+                                            dataset=self.dataset['id'],
+                                            limit=2,
+                                            offset=2)
+        assert_equals([r['name'] for r in releases], ['3'])
+
+    def test_list_since(self):
+        context = self._get_context(self.org_admin)
+        for name in ['1', '2']:
+            test_helpers.call_action(
+                'dataset_release_create',
+                context,
+                dataset=self.dataset['id'],
+                name=name)
+
+        all_releases = test_helpers.call_action('dataset_release_list',
+                                                context,
+                                                dataset=self.dataset['id'])
+
+        releases = test_helpers.call_action('dataset_release_list',
+                                            context,
+                                            dataset=self.dataset['id'],
+                                            since=all_releases[1]['created'])
+        assert_equals([r['name'] for r in releases], ['2'])
+
+    def test_list_invalid_limit(self):
+        assert_raises(toolkit.ValidationError, test_helpers.call_action,
+                      'dataset_release_list', dataset=self.dataset['id'], limit='all')
+
     def test_list_no_releases(self):
         context = self._get_context(self.org_admin)
         releases = test_helpers.call_action('dataset_release_list',
@@ -114,6 +183,129 @@ class TestVersioningActions(MetastoreBackendTestBase):
         assert_raises(toolkit.ObjectNotFound, test_helpers.call_action,
                       'dataset_release_list', **payload)
 
+    def test_list_batch(self):
+        context = self._get_context(self.org_admin)
+        other_dataset = factories.Dataset()
+        for name in ['1', '2']:
+            test_helpers.call_action(
+                'dataset_release_create',
+                context,
+                dataset=self.dataset['id'],
+                name=name)
+
+        releases = test_helpers.call_action('dataset_release_list_batch',
+                                            context,
+                                            datasets=[self.dataset['id'], other_dataset['name']])
+        assert_equals([r['name'] for r in releases[self.dataset['id']]], ['1', '2'])
+        assert_equals(releases[other_dataset['name']], [])
+
+    def test_list_batch_summary(self):
+        context = self._get_context(self.org_admin)
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        summaries = test_helpers.call_action('dataset_release_list_batch',
+                                             context,
+                                             datasets=self.dataset['name'],
+                                             summary=True)
+        assert_equals(summaries[self.dataset['name']],
+                      {'count': 1, 'latest': {'name': '1.0', 'created': release['created']}})
+
+    def test_list_batch_not_found(self):
+        assert_raises(toolkit.ObjectNotFound, test_helpers.call_action,
+                      'dataset_release_list_batch', datasets=[self.dataset['id'], 'abc123'])
+
+    def test_revision_fingerprint(self):
+        context = self._get_context(self.org_admin)
+        revision_ref = helpers.get_dataset_current_revision(self.dataset['name'])
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        by_revision = test_helpers.call_action('dataset_revision_fingerprint',
+                                               context,
+                                               dataset=self.dataset['id'],
+                                               revision_ref=revision_ref)
+        assert_equals(by_revision['revision_id'], revision_ref)
+        assert_equals(by_revision['immutable'], True)
+
+        by_release = test_helpers.call_action('dataset_revision_fingerprint',
+                                              context,
+                                              dataset=self.dataset['name'],
+                                              revision_ref=release['name'])
+        assert_equals(by_release['revision_id'], revision_ref)
+        assert_equals(by_release['immutable'], False)
+
+        test_helpers.call_action(
+            'dataset_release_update',
+            context,
+            dataset=self.dataset['id'],
+            release=release['name'],
+            name=release['name'],
+            description='New description')
+
+        updated = test_helpers.call_action('dataset_revision_fingerprint',
+                                           context,
+                                           dataset=self.dataset['name'],
+                                           revision_ref=release['name'])
+        assert updated['fingerprint'] != by_release['fingerprint']
+
+    @test_helpers.change_config('ckanext.versioning.write_mode', 'async')
+    def test_create_release_includes_queued_changes(self):
+        context = self._get_context(self.org_admin)
+        test_helpers.call_action(
+            'package_patch',
+            context,
+            id=self.dataset['id'],
+            title='Queued Title')
+
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=release['name'])
+        assert_equals(dataset['title'], 'Queued Title')
+
+    @test_helpers.change_config('ckanext.versioning.write_mode', 'async')
+    def test_create_release_after_reading_head_in_same_request(self):
+        context = self._get_context(self.org_admin)
+        memo = {}
+        get_request_memo = common._get_request_memo
+        common._get_request_memo = lambda: memo
+        try:
+            # HEAD is memoized before queued changes are committed
+            get_metastore_backend().fetch(self.dataset['name'])
+            test_helpers.call_action(
+                'package_patch',
+                context,
+                id=self.dataset['id'],
+                title='Queued Title')
+            release = test_helpers.call_action(
+                'dataset_release_create',
+                context,
+                dataset=self.dataset['id'],
+                name='1.0')
+        finally:
+            common._get_request_memo = get_request_memo
+
+        dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=release['name'])
+        assert_equals(dataset['title'], 'Queued Title')
+
     def test_create_two_releases_for_same_revision(self):
         context = self._get_context(self.org_admin)
         test_helpers.call_action(
@@ -135,6 +327,34 @@ class TestVersioningActions(MetastoreBackendTestBase):
                                             dataset=self.dataset['id'])
         assert_equals(len(releases), 2)
 
+    def test_release_list_stale_entry_is_refreshed(self):
+        context = self._get_context(self.org_admin)
+        test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name="0.1.2",
+            description="The best dataset ever, it **rules!**")
+
+        release_cache = common.get_release_cache()
+        release_cache.set_list(self.dataset['name'], [])
+        list_ttl = release_cache.list_ttl
+        release_cache.list_ttl = 0
+        try:
+            # The stale list is served while it is reloaded in the background
+            releases = test_helpers.call_action('dataset_release_list', context, dataset=self.dataset['id'])
+            assert_equals(releases, [])
+
+            for _ in range(100):
+                cached, _ = release_cache.get_list(self.dataset['name'])
+                if cached:
+                    break
+                time.sleep(0.05)
+        finally:
+            release_cache.list_ttl = list_ttl
+
+        assert_equals([r['name'] for r in cached], ['0.1.2'])
+
     def test_delete(self):
         context = self._get_context(self.org_admin)
         release = test_helpers.call_action(
@@ -178,6 +398,56 @@ class TestVersioningActions(MetastoreBackendTestBase):
 
         assert_equals(release2, release1)
 
+    def test_show_after_delete_not_found(self):
+        context = self._get_context(self.org_admin)
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name="0.1.2")
+
+        test_helpers.call_action('dataset_release_show', context,
+                                 dataset=self.dataset['name'],
+                                 release=release['name'])
+
+        test_helpers.call_action('dataset_release_delete', context,
+                                 dataset=self.dataset['name'],
+                                 release=release['name'])
+
+        assert_raises(toolkit.ObjectNotFound, test_helpers.call_action,
+                      'dataset_release_show', context,
+                      dataset=self.dataset['name'], release=release['name'])
+
+    def test_show_after_update(self):
+        context = self._get_context(self.org_admin)
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name="0.1.2")
+
+        test_helpers.call_action('dataset_release_show', context,
+                                 dataset=self.dataset['name'],
+                                 release=release['name'])
+
+        test_helpers.call_action(
+            'dataset_release_update',
+            context,
+            dataset=self.dataset['id'],
+            release=release['name'],
+            name="0.1.3",
+            description="Edited Description")
+
+        updated = test_helpers.call_action('dataset_release_show', context,
+                                           dataset=self.dataset['name'],
+                                           release='0.1.3')
+        assert_equals(updated['description'], "Edited Description")
+        assert_equals(updated['revision_ref'], release['revision_ref'])
+
+        assert_raises(toolkit.ObjectNotFound, test_helpers.call_action,
+                      'dataset_release_show', context,
+                      dataset=self.dataset['name'], release=release['name'])
+
     def test_show_not_found(self):
         payload = {'dataset': 'abc123', 'release': '1.1'}
         assert_raises(toolkit.ObjectNotFound, test_helpers.call_action,
@@ -615,6 +885,178 @@ class TestPackageShowRevision(MetastoreBackendTestBase):
 
         assert_equals(initial_dataset['title'], 'Test Dataset')
 
+    def test_package_show_revision_excludes_volatile_fields(self):
+        context = self._get_context(self.org_admin)
+        test_helpers.call_action(
+            'package_update',
+            context,
+            name=self.dataset['name'],
+            title='New Title',
+            notes='New Notes'
+        )
+        revision = helpers.get_dataset_current_revision(self.dataset['name'])
+
+        datapackage = get_metastore_backend().fetch(self.dataset['name'], revision).package
+        assert_not_in('metadata_modified', datapackage)
+        assert_not_in('tracking_summary', datapackage)
+
+        dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=revision
+            )
+        assert_equals(dataset['num_resources'], len(dataset['resources']))
+
+    @test_helpers.change_config('ckanext.versioning.revision_fast_path', 'true')
+    def test_package_show_revision_fast_path_gets_revision(self):
+        context = self._get_context(self.org_admin)
+        initial_revision = helpers.get_dataset_current_revision(
+            self.dataset['name']
+            )
+
+        test_helpers.call_action(
+            'package_update',
+            context,
+            name=self.dataset['name'],
+            title='New Title',
+            notes='New Notes'
+        )
+
+        initial_dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=initial_revision
+            )
+
+        assert_equals(initial_dataset['title'], 'Test Dataset')
+        assert_equals(initial_dataset['id'], self.dataset['id'])
+        assert_equals(initial_dataset['state'], 'active')
+        assert_equals(initial_dataset['num_resources'], 2)
+        assert_equals(
+            [r['id'] for r in initial_dataset['resources']],
+            [self.uploaded_resource['id'], self.url_resource['id']])
+
+    @test_helpers.change_config('ckanext.versioning.revision_fast_path', 'true')
+    def test_package_show_revision_fast_path_includes_tracking(self):
+        context = self._get_context(self.org_admin)
+        revision = helpers.get_dataset_current_revision(self.dataset['name'])
+
+        dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=revision,
+            include_tracking=True
+            )
+
+        assert_in('tracking_summary', dataset)
+        for resource in dataset['resources']:
+            assert_in('tracking_summary', resource)
+
+    def test_package_show_revisions(self):
+        context = self._get_context(self.org_admin)
+        initial_revision = helpers.get_dataset_current_revision(
+            self.dataset['name']
+            )
+
+        test_helpers.call_action(
+            'package_update',
+            context,
+            name=self.dataset['name'],
+            title='New Title',
+            notes='New Notes'
+        )
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        datasets = test_helpers.call_action(
+            'package_show_revisions',
+            context,
+            id=self.dataset['id'],
+            revision_refs=[release['name'], initial_revision, release['revision_ref']]
+            )
+
+        assert_equals([d['title'] for d in datasets], ['New Title', 'Test Dataset', 'New Title'])
+        assert_equals(set(d['id'] for d in datasets), {self.dataset['id']})
+
+    def test_package_show_revisions_identical_content_is_cached_once(self):
+        context = self._get_context(self.org_admin)
+        initial_revision = helpers.get_dataset_current_revision(self.dataset['name'])
+        test_helpers.call_action('package_update', context, name=self.dataset['name'], title='New Title')
+        test_helpers.call_action('package_update', context, name=self.dataset['name'], title='Test Dataset')
+        reverted_revision = helpers.get_dataset_current_revision(self.dataset['name'])
+
+        datasets = test_helpers.call_action(
+            'package_show_revisions',
+            context,
+            id=self.dataset['id'],
+            revision_refs=[initial_revision, reverted_revision]
+            )
+
+        assert_equals([d['title'] for d in datasets], ['Test Dataset', 'Test Dataset'])
+        cache = get_revision_cache()
+        assert_equals(cache.get((self.dataset['name'], initial_revision, 'content')),
+                      cache.get((self.dataset['name'], reverted_revision, 'content')))
+
+    @raises(toolkit.ObjectNotFound)
+    def test_package_show_revisions_unknown_release(self):
+        context = self._get_context(self.org_admin)
+        test_helpers.call_action(
+            'package_show_revisions',
+            context,
+            id=self.dataset['id'],
+            revision_refs='no-such-release'
+            )
+
+    @raises(toolkit.ValidationError)
+    def test_package_show_revisions_requires_revision_refs(self):
+        context = self._get_context(self.org_admin)
+        test_helpers.call_action(
+            'package_show_revisions',
+            context,
+            id=self.dataset['id'],
+            revision_refs=[]
+            )
+
+    def test_package_show_revision_fields(self):
+        context = self._get_context(self.org_admin)
+        initial_revision = helpers.get_dataset_current_revision(
+            self.dataset['name']
+            )
+
+        test_helpers.call_action(
+            'package_update',
+            context,
+            name=self.dataset['name'],
+            title='New Title',
+            notes='New Notes'
+        )
+
+        initial_dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=initial_revision,
+            fields='title,num_resources'
+            )
+        assert_equals(initial_dataset, {'title': 'Test Dataset', 'num_resources': 2})
+
+        initial_dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=initial_revision,
+            fields=['notes', 'resources.id']
+            )
+        assert_equals(initial_dataset['notes'], self.dataset['notes'])
+        assert_equals(initial_dataset['resources'],
+                      [{'id': self.uploaded_resource['id']}, {'id': self.url_resource['id']}])
+
     def test_package_show_revision_has_download_url(self):
         context = self._get_context(self.org_admin)
         initial_revision = helpers.get_dataset_current_revision(
@@ -645,6 +1087,32 @@ class TestPackageShowRevision(MetastoreBackendTestBase):
 
         assert_equals(initial_dataset['resources'][0]['url'], expected)
 
+    def test_package_show_release_download_url_refers_to_release(self):
+        context = self._get_context(self.org_admin)
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        dataset = test_helpers.call_action(
+            'package_show_release',
+            context,
+            id=self.dataset['id'],
+            dataset=self.dataset['id'],
+            release=release['name']
+            )
+
+        expected = ('http://localhost:5000/dataset/{dataset_id}/resource/'
+                    '{resource_id}/download/{filename}?revision_ref={revision_ref}') \
+            .format(dataset_id=self.dataset['id'],
+                    resource_id=self.uploaded_resource['id'],
+                    filename='my-resource.csv',
+                    revision_ref=release['name'])
+
+        assert_equals(dataset['resources'][0]['url'], expected)
+        assert_equals(dataset['release_metadata']['name'], release['name'])
+
     def test_resource_show_revision_has_download_url(self):
         context = self._get_context(self.org_admin)
         initial_revision = helpers.get_dataset_current_revision(
@@ -698,6 +1166,111 @@ class TestPackageShowRevision(MetastoreBackendTestBase):
 
         assert_equals(initial_resource['url'], 'http://link.to.some.data')
 
+    def test_resource_show_revision_from_cached_package(self):
+        context = self._get_context(self.org_admin)
+        initial_revision = helpers.get_dataset_current_revision(self.dataset['name'])
+        test_helpers.call_action(
+            'resource_patch',
+            context,
+            id=self.url_resource['id'],
+            name='New Resource Name'
+        )
+
+        # Showing the package caches the whole dataset in the revision
+        initial_dataset = test_helpers.call_action(
+            'package_show',
+            context,
+            id=self.dataset['id'],
+            revision_ref=initial_revision
+        )
+        initial_resource = test_helpers.call_action(
+            'resource_show',
+            context,
+            id=self.url_resource['id'],
+            revision_ref=initial_revision
+        )
+
+        assert_equals(initial_resource['name'], self.url_resource['name'])
+        assert_in(initial_resource['id'], [r['id'] for r in initial_dataset['resources']])
+
+    def test_resource_show_revision_fetches_datapackage_once(self):
+        context = self._get_context(self.org_admin)
+        initial_revision = helpers.get_dataset_current_revision(self.dataset['name'])
+        test_helpers.call_action(
+            'resource_patch',
+            context,
+            id=self.url_resource['id'],
+            name='New Resource Name'
+        )
+
+        backend = get_metastore_backend()
+        fetched = []
+
+        def fetch(*args, **kwargs):
+            fetched.append(args)
+            return type(backend).fetch(backend, *args, **kwargs)
+
+        backend.fetch = fetch
+        try:
+            resources = [test_helpers.call_action('resource_show', context, id=resource_id,
+                                                  revision_ref=initial_revision)
+                         for resource_id in [self.uploaded_resource['id'], self.url_resource['id']]]
+        finally:
+            del backend.fetch
+
+        assert_equals([r['id'] for r in resources], [self.uploaded_resource['id'], self.url_resource['id']])
+        assert_equals(resources[1]['name'], self.url_resource['name'])
+        assert_equals(len(fetched), 1)
+
+    @raises(toolkit.ObjectNotFound)
+    def test_resource_show_revision_resource_not_in_revision(self):
+        context = self._get_context(self.org_admin)
+        initial_revision = helpers.get_dataset_current_revision(
+            self.dataset['name']
+            )
+
+        new_resource = factories.Resource(package_id=self.dataset['id'])
+
+        test_helpers.call_action(
+            'resource_show',
+            context,
+            id=new_resource['id'],
+            revision_ref=initial_revision
+        )
+
+    def test_resource_show_release(self):
+        context = self._get_context(self.org_admin)
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        test_helpers.call_action(
+            'resource_patch',
+            context,
+            id=self.url_resource['id'],
+            name='New Resource Name'
+        )
+
+        resource = test_helpers.call_action(
+            'resource_show_release',
+            context,
+            id=self.url_resource['id'],
+            release=release['name']
+        )
+        assert_equals(resource['name'], self.url_resource['name'])
+        assert_equals(resource['release_metadata'], release)
+
+        resource = test_helpers.call_action(
+            'resource_show_release',
+            context,
+            id=self.url_resource['id'],
+            revision_ref=release['revision_ref']
+        )
+        assert_equals(resource['name'], self.url_resource['name'])
+        assert_equals(resource['release_metadata']['name'], release['name'])
+
 
 class TestDatasetPurge(MetastoreBackendTestBase):
 
@@ -728,6 +1301,19 @@ class TestDatasetPurge(MetastoreBackendTestBase):
         with assert_raises(NotFound):
             backend.fetch(self.dataset['name'])
 
+    def test_dataset_purge_drops_cached_fragments(self):
+        context = self._get_context(self.sys_admin)
+        fragment_cache = common.get_fragment_cache()
+        fragment_cache.set((self.dataset['name'], '["release_list"]'), [0, '<div></div>'])
+
+        test_helpers.call_action(
+            'dataset_purge',
+            context,
+            id=self.dataset['name'],
+        )
+
+        assert_not_in((self.dataset['name'], '["release_list"]'), fragment_cache)
+
     def test_dataset_purge_works_if_not_in_metastore(self):
         context = self._get_context(self.sys_admin)
 
@@ -761,3 +1347,57 @@ class TestDatasetPurge(MetastoreBackendTestBase):
             context,
             id=self.dataset['name'],
         )
+
+
+class TestVersioningBatch(MetastoreBackendTestBase):
+
+    def setup(self):
+        super(TestVersioningBatch, self).setup()
+        self.sys_admin = factories.Sysadmin()
+        self.datasets = [factories.Dataset(), factories.Dataset()]
+
+    def teardown(self):
+        end_batch_session()
+        super(TestVersioningBatch, self).teardown()
+
+    def test_batch_commits_one_revision_per_dataset(self):
+        context = self._get_context(self.sys_admin)
+        with batch_session() as batch:
+            for dataset in self.datasets:
+                for title in ('First Title', 'Second Title'):
+                    test_helpers.call_action('package_patch', context, id=dataset['id'], title=title)
+
+                # Nothing is committed until the end of the session
+                assert_equals(len(helpers.get_dataset_revision_list(dataset['name'])), 1)
+
+        assert_equals(batch['summary']['committed'], 2)
+        for dataset in self.datasets:
+            assert_equals(len(helpers.get_dataset_revision_list(dataset['name'])), 2)
+            revision = helpers.get_dataset_current_revision(dataset['name'])
+            dataset = test_helpers.call_action('package_show', context, id=dataset['id'], revision_ref=revision)
+            assert_equals(dataset['title'], 'Second Title')
+
+    def test_batch_session_twice(self):
+        with batch_session():
+            with assert_raises(RuntimeError):
+                with batch_session():
+                    pass
+
+    def test_batch_session_does_not_defer_other_threads(self):
+        context = self._get_context(self.sys_admin)
+        dataset = self.datasets[0]
+
+        def patch():
+            test_helpers.call_action('package_patch', dict(context), id=dataset['id'], title='Other Thread')
+
+        with batch_session() as batch:
+            thread = threading.Thread(target=patch)
+            thread.start()
+            thread.join()
+            assert_equals(len(helpers.get_dataset_revision_list(dataset['name'])), 2)
+
+        assert_equals(batch['summary']['datasets'], 0)
+
+    def test_batch_actions_are_not_exposed(self):
+        for name in ('versioning_batch_begin', 'versioning_batch_commit'):
+            assert_raises(KeyError, toolkit.get_action, name)
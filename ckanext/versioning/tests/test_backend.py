@@ -0,0 +1,115 @@
+"""Tests for lib/backend.py
+"""
+import threading
+
+from nose.tools import assert_equals, assert_is, assert_is_not
+
+from ckanext.versioning.lib import backend
+
+
+class _FakeBackend(object):
+
+    def __init__(self, backend_type, config):
+        self.backend_type = backend_type
+        self.config = config
+
+
+def test_parse_backend_config():
+    assert_equals(backend.parse_backend_config('{"uri": "/tmp/foo"}'), {"uri": "/tmp/foo"})
+    assert_equals(backend.parse_backend_config(None), {})
+
+
+def test_pool_reuses_backend_instance():
+    pool = backend.BackendPool(factory=_FakeBackend)
+    b1 = pool.get('filesystem', '{"uri": "/tmp/foo"}')
+    b2 = pool.get('filesystem', '{"uri": "/tmp/foo"}')
+    assert_is(b1, b2)
+    assert_equals(b1.config, {"uri": "/tmp/foo"})
+    assert_equals(pool.stats.as_dict(), {'hits': 1, 'misses': 1, 'evictions': 0})
+
+
+def test_pool_creates_new_instance_when_config_changes():
+    pool = backend.BackendPool(factory=_FakeBackend)
+    b1 = pool.get('filesystem', '{"uri": "/tmp/foo"}')
+    b2 = pool.get('filesystem', '{"uri": "/tmp/bar"}')
+    assert_is_not(b1, b2)
+    assert_equals(b2.config, {"uri": "/tmp/bar"})
+
+
+def test_pool_invalidate():
+    pool = backend.BackendPool(factory=_FakeBackend)
+    b1 = pool.get('filesystem', '{"uri": "/tmp/foo"}')
+    pool.invalidate()
+    b2 = pool.get('filesystem', '{"uri": "/tmp/foo"}')
+    assert_is_not(b1, b2)
+    assert_equals(pool.stats.as_dict(), {'hits': 0, 'misses': 2, 'evictions': 0})
+
+
+def test_pool_instances_are_per_thread():
+    pool = backend.BackendPool(factory=_FakeBackend)
+    main_backend = pool.get('filesystem', '{}')
+    thread_backends = []
+
+    thread = threading.Thread(target=lambda: thread_backends.append(pool.get('filesystem', '{}')))
+    thread.start()
+    thread.join()
+
+    assert_is_not(main_backend, thread_backends[0])
+
+
+class _CountingBackend(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def fetch(self, package_id, revision_ref=None):
+        self.calls.append(('fetch', package_id, revision_ref))
+        return {'name': package_id, 'revision': revision_ref}
+
+    def tag_list(self, package_id):
+        self.calls.append(('tag_list', package_id))
+        return ['tag-1', 'tag-2']
+
+    def update(self, package_id, metadata, author=None):
+        self.calls.append(('update', package_id))
+
+
+def test_request_cached_backend_memoizes_reads():
+    wrapped = _CountingBackend()
+    memo = {}
+    b = backend.RequestCachedBackend(wrapped, memo)
+
+    assert_equals(b.fetch('pkg', 'rev-1'), {'name': 'pkg', 'revision': 'rev-1'})
+    assert_equals(b.fetch('pkg', 'rev-1'), {'name': 'pkg', 'revision': 'rev-1'})
+    b.fetch('pkg', 'rev-2')
+    b.tag_list('pkg')
+    b.tag_list('pkg')
+
+    # A new wrapper sharing the same memo (i.e. the same request) is also cached
+    backend.RequestCachedBackend(wrapped, memo).fetch('pkg', 'rev-1')
+
+    assert_equals(wrapped.calls, [('fetch', 'pkg', 'rev-1'),
+                                  ('fetch', 'pkg', 'rev-2'),
+                                  ('tag_list', 'pkg')])
+
+
+def test_request_cached_backend_returns_copies():
+    b = backend.RequestCachedBackend(_CountingBackend(), {})
+    b.fetch('pkg')['name'] = 'changed'
+    assert_equals(b.fetch('pkg')['name'], 'pkg')
+
+
+def test_request_cached_backend_write_invalidates_package():
+    wrapped = _CountingBackend()
+    b = backend.RequestCachedBackend(wrapped, {})
+
+    b.fetch('pkg')
+    b.fetch('other-pkg')
+    b.update('pkg', {})
+    b.fetch('pkg')
+    b.fetch('other-pkg')
+
+    assert_equals(wrapped.calls, [('fetch', 'pkg', None),
+                                  ('fetch', 'other-pkg', None),
+                                  ('update', 'pkg'),
+                                  ('fetch', 'pkg', None)])
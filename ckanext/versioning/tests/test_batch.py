@@ -0,0 +1,58 @@
+"""Tests for lib/batch.py
+"""
+from multiprocessing.pool import ThreadPool
+
+from nose.tools import assert_equals
+
+from ckanext.versioning.lib import batch, commits
+
+
+class TestBatchSession(object):
+
+    def setup(self):
+        self.pool = ThreadPool(2)
+        self.session = batch.BatchSession()
+
+    def teardown(self):
+        self.pool.close()
+
+    def test_record_keeps_one_change_per_dataset(self):
+        self.session.record('pkg-1', commits.UPDATE, 'user-1')
+        self.session.record('pkg-2', commits.CREATE, 'user-1')
+        self.session.record('pkg-1', commits.UPDATE, 'user-2')
+        self.session.record('pkg-2', commits.UPDATE, 'user-2')
+
+        assert_equals(self.session.changes(), [('pkg-1', commits.UPDATE, 'user-1'),
+                                               ('pkg-2', commits.CREATE, 'user-1')])
+
+    def test_discard(self):
+        self.session.record('pkg-1', commits.UPDATE, 'user')
+        self.session.discard('pkg-1')
+        assert_equals(len(self.session), 0)
+
+    def test_commit(self):
+        for i in range(5):
+            self.session.record('pkg-{}'.format(i), commits.UPDATE, 'user')
+        committed = []
+        progress = []
+
+        def convert(package_id, operation, author):
+            if package_id == 'pkg-0':
+                return None
+            if package_id == 'pkg-1':
+                raise RuntimeError('Not found')
+            return package_id, operation
+
+        def commit(package_id, operation):
+            if package_id == 'pkg-2':
+                raise RuntimeError('Backend is down')
+            committed.append(package_id)
+            return package_id != 'pkg-3'
+
+        summary = self.session.commit(convert, commit, self.pool, chunk_size=2,
+                                      progress=lambda done, total: progress.append((done, total)))
+
+        assert_equals(summary, {'datasets': 5, 'committed': 1, 'unchanged': 1, 'skipped': 1,
+                                'failed': ['pkg-1', 'pkg-2']})
+        assert_equals(sorted(committed), ['pkg-3', 'pkg-4'])
+        assert_equals(progress, [(2, 5), (4, 5), (5, 5)])
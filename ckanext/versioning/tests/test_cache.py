@@ -0,0 +1,81 @@
+"""Tests for lib/cache.py
+"""
+import json
+
+from nose.tools import assert_equals, assert_in, assert_is_none, assert_not_in
+
+from ckanext.versioning.lib import cache
+
+
+def test_lru_cache_get_set():
+    c = cache.LRUCache(1024)
+    c.set(('pkg', 'rev-1'), {'name': 'pkg', 'resources': [{'id': 'r-1'}]})
+
+    assert_equals(c.get(('pkg', 'rev-1')), {'name': 'pkg', 'resources': [{'id': 'r-1'}]})
+    assert_is_none(c.get(('pkg', 'rev-2')))
+    assert_equals(c.stats.as_dict(), {'hits': 1, 'misses': 1, 'evictions': 0})
+
+
+def test_lru_cache_returns_copies():
+    c = cache.LRUCache(1024)
+    c.set('key', {'resources': [{'id': 'r-1'}]})
+
+    c.get('key')['resources'].append({'id': 'r-2'})
+    assert_equals(c.get('key'), {'resources': [{'id': 'r-1'}]})
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    value = {'notes': 'x' * 100}
+    value_size = len(json.dumps(value))
+    c = cache.LRUCache(value_size * 3)
+
+    c.set('a', value)
+    c.set('b', value)
+    c.set('c', value)
+    c.get('a')
+    c.set('d', value)
+
+    assert_in('a', c)
+    assert_not_in('b', c)
+    assert_equals(len(c), 3)
+    assert_equals(c.size, value_size * 3)
+    assert_equals(c.stats.evictions, 1)
+
+
+def test_lru_cache_ignores_values_larger_than_max_size():
+    c = cache.LRUCache(10)
+    c.set('key', {'notes': 'x' * 100})
+    assert_not_in('key', c)
+
+
+def test_lru_cache_disabled_with_zero_size():
+    c = cache.LRUCache(0)
+    c.set('key', {})
+    assert_is_none(c.get('key'))
+
+
+def test_lru_cache_delete_if():
+    c = cache.LRUCache(1024)
+    c.set(('pkg-1', 'rev-1'), 'a')
+    c.set(('pkg-1', 'rev-2'), 'b')
+    c.set(('pkg-2', 'rev-1'), 'c')
+
+    c.delete_if(lambda key: key[0] == 'pkg-1')
+
+    assert_equals(len(c), 1)
+    assert_equals(c.get(('pkg-2', 'rev-1')), 'c')
+    assert_equals(c.size, len(json.dumps('c')))
+
+
+def test_tiered_cache_promotes_values_from_second_tier():
+    first = cache.LRUCache(1024)
+    second = cache.LRUCache(1024)
+    tiered = cache.TieredCache(first, second)
+
+    second.set('key', {'name': 'pkg'})
+    assert_equals(tiered.get('key'), {'name': 'pkg'})
+    assert_in('key', first)
+
+    tiered.set('other', {'name': 'other'})
+    assert_in('other', first)
+    assert_in('other', second)
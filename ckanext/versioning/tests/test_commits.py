@@ -0,0 +1,81 @@
+"""Tests for lib/commits.py
+"""
+from metastore.types import Author
+from nose.tools import assert_equals, assert_is_none
+
+from ckanext.versioning.lib import commits
+from ckanext.versioning.lib.cache import LRUCache
+
+
+class _PackageInfo(object):
+
+    def __init__(self, package_id, revision):
+        self.package_id = package_id
+        self.revision = revision
+
+
+class _Backend(object):
+    """A fake metastore backend keeping the latest revision of each package
+    """
+
+    def __init__(self):
+        self.heads = {}
+        self.commits = 0
+
+    def create(self, package_id, metadata, author=None, message=None):
+        return self._commit(package_id)
+
+    def update(self, package_id, metadata, author=None, message=None):
+        return self._commit(package_id)
+
+    def fetch(self, package_id, revision_ref=None):
+        raise AssertionError('The datapackage should not be fetched')
+
+    def revision_list(self, package_id):
+        return [_PackageInfo(package_id, self.heads[package_id])]
+
+    def _commit(self, package_id):
+        self.commits += 1
+        self.heads[package_id] = 'rev-{}'.format(self.commits)
+        return _PackageInfo(package_id, self.heads[package_id])
+
+
+class TestCommitDatapackage(object):
+
+    def setup(self):
+        self.backend = _Backend()
+        self.head_hashes = commits.HeadHashes(LRUCache(1024 * 1024))
+        self.author = Author('user', None)
+
+    def _commit(self, operation, datapackage):
+        return commits.commit_datapackage(self.backend, 'pkg', operation, datapackage, self.author,
+                                          self.head_hashes)
+
+    def test_unchanged_update_is_skipped(self):
+        self._commit(commits.CREATE, {'title': 'Title'})
+        assert_is_none(self._commit(commits.UPDATE, {'title': 'Title', 'metadata_modified': '2020-01-01'}))
+        assert_equals(self.backend.commits, 1)
+
+    def test_changed_update_is_committed(self):
+        self._commit(commits.CREATE, {'title': 'Title'})
+        pkg_info = self._commit(commits.UPDATE, {'title': 'New Title'})
+        assert_equals(pkg_info.revision, 'rev-2')
+        assert_is_none(self._commit(commits.UPDATE, {'title': 'New Title'}))
+
+    def test_update_is_committed_if_head_moved(self):
+        self._commit(commits.CREATE, {'title': 'Title'})
+        # Another process committed a different revision
+        self.backend.update('pkg', {'title': 'Other Title'})
+
+        pkg_info = self._commit(commits.UPDATE, {'title': 'Title'})
+        assert_equals(pkg_info.revision, 'rev-3')
+
+    def test_update_is_committed_if_hash_unknown(self):
+        self.backend.create('pkg', {'title': 'Title'})
+        pkg_info = self._commit(commits.UPDATE, {'title': 'Title'})
+        assert_equals(pkg_info.revision, 'rev-2')
+
+    def test_without_head_hashes_always_commits(self):
+        commits.commit_datapackage(self.backend, 'pkg', commits.CREATE, {'title': 'Title'}, self.author)
+        commits.commit_datapackage(self.backend, 'pkg', commits.UPDATE, {'title': 'Title'}, self.author)
+        assert_equals(self.backend.commits, 2)
@@ -1,6 +1,8 @@
 """Datapackage formatting related tests
 """
-from nose.tools import assert_equals
+import multiprocessing
+
+from nose.tools import assert_equals, assert_is_none, assert_not_equals
 from parameterized import parameterized
 
 from ckanext.versioning import datapackage
@@ -64,3 +66,163 @@ def test_resource_path_conflicting_paths_fixed():
     assert_equals(resources[2]['path'], 'data/foo-2.csv')
     assert_equals(resources[3]['path'], 'data/foo-3.csv')
     assert_equals(resources[4]['path'], 'data/foo-4.csv')
+
+
+def test_resource_path_suffixed_paths_are_unique():
+    dataset = {
+        "name": "my package",
+        "resources": [{"path": "data/foo.csv", "id": "r-1"},
+                      {"path": "data/foo.csv", "id": "r-2"},
+                      {"path": "data/foo-1.csv", "id": "r-3"},
+                      {"path": "data/foo-1-2.csv", "id": "r-4"},
+                      {"path": "data/foo-1.csv", "id": "r-5"}]
+    }
+    paths = [r['path'] for r in datapackage.dataset_to_frictionless(dataset)['resources']]
+    assert_equals(paths, ['data/foo.csv', 'data/foo-1-3.csv', 'data/foo-1.csv', 'data/foo-1-2.csv',
+                          'data/foo-1-4.csv'])
+
+
+def test_resource_path_unique_paths_are_stable():
+    resources = [{"path": "data/foo.csv", "id": "r-1"},
+                 {"path": "data/bar.csv", "id": "r-2"},
+                 {"path": "data/foo-2.csv", "id": "r-3"}]
+    before = datapackage.dataset_to_frictionless({"name": "my package", "resources": resources})
+    after = datapackage.dataset_to_frictionless({"name": "my package",
+                                                 "resources": resources + [{"path": "data/foo.csv", "id": "r-4"}]})
+    assert_equals(after['resources'][:3], before['resources'])
+    assert_equals(after['resources'][3]['path'], 'data/foo-3.csv')
+
+
+@parameterized([
+    ('data/foo.csv', 'data/foo-1.csv'),
+    ('data/foo', 'data/foo-1'),
+    ('data.v2/foo', 'data.v2/foo-1'),
+    ('data.v2/foo.tar.gz', 'data.v2/foo.tar-1.gz'),
+])
+def test_add_filename_suffix(path, expected):
+    assert_equals(datapackage._add_filename_suffix(path, '-1'), expected)
+
+
+def test_datapackage_hash_ignores_key_order():
+    package_1 = {"name": "my-package", "title": "My Package", "resources": [{"path": "a.csv", "name": "a"}]}
+    package_2 = {"resources": [{"name": "a", "path": "a.csv"}], "title": "My Package", "name": "my-package"}
+    assert_equals(datapackage.datapackage_hash(package_1), datapackage.datapackage_hash(package_2))
+
+
+def test_datapackage_hash_ignores_volatile_fields():
+    package_1 = {"name": "my-package", "metadata_modified": "2020-01-01T00:00:00",
+                 "resources": [{"path": "a.csv", "tracking_summary": {"total": 1}}]}
+    package_2 = {"name": "my-package", "metadata_modified": "2020-02-01T00:00:00",
+                 "resources": [{"path": "a.csv", "tracking_summary": {"total": 5}}]}
+    assert_equals(datapackage.datapackage_hash(package_1), datapackage.datapackage_hash(package_2))
+
+
+def test_datapackage_hash_changes_with_content():
+    package_1 = {"name": "my-package", "resources": [{"path": "a.csv"}]}
+    package_2 = {"name": "my-package", "resources": [{"path": "b.csv"}]}
+    assert datapackage.datapackage_hash(package_1) != datapackage.datapackage_hash(package_2)
+
+
+def test_datapackage_hash_without_ignored_fields():
+    package_1 = {"name": "my-package", "metadata_modified": "2020-01-01T00:00:00"}
+    package_2 = {"name": "my-package", "metadata_modified": "2020-02-01T00:00:00"}
+    assert (datapackage.datapackage_hash(package_1, ignored_fields=()) !=
+            datapackage.datapackage_hash(package_2, ignored_fields=()))
+
+
+def test_prepare_dataset_gives_same_package_dict():
+    package = {"name": "my-package",
+               "title": "My Package",
+               "version": "1.0",
+               "custom": "value",
+               "resources": [{"path": "data/foo.csv", "name": "foo"}]}
+    prepared = datapackage.prepare_dataset(dict(package, extras=[{"key": "title", "value": "Other"}]))
+    assert_equals(prepared['extras'], [{"key": "custom", "value": "value"}])
+
+    live = {"id": "package-id", "name": "my-package", "notes": "Notes"}
+    assert_equals(datapackage.update_ckan_dict(dict(live), datapackage.prepare_dataset(package)),
+                  datapackage.update_ckan_dict(dict(live), datapackage.frictionless_to_dataset(package)))
+
+
+def test_excluded_fields_are_removed():
+    dataset = {"name": "my-package",
+               "metadata_modified": "2020-01-01T00:00:00",
+               "tracking_summary": {"total": 1, "recent": 1},
+               "resources": [{"url": "data/foo.csv", "id": "r-1", "tracking_summary": {"total": 1, "recent": 1}}]}
+    result = datapackage.dataset_to_frictionless(dataset, ('metadata_modified', 'tracking_summary'))
+    assert_equals(result, {"name": "my-package", "resources": [{"path": "data/foo.csv", "id": "r-1"}]})
+    assert 'tracking_summary' in dataset['resources'][0]
+
+
+def test_resource_conversion_cache_output_is_identical():
+    dataset = {
+        "id": "package-id",
+        "name": "my package",
+        "resources": [{"url": "data/foo.csv", "name": "resource 1", "id": "resource-1"},
+                      {"url": "data/foo.csv", "name": "resource 2", "id": "resource-2"},
+                      {"path": "/an/../existing/path.csv", "name": "resource 3", "id": "resource-3"},
+                      {"name": "my-resource", "format": "xls", "sha256": SHA256, "id": "resource-4"}]
+    }
+    cache = datapackage.ResourceConversionCache()
+
+    for resources in (dataset['resources'],
+                      dataset['resources'] + [{"url": "data/foo.csv", "name": "resource 5", "id": "resource-5"}],
+                      [{"url": "data/bar.csv", "name": "resource 0", "id": "resource-0"}] + dataset['resources'],
+                      dataset['resources'][2:]):
+        changed = dict(dataset, resources=resources)
+        expected = datapackage.dataset_to_frictionless(changed)
+        assert_equals(datapackage.dataset_to_frictionless(changed, resource_cache=cache), expected)
+
+
+def test_resource_conversion_cache_converts_changed_resources_only():
+    dataset = {"id": "package-id",
+               "name": "my package",
+               "resources": [{"url": "data/{}.csv".format(i), "id": "resource-{}".format(i)} for i in range(10)]}
+    cache = datapackage.ResourceConversionCache()
+    datapackage.dataset_to_frictionless(dataset, resource_cache=cache)
+
+    dataset['resources'][3] = dict(dataset['resources'][3], name='changed')
+    cache.stats.reset()
+    result = datapackage.dataset_to_frictionless(dataset, resource_cache=cache)
+
+    assert_equals(cache.stats.as_dict(), {'hits': 9, 'misses': 1, 'evictions': 0})
+    assert_equals(result['resources'][3]['name'], 'changed')
+
+
+class TestParallelConverter(object):
+
+    def setup(self):
+        self.converter = datapackage.ParallelConverter(2, threshold=5)
+        self.dataset = {
+            "id": "package-id",
+            "name": "my package",
+            "resources": [{"url": "data/{}.csv".format(i % 4), "name": "resource {}".format(i),
+                           "id": "resource-{}".format(i)} for i in range(11)]
+        }
+
+    def teardown(self):
+        self.converter.close()
+
+    def test_map_keeps_order(self):
+        assert_equals(self.converter.map(str, list(range(23))), [str(i) for i in range(23)])
+
+    def test_pool_is_not_forked_from_calling_process(self):
+        if not hasattr(multiprocessing, 'get_context'):
+            return
+        assert_not_equals(datapackage._get_pool_context().get_start_method(), 'fork')
+
+    def test_map_below_threshold_is_serial(self):
+        assert_equals(self.converter.map(str, [1, 2, 3]), ['1', '2', '3'])
+        assert_is_none(self.converter._pool)
+
+    def test_dataset_to_frictionless(self):
+        expected = datapackage.dataset_to_frictionless(self.dataset)
+        assert_equals(datapackage.dataset_to_frictionless(self.dataset, converter=self.converter), expected)
+        cache = datapackage.ResourceConversionCache()
+        assert_equals(datapackage.dataset_to_frictionless(self.dataset, resource_cache=cache, converter=self.converter),
+                      expected)
+
+    def test_frictionless_to_dataset(self):
+        package = datapackage.dataset_to_frictionless(self.dataset)
+        assert_equals(datapackage.frictionless_to_dataset(package, self.converter),
+                      datapackage.frictionless_to_dataset(package))
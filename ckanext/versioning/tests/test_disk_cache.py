@@ -0,0 +1,51 @@
+"""Tests for lib/disk_cache.py
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals, assert_in, assert_is_none, assert_not_in
+
+from ckanext.versioning.lib import disk_cache
+
+
+class TestSQLiteCache(object):
+
+    def setup(self):
+        self._dir = tempfile.mkdtemp()
+        self.path = os.path.join(self._dir, 'cache', 'revisions.sqlite')
+
+    def teardown(self):
+        shutil.rmtree(self._dir)
+
+    def test_get_set(self):
+        cache = disk_cache.SQLiteCache(self.path, 1024)
+        cache.set(('pkg', 'rev-1'), {'name': 'pkg'})
+
+        assert_equals(cache.get(('pkg', 'rev-1')), {'name': 'pkg'})
+        assert_is_none(cache.get(('pkg', 'rev-2')))
+        assert_equals(cache.stats.as_dict(), {'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_values_survive_new_instance(self):
+        disk_cache.SQLiteCache(self.path, 1024).set(('pkg', 'rev-1'), {'name': 'pkg'})
+        assert_equals(disk_cache.SQLiteCache(self.path, 1024).get(('pkg', 'rev-1')), {'name': 'pkg'})
+
+    def test_evicts_least_recently_accessed(self):
+        value = {'notes': 'x' * 100}
+        cache = disk_cache.SQLiteCache(self.path, len(json.dumps(value)) * 2)
+
+        cache.set('a', value)
+        cache.set('b', value)
+        cache.set('c', value)
+
+        assert_not_in('a', cache)
+        assert_in('b', cache)
+        assert_in('c', cache)
+        assert_equals(cache.stats.evictions, 1)
+
+    def test_delete(self):
+        cache = disk_cache.SQLiteCache(self.path, 1024)
+        cache.set('a', {})
+        cache.delete('a')
+        assert_not_in('a', cache)
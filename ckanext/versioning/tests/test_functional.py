@@ -1,8 +1,10 @@
 from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckan.tests import helpers as test_helpers
-from nose.tools import assert_in
+from nose.tools import assert_equals, assert_in, assert_not_in
 
+from ckanext.versioning.common import get_fragment_cache
+from ckanext.versioning.logic import helpers
 from ckanext.versioning.tests import MetastoreBackendTestBase
 
 
@@ -65,6 +67,23 @@ class TestPackageShow(MetastoreBackendTestBase):
 
         assert_in(original_notes, res.ubody)
 
+    def test_package_show_unreleased_revision_has_no_release_controls(self):
+        app = self._get_test_app()
+        sysadmin = factories.Sysadmin()
+        revision_ref = helpers.get_dataset_current_revision(self.dataset['name'])
+
+        url = toolkit.url_for(
+            'versioning.show',
+            package_id=self.dataset['id'],
+            revision_ref=revision_ref)
+        environ = {'REMOTE_USER': sysadmin['name'].encode('utf8')}
+        res = app.get(url, extra_environ=environ)
+
+        assert_in(self.dataset['name'], res.ubody)
+        assert_not_in('version {}'.format(revision_ref), res.ubody)
+        assert_not_in('Delete Version', res.ubody)
+        assert_not_in('Revert to this Version', res.ubody)
+
     def test_package_show_renders_release_by_name(self):
         app = self._get_test_app()
         context = self._get_context(self.user)
@@ -123,3 +142,188 @@ class TestPackageShow(MetastoreBackendTestBase):
 
         assert_in('This is an old revision of this dataset', res.ubody)
         assert_in('module info alert alert-info', res.ubody)
+
+    def test_package_show_revision_is_cacheable(self):
+        app = self._get_test_app()
+        context = self._get_context(self.user)
+
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name="0.1.2")
+
+        url = toolkit.url_for(
+            'versioning.show',
+            package_id=self.dataset['id'],
+            revision_ref=release['revision_ref'])
+
+        res = app.get(url, status=200)
+        assert_in('immutable', res.headers['Cache-Control'])
+        assert_in('public', res.headers['Cache-Control'])
+
+        res = app.get(url, headers={'If-None-Match': res.headers['ETag']}, status=304)
+        assert_equals(res.body, b'')
+
+    def test_package_show_revision_of_private_dataset_is_not_public(self):
+        app = self._get_test_app()
+        org = factories.Organization(users=[{'name': self.user['name'], 'capacity': 'admin'}])
+        dataset = factories.Dataset(owner_org=org['id'])
+        revision_ref = helpers.get_dataset_current_revision(dataset['name'])
+
+        url = toolkit.url_for(
+            'versioning.show',
+            package_id=dataset['id'],
+            revision_ref=revision_ref)
+
+        res = app.get(url, status=200)
+        assert_in('public', res.headers['Cache-Control'])
+        etag = res.headers['ETag']
+
+        test_helpers.call_action(
+            'package_patch',
+            self._get_context(self.user),
+            id=dataset['id'],
+            private=True)
+
+        environ = {'REMOTE_USER': self.user_name}
+        res = app.get(url, extra_environ=environ, headers={'If-None-Match': etag}, status=200)
+        assert_equals(res.headers['Cache-Control'], 'private, no-cache')
+        assert_not_in('public', res.headers['Cache-Control'])
+
+    def test_package_show_release_by_name_is_revalidated(self):
+        app = self._get_test_app()
+        context = self._get_context(self.user)
+
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name="0.1.2")
+
+        url = toolkit.url_for(
+            'versioning.show',
+            package_id=self.dataset['id'],
+            revision_ref=release['name'])
+
+        environ = {'REMOTE_USER': self.user_name}
+        res = app.get(url, extra_environ=environ, status=200)
+        assert_equals(res.headers['Cache-Control'], 'private, no-cache')
+        etag = res.headers['ETag']
+
+        app.get(url, extra_environ=environ, headers={'If-None-Match': etag}, status=304)
+
+        test_helpers.call_action(
+            'dataset_release_update',
+            context,
+            dataset=self.dataset['id'],
+            release=release['name'],
+            name=release['name'],
+            description='A new description')
+
+        app.get(url, extra_environ=environ, headers={'If-None-Match': etag}, status=200)
+
+    def test_package_show_release_fragments_are_cached(self):
+        app = self._get_test_app()
+        context = self._get_context(self.user)
+
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name="0.1.2")
+
+        url = toolkit.url_for(
+            'versioning.show',
+            package_id=self.dataset['id'],
+            revision_ref=release['name'])
+
+        environ = {'REMOTE_USER': self.user_name}
+        first = app.get(url, extra_environ=environ, status=200)
+        assert len(get_fragment_cache()) > 0
+
+        second = app.get(url, extra_environ=environ, status=200)
+        assert_equals(first.ubody, second.ubody)
+
+        test_helpers.call_action(
+            'dataset_release_update',
+            context,
+            dataset=self.dataset['id'],
+            release=release['name'],
+            name='0.1.3')
+
+        url = toolkit.url_for(
+            'versioning.show',
+            package_id=self.dataset['id'],
+            revision_ref='0.1.3')
+        res = app.get(url, extra_environ=environ, status=200)
+        assert_in('0.1.3', res.ubody)
+
+
+class TestApiConditionalGet(MetastoreBackendTestBase):
+
+    def setup(self):
+        super(TestApiConditionalGet, self).setup()
+
+        self.user = factories.User()
+        self.dataset = factories.Dataset()
+
+    def test_package_show_revision_not_modified(self):
+        app = self._get_test_app()
+        revision_ref = helpers.get_dataset_current_revision(self.dataset['name'])
+
+        url = '/api/3/action/package_show?id={}&revision_ref={}'.format(self.dataset['id'], revision_ref)
+        res = app.get(url, status=200)
+        etag = res.headers['ETag']
+
+        res = app.get(url, headers={'If-None-Match': etag}, status=304)
+        assert_equals(res.body, b'')
+
+    def test_package_show_revision_with_tracking_has_no_etag(self):
+        app = self._get_test_app()
+        revision_ref = helpers.get_dataset_current_revision(self.dataset['name'])
+
+        url = '/api/3/action/package_show?id={}&revision_ref={}&include_tracking=true'.format(
+            self.dataset['id'], revision_ref)
+        res = app.get(url, status=200)
+        assert_not_in('ETag', res.headers)
+        assert_in('tracking_summary', res.json['result'])
+
+    def test_package_show_current_has_no_etag(self):
+        app = self._get_test_app()
+
+        url = '/api/3/action/package_show?id={}'.format(self.dataset['id'])
+        res = app.get(url, status=200)
+        assert_not_in('ETag', res.headers)
+
+    def test_package_show_release_etag_changes_when_release_moves(self):
+        app = self._get_test_app()
+        context = self._get_context(self.user)
+        release = test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        url = '/api/3/action/package_show_release?id={0}&dataset={0}&release={1}'.format(
+            self.dataset['id'], release['name'])
+        etag = app.get(url, status=200).headers['ETag']
+
+        test_helpers.call_action(
+            'package_patch',
+            context,
+            id=self.dataset['id'],
+            notes='Some changed notes',
+        )
+        test_helpers.call_action(
+            'dataset_release_delete',
+            context,
+            dataset=self.dataset['id'],
+            release=release['name'])
+        test_helpers.call_action(
+            'dataset_release_create',
+            context,
+            dataset=self.dataset['id'],
+            name='1.0')
+
+        app.get(url, headers={'If-None-Match': etag}, status=200)
@@ -64,3 +64,26 @@ class TestHelpers(MetastoreBackendTestBase):
 
         revision_list = helpers.get_dataset_revision_list(self.dataset['name'])
         assert_equals(len(revision_list), 2)
+
+    def test_get_dataset_revision_list_unchanged_update(self):
+        context = self._get_context(self.admin_user)
+        test_helpers.call_action(
+            'package_patch',
+            context,
+            id=self.dataset['id'],
+            notes=self.dataset['notes'])
+
+        revision_list = helpers.get_dataset_revision_list(self.dataset['name'])
+        assert_equals(len(revision_list), 1)
+
+    @test_helpers.change_config('ckanext.versioning.skip_unchanged_revisions', 'false')
+    def test_get_dataset_revision_list_unchanged_update_not_skipped(self):
+        context = self._get_context(self.admin_user)
+        test_helpers.call_action(
+            'package_patch',
+            context,
+            id=self.dataset['id'],
+            notes=self.dataset['notes'])
+
+        revision_list = helpers.get_dataset_revision_list(self.dataset['name'])
+        assert_equals(len(revision_list), 2)
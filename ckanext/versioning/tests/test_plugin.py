@@ -1,5 +1,13 @@
 """Tests for plugin.py."""
+from ckan.plugins import toolkit
+from ckan.tests import factories
+from ckan.tests import helpers as test_helpers
+from nose.tools import assert_equals
+
 import ckanext.versioning.plugin as plugin
+from ckanext.versioning.common import get_excluded_fields, get_metastore_backend
+from ckanext.versioning.datapackage import dataset_to_frictionless
+from ckanext.versioning.tests import MetastoreBackendTestBase
 
 
 def test_package_versioning_plugin():
@@ -7,3 +15,58 @@ def test_package_versioning_plugin():
     """
     p = plugin.PackageVersioningPlugin()
     assert p
+
+
+class TestAfterUpdate(MetastoreBackendTestBase):
+    """The datapackage committed after an update must be the same as the one
+    converted from the output of package_show
+    """
+
+    def setup(self):
+        super(TestAfterUpdate, self).setup()
+        self.user = factories.Sysadmin()
+        self.dataset = factories.Dataset(
+            tags=[{'name': 'b-tag'}, {'name': 'a-tag'}],
+            extras=[{'key': 'z-extra', 'value': '1'}, {'key': 'a-extra', 'value': '{"x": 2}'}],
+            resources=[{'url': 'https://example.com/data.csv', 'name': 'Data'}])
+
+    def _assert_committed_datapackage(self):
+        expected = dataset_to_frictionless(
+            toolkit.get_action('package_show')({}, {'id': self.dataset['id']}),
+            get_excluded_fields())
+        committed = get_metastore_backend().fetch(self.dataset['name']).package
+        assert_equals(committed, expected)
+
+    def test_package_patch(self):
+        test_helpers.call_action('package_patch', self._get_context(self.user),
+                                 id=self.dataset['id'], title='New Title')
+        self._assert_committed_datapackage()
+
+    def test_package_update_with_new_resource(self):
+        dataset = test_helpers.call_action('package_show', id=self.dataset['id'])
+        dataset['resources'].append({'url': 'https://example.com/more.csv', 'name': 'More Data'})
+        dataset['tag_string'] = 'c-tag,a-tag'
+        del dataset['tags']
+        dataset['extras'] = [{'key': 'a-extra', 'value': 'changed'}]
+        test_helpers.call_action('package_update', self._get_context(self.user), **dataset)
+        self._assert_committed_datapackage()
+
+    def test_package_patch_license_with_url(self):
+        test_helpers.call_action('package_patch', self._get_context(self.user),
+                                 id=self.dataset['id'], license_id='cc-by')
+        self._assert_committed_datapackage()
+
+    def test_package_patch_license_without_url(self):
+        test_helpers.call_action('package_patch', self._get_context(self.user),
+                                 id=self.dataset['id'], license_id='other-open')
+        self._assert_committed_datapackage()
+
+    def test_package_patch_license_not_in_registry(self):
+        test_helpers.call_action('package_patch', self._get_context(self.user),
+                                 id=self.dataset['id'], license_id='my-custom-license')
+        self._assert_committed_datapackage()
+
+    def test_resource_create(self):
+        test_helpers.call_action('resource_create', self._get_context(self.user),
+                                 package_id=self.dataset['id'], url='https://example.com/new.csv', name='New')
+        self._assert_committed_datapackage()
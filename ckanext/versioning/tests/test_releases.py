@@ -0,0 +1,185 @@
+"""Tests for lib/releases.py
+"""
+import threading
+import time
+
+from nose.tools import assert_equals, assert_is, assert_is_none
+
+from ckanext.versioning.lib import releases
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _release(name, revision_ref='abc123', created='2020-01-01T00:00:00+00:00'):
+    return {'name': name,
+            'revision_ref': revision_ref,
+            'package_id': 'my-dataset',
+            'created': created,
+            'author': 'someone',
+            'author_email': 'someone@example.com',
+            'description': 'Release {}'.format(name)}
+
+
+def test_release_cache_get_set():
+    cache = releases.ReleaseCache()
+    cache.set('my-dataset', _release('1.0'))
+
+    assert_equals(cache.get('my-dataset', '1.0'), _release('1.0'))
+    assert_is_none(cache.get('my-dataset', '2.0'))
+    assert_is_none(cache.get('other-dataset', '1.0'))
+
+
+def test_release_cache_returns_copies():
+    cache = releases.ReleaseCache()
+    cache.set('my-dataset', _release('1.0'))
+    cache.get('my-dataset', '1.0')['name'] = 'changed'
+    assert_equals(cache.get('my-dataset', '1.0')['name'], '1.0')
+
+
+def test_release_cache_entries_expire():
+    clock = _Clock()
+    cache = releases.ReleaseCache(ttl=60, negative_ttl=5, clock=clock)
+    cache.set('my-dataset', _release('1.0'))
+    cache.set_not_found('my-dataset', '2.0')
+
+    assert_is(cache.get('my-dataset', '2.0'), releases.NOT_FOUND)
+
+    clock.now += 10
+    assert_is_none(cache.get('my-dataset', '2.0'))
+    assert_equals(cache.get('my-dataset', '1.0'), _release('1.0'))
+
+    clock.now += 60
+    assert_is_none(cache.get('my-dataset', '1.0'))
+
+
+def test_release_cache_invalidation():
+    cache = releases.ReleaseCache()
+    cache.set('my-dataset', _release('1.0'))
+    cache.set('my-dataset', _release('1.1'))
+
+    cache.delete('my-dataset', '1.0')
+    assert_is_none(cache.get('my-dataset', '1.0'))
+    assert_equals(cache.get('my-dataset', '1.1'), _release('1.1'))
+
+    cache.invalidate('my-dataset')
+    assert_is_none(cache.get('my-dataset', '1.1'))
+
+
+def test_release_cache_list_fresh_and_stale():
+    clock = _Clock()
+    cache = releases.ReleaseCache(list_ttl=60, list_stale_ttl=600, clock=clock)
+    cache.set_list('my-dataset', [_release('1.0'), _release('1.1')])
+
+    assert_equals(cache.get_list('my-dataset'), ([_release('1.0'), _release('1.1')], True))
+    assert_equals(cache.get('my-dataset', '1.1'), _release('1.1'))
+
+    clock.now += 100
+    assert_equals(cache.get_list('my-dataset'), ([_release('1.0'), _release('1.1')], False))
+
+    clock.now += 600
+    assert_equals(cache.get_list('my-dataset'), (None, False))
+
+
+def test_release_cache_list_invalidation():
+    cache = releases.ReleaseCache()
+    generation = cache.generation('my-dataset')
+    cache.set_list('my-dataset', [_release('1.0')])
+
+    cache.invalidate_list('my-dataset')
+    assert_equals(cache.get_list('my-dataset'), (None, False))
+
+    # A list loaded before invalidation is outdated, and is not cached
+    cache.set_list('my-dataset', [_release('1.0')], generation=generation)
+    assert_equals(cache.get_list('my-dataset'), (None, False))
+
+
+def test_release_cache_refresh_list():
+    cache = releases.ReleaseCache()
+    loaded = threading.Event()
+
+    def loader(dataset):
+        loaded.set()
+        return [_release('2.0')]
+
+    cache.refresh_list('my-dataset', loader)
+    loaded.wait(5)
+    for _ in range(100):
+        if cache.get_list('my-dataset')[0] is not None:
+            break
+        time.sleep(0.01)
+
+    assert_equals(cache.get_list('my-dataset'), ([_release('2.0')], True))
+
+
+def test_release_cache_get_by_revision():
+    cache = releases.ReleaseCache()
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1'), (None, False))
+
+    cache.set_list('my-dataset', [_release('1.0', 'rev-1', '2020-01-01T00:00:00+00:00'),
+                                  _release('1.0-copy', 'rev-1', '2020-01-02T00:00:00+00:00'),
+                                  _release('2.0', 'rev-2', '2020-01-03T00:00:00+00:00')])
+
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1')[0]['name'], '1.0')
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-2')[0]['name'], '2.0')
+    assert_is(cache.get_by_revision('my-dataset', 'rev-3')[0], releases.NOT_FOUND)
+
+
+def test_release_cache_keeps_index_up_to_date():
+    cache = releases.ReleaseCache()
+    cache.set_list('my-dataset', [_release('1.0', 'rev-1', '2020-01-01T00:00:00+00:00')])
+
+    cache.release_created('my-dataset', _release('2.0', 'rev-2', '2020-01-03T00:00:00+00:00'))
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-2')[0]['name'], '2.0')
+
+    cache.release_updated('my-dataset', '1.0', _release('1.1', 'rev-1', '2020-01-02T00:00:00+00:00'))
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1')[0]['name'], '1.1')
+    assert_is_none(cache.get('my-dataset', '1.0'))
+    assert_equals([r['name'] for r in cache.get_list('my-dataset')[0]], ['1.1', '2.0'])
+
+    cache.release_deleted('my-dataset', '2.0')
+    assert_is(cache.get_by_revision('my-dataset', 'rev-2')[0], releases.NOT_FOUND)
+    assert_equals([r['name'] for r in cache.get_list('my-dataset')[0]], ['1.1'])
+
+
+def test_release_cache_get_by_revision_fresh_and_stale():
+    clock = _Clock()
+    cache = releases.ReleaseCache(list_ttl=60, list_stale_ttl=600, clock=clock)
+    cache.set_list('my-dataset', [_release('1.0', 'rev-1')])
+
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1'), (_release('1.0', 'rev-1'), True))
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-2'), (releases.NOT_FOUND, True))
+
+    clock.now += 100
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1'), (_release('1.0', 'rev-1'), False))
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-2'), (releases.NOT_FOUND, False))
+
+    clock.now += 600
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1'), (None, False))
+
+
+def test_release_cache_index_falls_back_to_next_oldest_release():
+    cache = releases.ReleaseCache()
+    cache.set_list('my-dataset', [_release('1.0', 'rev-1', '2020-01-01T00:00:00+00:00'),
+                                  _release('1.0-copy', 'rev-1', '2020-01-02T00:00:00+00:00')])
+
+    cache.release_created('my-dataset', _release('0.9', 'rev-1', '2019-12-01T00:00:00+00:00'))
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1')[0]['name'], '0.9')
+
+    cache.release_deleted('my-dataset', '0.9')
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1')[0]['name'], '1.0')
+    cache.release_deleted('my-dataset', '1.0-copy')
+    assert_equals(cache.get_by_revision('my-dataset', 'rev-1')[0]['name'], '1.0')
+    cache.release_deleted('my-dataset', '1.0')
+    assert_is(cache.get_by_revision('my-dataset', 'rev-1')[0], releases.NOT_FOUND)
+
+
+def test_release_record_round_trip():
+    record = releases.ReleaseRecord.from_dict(_release('1.0'))
+    assert_equals(record.to_dict(), _release('1.0'))
@@ -0,0 +1,315 @@
+"""Tests for lib/write_queue.py
+"""
+import os
+import shutil
+import tempfile
+import time
+
+from metastore.types import Author
+from nose.tools import assert_equals, assert_false, assert_is_none, assert_true
+
+from ckanext.versioning.lib import commits, write_queue
+
+
+class _Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class _PackageInfo(object):
+
+    def __init__(self, package_id, revision):
+        self.package_id = package_id
+        self.revision = revision
+
+
+class _Backend(object):
+    """A fake metastore backend recording commits
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.commits = []
+        self.messages = []
+
+    def create(self, package_id, metadata, author=None, message=None):
+        return self._commit('create', package_id, metadata, author, message)
+
+    def update(self, package_id, metadata, author=None, message=None):
+        return self._commit('update', package_id, metadata, author, message)
+
+    def _commit(self, operation, package_id, metadata, author, message):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('Backend is down')
+        self.commits.append((operation, package_id, metadata['title'], author.name))
+        self.messages.append(message)
+        return _PackageInfo(package_id, 'rev-{}'.format(len(self.commits)))
+
+
+class _QueueTests(object):
+    """Tests shared by all queue implementations
+    """
+
+    def _queue(self):
+        raise NotImplementedError()
+
+    def test_claim_in_order(self):
+        queue = self._queue()
+        first = queue.put('pkg', commits.CREATE, {'title': '1'}, 'user')
+        queue.put('pkg', commits.UPDATE, {'title': '2'}, 'user')
+
+        job = queue.claim()
+        assert_equals(job.id, first)
+        assert_equals(job.datapackage, {'title': '1'})
+        assert_equals(job.operation, commits.CREATE)
+
+        # The next job of the same dataset waits for the first one
+        assert_is_none(queue.claim())
+
+        queue.complete(job.id)
+        assert_equals(queue.claim().datapackage, {'title': '2'})
+
+    def test_datasets_are_independent(self):
+        queue = self._queue()
+        queue.put('pkg-1', commits.UPDATE, {'title': '1'})
+        queue.put('pkg-2', commits.UPDATE, {'title': '2'})
+
+        assert_equals(queue.claim().dataset, 'pkg-1')
+        assert_equals(queue.claim().dataset, 'pkg-2')
+        assert_is_none(queue.claim())
+
+    def test_claim_dataset(self):
+        queue = self._queue()
+        queue.put('pkg-1', commits.UPDATE, {'title': '1'})
+        queue.put('pkg-2', commits.UPDATE, {'title': '2'})
+
+        assert_equals(queue.claim('pkg-2').dataset, 'pkg-2')
+        assert_equals(queue.pending(), 2)
+        assert_equals(queue.pending('pkg-2'), 1)
+
+    def test_retry_delays_job(self):
+        queue = self._queue()
+        job_id = queue.put('pkg', commits.UPDATE, {'title': '1'})
+        queue.retry(queue.claim().id, 10)
+
+        assert_is_none(queue.claim())
+        assert_equals(queue.claim(ignore_delay=True).id, job_id)
+
+        queue.retry(job_id, 10)
+        self.clock.now += 11
+        job = queue.claim()
+        assert_equals(job.id, job_id)
+        assert_equals(job.attempts, 2)
+
+    def test_claim_expires(self):
+        queue = self._queue()
+        job_id = queue.put('pkg', commits.UPDATE, {'title': '1'})
+        queue.claim()
+
+        self.clock.now += 301
+        assert_equals(queue.claim().id, job_id)
+
+    def test_failed_jobs_do_not_block(self):
+        queue = self._queue()
+        failed = queue.put('pkg', commits.UPDATE, {'title': '1'})
+        queue.put('pkg', commits.UPDATE, {'title': '2'})
+        queue.fail(queue.claim().id)
+
+        job = queue.claim()
+        assert_true(job.id != failed)
+        assert_equals(queue.pending(), 1)
+
+    def test_discard(self):
+        queue = self._queue()
+        queue.put('pkg-1', commits.UPDATE, {'title': '1'})
+        queue.put('pkg-2', commits.UPDATE, {'title': '2'})
+        queue.discard('pkg-1')
+
+        assert_equals(queue.pending('pkg-1'), 0)
+        assert_equals(queue.pending(), 1)
+
+    def test_delayed_updates_are_merged(self):
+        queue = self._queue()
+        job_id = queue.put('pkg', commits.CREATE, {'title': '1'}, 'user-1', delay=10)
+        self.clock.now += 5
+        assert_equals(queue.put('pkg', commits.UPDATE, {'title': '2'}, 'user-2', delay=10), job_id)
+        assert_equals(queue.put('pkg', commits.UPDATE, {'title': '3'}, 'user-1', delay=10), job_id)
+
+        # The window restarts with each update
+        self.clock.now += 6
+        assert_is_none(queue.claim())
+        self.clock.now += 5
+        job = queue.claim()
+        assert_equals(job.id, job_id)
+        assert_equals(job.operation, commits.CREATE)
+        assert_equals(job.datapackage, {'title': '3'})
+        assert_equals(job.author_name, 'user-1')
+        assert_equals(job.co_authors, [('user-2', None)])
+        assert_equals(queue.pending(), 1)
+
+    def test_merge_delay_is_bounded(self):
+        queue = self._queue()
+        queue.put('pkg', commits.UPDATE, {'title': '1'}, delay=10, max_delay=15)
+        self.clock.now += 9
+        queue.put('pkg', commits.UPDATE, {'title': '2'}, delay=10, max_delay=15)
+
+        self.clock.now += 6
+        assert_equals(queue.claim().datapackage, {'title': '2'})
+
+    def test_updates_are_not_merged_into_claimed_job(self):
+        queue = self._queue()
+        first = queue.put('pkg', commits.UPDATE, {'title': '1'}, delay=10)
+        queue.claim(ignore_delay=True)
+
+        assert_true(queue.put('pkg', commits.UPDATE, {'title': '2'}, delay=10) != first)
+        assert_equals(queue.pending(), 2)
+
+
+class TestMemoryWriteQueue(_QueueTests):
+
+    def setup(self):
+        self.clock = _Clock()
+
+    def _queue(self):
+        return write_queue.MemoryWriteQueue(clock=self.clock)
+
+
+class TestSQLiteWriteQueue(_QueueTests):
+
+    def setup(self):
+        self.clock = _Clock()
+        self._dir = tempfile.mkdtemp()
+        self.path = os.path.join(self._dir, 'queue', 'writes.sqlite')
+
+    def teardown(self):
+        shutil.rmtree(self._dir)
+
+    def _queue(self):
+        return write_queue.SQLiteWriteQueue(self.path, clock=self.clock)
+
+    def test_jobs_survive_new_instance(self):
+        self._queue().put('pkg', commits.UPDATE, {'title': '1'}, 'user', 'user@example.com')
+
+        job = self._queue().claim()
+        assert_equals(job.datapackage, {'title': '1'})
+        assert_equals((job.author_name, job.author_email), ('user', 'user@example.com'))
+
+
+class TestWriteBehindQueue(object):
+
+    def setup(self):
+        self.clock = _Clock()
+        self.queue = write_queue.MemoryWriteQueue(clock=self.clock)
+
+    def _write_behind(self, backend, **kwargs):
+        return write_queue.WriteBehindQueue(self.queue, lambda: backend, **kwargs)
+
+    def test_process_next_commits_in_order(self):
+        backend = _Backend()
+        write_behind = self._write_behind(backend)
+        self.queue.put('pkg', commits.CREATE, {'title': '1'}, 'user')
+        self.queue.put('pkg', commits.UPDATE, {'title': '2'}, 'user')
+
+        assert_true(write_behind.process_next())
+        assert_true(write_behind.process_next())
+        assert_false(write_behind.process_next())
+        assert_equals(backend.commits, [('create', 'pkg', '1', 'user'), ('update', 'pkg', '2', 'user')])
+
+    def test_failed_commit_is_retried_with_backoff(self):
+        backend = _Backend(failures=2)
+        write_behind = self._write_behind(backend, retry_delay=5)
+        self.queue.put('pkg', commits.UPDATE, {'title': '1'}, 'user')
+
+        assert_true(write_behind.process_next())
+        assert_false(write_behind.process_next())
+
+        self.clock.now += 5
+        assert_true(write_behind.process_next())
+        self.clock.now += 5
+        assert_false(write_behind.process_next())
+
+        self.clock.now += 5
+        assert_true(write_behind.process_next())
+        assert_equals(backend.commits, [('update', 'pkg', '1', 'user')])
+
+    def test_gives_up_after_max_attempts(self):
+        backend = _Backend(failures=2)
+        write_behind = self._write_behind(backend, max_attempts=2, retry_delay=0)
+        self.queue.put('pkg', commits.UPDATE, {'title': '1'}, 'user')
+
+        assert_true(write_behind.process_next())
+        assert_true(write_behind.process_next())
+        assert_false(write_behind.process_next())
+        assert_equals(self.queue.pending(), 0)
+        assert_equals(backend.commits, [])
+
+    def test_flush(self):
+        backend = _Backend()
+        write_behind = self._write_behind(backend)
+        self.queue.put('pkg-1', commits.UPDATE, {'title': '1'}, 'user')
+        self.queue.put('pkg-2', commits.UPDATE, {'title': '2'}, 'user')
+        self.queue.put('pkg-1', commits.UPDATE, {'title': '3'}, 'user')
+
+        assert_true(write_behind.flush('pkg-1'))
+        assert_equals(backend.commits, [('update', 'pkg-1', '1', 'user'), ('update', 'pkg-1', '3', 'user')])
+        assert_equals(self.queue.pending(), 1)
+
+    def test_flush_fails(self):
+        write_behind = self._write_behind(_Backend(failures=1))
+        self.queue.put('pkg', commits.UPDATE, {'title': '1'}, 'user')
+
+        assert_false(write_behind.flush('pkg'))
+        assert_equals(self.queue.pending('pkg'), 1)
+
+    def test_coalesced_commit_credits_co_authors(self):
+        backend = _Backend()
+        write_behind = self._write_behind(backend, coalesce_window=60)
+        write_behind.enqueue('pkg', commits.UPDATE, {'title': '1'}, Author('user-1', 'one@example.com'))
+        write_behind.enqueue('pkg', commits.UPDATE, {'title': '2'}, Author('user-2', 'two@example.com'))
+        assert_false(write_behind.process_next())
+
+        assert_true(write_behind.flush('pkg'))
+        assert_equals(backend.commits, [('update', 'pkg', '2', 'user-1')])
+        assert_equals(backend.messages, ['Update pkg\n\nCo-authored-by: user-2 <two@example.com>'])
+        write_behind.close()
+
+    def test_resume_commits_jobs_left_by_previous_process(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'writes.sqlite')
+        try:
+            write_queue.SQLiteWriteQueue(path).put('pkg', commits.UPDATE, {'title': '1'}, 'user')
+
+            backend = _Backend()
+            write_behind = write_queue.WriteBehindQueue(write_queue.SQLiteWriteQueue(path), lambda: backend)
+            try:
+                write_behind.resume()
+                for _ in range(100):
+                    if backend.commits:
+                        break
+                    time.sleep(0.05)
+            finally:
+                write_behind.close()
+        finally:
+            shutil.rmtree(directory)
+
+        assert_equals(backend.commits, [('update', 'pkg', '1', 'user')])
+
+    def test_resume_without_pending_jobs(self):
+        write_behind = self._write_behind(_Backend())
+        write_behind.resume()
+        assert_is_none(write_behind._worker)
+
+    def test_enqueue_is_processed_by_worker(self):
+        backend = _Backend()
+        write_behind = write_queue.WriteBehindQueue(write_queue.MemoryWriteQueue(), lambda: backend)
+        try:
+            write_behind.enqueue('pkg', commits.UPDATE, {'title': '1'}, Author('user', None))
+            assert_true(write_behind.flush('pkg', timeout=5))
+        finally:
+            write_behind.close()
+        assert_equals(backend.commits, [('update', 'pkg', '1', 'user')])